@@ -6,20 +6,59 @@
 __author__ = 'Aleksey Devyatkin <devyatkin.av@ya.ru>'
 
 import argparse
+import array
+import asyncio
+import base64
+import bisect
 import collections
+import contextlib
+import csv
+import copy
+import cProfile
 import datetime
+import functools
 import gzip
+import heapq
 import io
+import itertools
 import json
 import logging
+import math
+import mmap
+import multiprocessing
 import os
+import pstats
+import queue
+import random
 import re
+import shutil
+import sqlite3
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
 import time
+import tracemalloc
+import urllib.parse
+import zlib
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
 
 
 def singleton_decorator(cls):
-    """Декоратор превращающий декорируемый класс в синглтон."""
+    """Декоратор превращающий декорируемый класс в синглтон.
+
+    Сам класс доступен как __wrapped__ - для независимых экземпляров (см. BatchRunner).
+    """
     instances = {}
 
     def get_instance(*args, **kwargs):
@@ -27,6 +66,7 @@ def singleton_decorator(cls):
             instances[cls] = cls(*args, **kwargs)
         return instances[cls]
 
+    get_instance.__wrapped__ = cls
     return get_instance
 
 
@@ -69,6 +109,11 @@ class Utils:
     def _ts_time_str(self):
         return str(self._ts_time)
 
+    @staticmethod
+    def peak_rss() -> int:
+        """Пиковый RSS процесса, КБ (None - модуль resource недоступен)."""
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+
     def public_attrs(self) -> dict:
         """Словарь только публичных атрибутов класса."""
         result_dict = dict()
@@ -85,8 +130,11 @@ class Utils:
         return result_dict
 
     def update(self, config_dict: dict):
-        """Задает значения публичных атрибутов класса."""
-        for attr in config_dict:
+        """Задает значения публичных атрибутов класса.
+
+        incremental задается первым: от него зависит проверка ts_f_path.
+        """
+        for attr in sorted(config_dict, key=lambda attr: attr.lower() != 'incremental'):
             if attr.startswith('_'):
                 continue
             if hasattr(self.__class__, attr) and callable(getattr(self.__class__, attr)):  # noqa
@@ -140,21 +188,330 @@ class Utils:
         return converted
 
     @staticmethod
-    def read_file_gen(file_name: str):
+    def log_name_date(file_name: str, date_re, date_fmt: str):
+        """Дата из имени лога по скомпилированному date_re, None - в имени нет корректной даты."""
+        date_match = date_re.search(file_name)
+        try:
+            return Utils.str_to_date(date_match.group(), date_fmt) if date_match else None
+        except ValueError:
+            return None
+
+    @staticmethod
+    def scan_logs(log_dir: str, recursive: bool, name_re, date_re, date_fmt: str) -> tuple:
+        """Ищет логи в log_dir через os.scandir (во вложенные каталоги - только при recursive).
+
+        Возвращает (mtime просмотренных каталогов, LogFile по возрастанию даты,
+        пути файлов с подходящим именем без корректной даты).
+        """
+        dir_mtimes, logs, undated = dict(), [], []
+        dirs = [log_dir or os.curdir]
+        while dirs:
+            dir_path = dirs.pop()
+            # mtime до чтения: изменение во время чтения будет замечено при следующем запуске
+            dir_mtimes[dir_path] = os.stat(dir_path).st_mtime_ns
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            dirs.append(entry.path)
+                        continue
+                    if not name_re.match(entry.name):
+                        continue
+                    log_date = Utils.log_name_date(entry.name, date_re, date_fmt)
+                    if log_date is None:
+                        undated.append(entry.path)
+                        continue
+                    entry_stat = entry.stat()
+                    logs.append(LogFile(log_date, entry.path, entry_stat.st_size, entry_stat.st_mtime))
+        return dir_mtimes, sorted(logs), undated
+
+    @staticmethod
+    def decompress_command():
+        """Внешний распаковщик gzip из PATH: pigz предпочтительнее zcat."""
+        for command in (['pigz', '-dc'], ['zcat']):
+            if shutil.which(command[0]):
+                return command
+        return None
+
+    @staticmethod
+    def resolve_decompress_backend(backend: str) -> str:
+        """Заменяет auto на доступный способ распаковки gzip.
+
+        auto: на одном ядре распаковку не с чем совмещать - gzip,
+        иначе pipe при наличии pigz/zcat, иначе thread.
+        pipe без распаковщика в PATH деградирует до thread.
+        """
+        if backend == 'auto':
+            cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+            if (cpu_count or 1) < 2:
+                return 'gzip'
+        if backend in ('auto', 'pipe'):
+            return 'pipe' if Utils.decompress_command() else 'thread'
+        return backend
+
+    @staticmethod
+    def resolve_report_backend(backend: str) -> str:
+        """Заменяет auto на numpy, если NumPy установлен, иначе на python."""
+        if backend == 'auto':
+            return 'numpy' if numpy is not None else 'python'
+        if backend == 'numpy' and numpy is None:
+            raise AssertionError('REPORT_BACKEND numpy requires NumPy.')
+        return backend
+
+    @staticmethod
+    @contextlib.contextmanager
+    def open_gzip(file_name: str, backend: str = 'gzip', block_size: int = 1048576):
+        """Открывает gzip файл на чтение bytes выбранным способом распаковки.
+
+        gzip: распаковка в текущем потоке
+        pipe: распаковка внешним процессом (pigz -dc или zcat)
+        thread: распаковка фоновым потоком в ограниченную очередь блоков
+        """
+        if backend == 'pipe':
+            command = Utils.decompress_command()
+            # stderr - во временный файл: непрочитанный pipe stderr остановил бы распаковщик
+            # после 64 КБ предупреждений, пока stdout еще не вычитан
+            error_f = tempfile.TemporaryFile()
+            try:
+                process = subprocess.Popen(command + [file_name], stdout=subprocess.PIPE, stderr=error_f)
+            except (TypeError, OSError):
+                error_f.close()
+                backend = 'thread'
+            else:
+                # Буфер pipe мал (64 КБ), поэтому pipe вычитывается фоновым потоком:
+                # распаковщик не ждет, пока разбирается очередной блок.
+                reader = ThreadedReader(lambda: process.stdout, block_size)
+                completed = False
+                try:
+                    yield reader
+                    completed = True
+                finally:
+                    if not completed:
+                        process.kill()
+                    reader.close()
+                    return_code = process.wait()
+                    error_f.seek(0)
+                    error = error_f.read()
+                    error_f.close()
+                if return_code:
+                    raise OSError('{} failed with code {}: {}'.format(command[0], return_code,
+                                                                       error.decode('utf-8', 'replace').strip()))
+                return
+
+        if backend == 'thread':
+            with ThreadedReader(functools.partial(gzip.open, file_name, 'rb'), block_size) as f:
+                yield f
+            return
+
+        with gzip.open(file_name, 'rb') as f:
+            yield f
+
+    @staticmethod
+    def read_file_gen(file_name: str, backend: str = 'gzip'):
         """Line by line read the log file."""
         assert (isinstance(file_name, str))
-        file_context = gzip.open if file_name.endswith('.gz') else open
-        with file_context(file_name, 'rt') as f:
+        if file_name.endswith('.gz'):
+            with Utils.open_gzip(file_name, backend) as f:
+                if isinstance(f, io.RawIOBase):
+                    f = io.BufferedReader(f)
+                for line in io.TextIOWrapper(f):
+                    if line:
+                        yield line
+            return
+
+        with open(file_name, 'rt') as f:
             for line in f:
                 if line:
                     yield line
 
-    def save_text_file(self, file_path: str, txt_data):
-        """Сохраняем файл в текстовом формате."""
+    @staticmethod
+    def split_file(file_name: str, parts: int, start: int = 0, end: int = None) -> list:
+        """Делит файл на диапазоны байт, выровненные по границам строк.
+
+        Возвращает список пар (start, end), покрывающих диапазон [start, end)
+        (по умолчанию - весь файл). start должен быть началом строки.
+        """
+        assert (isinstance(parts, int) and parts > 0)
+        end = os.path.getsize(file_name) if end is None else end
+        bounds = [start]
+
+        with open(file_name, 'rb') as f:
+            for part in range(1, parts):
+                f.seek(max(start + (end - start) * part // parts, bounds[-1]))
+                if f.tell() > start:
+                    f.readline()
+                bound = min(f.tell(), end)
+                if bound > bounds[-1]:
+                    bounds.append(bound)
+
+        if end > bounds[-1] or end == start:
+            bounds.append(end)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    @staticmethod
+    def last_line_end(file_name: str, size: int, block_size: int = 65536) -> int:
+        """Позиция сразу за последним b'\\n' в первых size байтах файла (0 - переводов строки нет)."""
+        with open(file_name, 'rb') as f:
+            position = size
+            while position > 0:
+                block_start = max(position - block_size, 0)
+                f.seek(block_start)
+                found = f.read(position - block_start).rfind(b'\n')
+                if found >= 0:
+                    return block_start + found + 1
+                position = block_start
+        return 0
+
+    @staticmethod
+    def head_crc(file_name: str, size: int = 4096) -> int:
+        """Контрольная сумма первых size байт файла."""
+        with open(file_name, 'rb') as f:
+            return zlib.crc32(f.read(size))
+
+    @staticmethod
+    def read_range_gen(file_name: str, start: int, end: int):
+        """Построчно читает диапазон байт [start, end) несжатого лога."""
+        with open(file_name, 'rb') as f:
+            f.seek(start)
+            position = start
+            for line in f:
+                if position >= end:
+                    break
+                position += len(line)
+                yield line.decode('utf-8')
+
+    @staticmethod
+    def read_blocks_gen(file_name: str, block_size: int, start: int = 0, end: int = None, backend: str = 'gzip'):
+        """Читает лог блоками bytes размером block_size.
+
+        У несжатого лога читается диапазон байт [start, end), ядру сообщается
+        о последовательном чтении. gzip лог читается целиком и распаковывается
+        способом backend (см. open_gzip).
+        """
+        assert (isinstance(file_name, str) and block_size > 0)
+        if file_name.endswith('.gz'):
+            with Utils.open_gzip(file_name, backend, block_size) as f:
+                for block in iter(functools.partial(f.read, block_size), b''):
+                    yield block
+            return
+
+        with open(file_name, 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), start, 0, os.POSIX_FADV_SEQUENTIAL)
+            f.seek(start)
+            remaining = float('inf') if end is None else end - start
+            while remaining > 0:
+                block = f.read(int(min(block_size, remaining)))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield block
+
+    @staticmethod
+    def read_sample_blocks_gen(file_name: str, rate: float, block_size: int, start: int = 0, end: int = None):
+        """Читает около доли rate диапазона байт [start, end) несжатого лога равномерными окнами.
+
+        Диапазон делится на равные шаги, в начале каждого шага читается окно около block_size байт:
+        блок bytes из целых строк, начинающихся внутри окна. Остальной файл не читается,
+        каждая строка попадает в выборку с вероятностью rate.
+        """
+        assert (0 < rate <= 1 and block_size > 0)
+        end = os.path.getsize(file_name) if end is None else end
+        windows = max(1, round((end - start) * rate / block_size))
+        stride = (end - start) / windows
+        window = (end - start) * rate / windows
+
+        with open(file_name, 'rb') as f:
+            for number in range(windows):
+                window_start, window_end = start + int(number * stride), start + int(number * stride + window)
+                if window_start > start:
+                    # первая строка, начинающаяся не раньше window_start
+                    f.seek(window_start - 1)
+                    f.readline()
+                else:
+                    f.seek(start)
+                if f.tell() >= window_end:
+                    continue
+                block = f.read(window_end - f.tell())
+                if not block.endswith(b'\n'):
+                    block += f.readline()
+                yield block
+
+    @staticmethod
+    def align_blocks_gen(blocks):
+        """Перенарезает блоки bytes так, чтобы каждый блок заканчивался целой строкой."""
+        tail = b''
+        for block in blocks:
+            cut = block.rfind(b'\n') + 1
+            if not cut:
+                tail += block
+                continue
+            yield tail + block[:cut] if tail else block[:cut]
+            tail = block[cut:]
+        if tail:
+            yield tail
+
+    @staticmethod
+    def split_lines_gen(blocks):
+        """Делит блоки bytes на строки (без b'\\n'), строка может продолжаться в следующих блоках."""
+        tail = b''
+        for block in blocks:
+            lines = block.split(b'\n')
+            if tail:
+                lines[0] = tail + lines[0]
+            tail = lines.pop()
+            yield from lines
+        if tail:
+            yield tail
+
+    def read_bytes_gen(self, file_name: str, block_size: int = 8388608, start: int = 0, end: int = None,
+                       backend: str = 'gzip'):
+        """Построчно читает лог в режиме bytes."""
+        return self.split_lines_gen(self.read_blocks_gen(file_name, block_size, start, end, backend))
+
+    def save_text_file(self, file_path: str, txt_data, overwrite: bool = False):
+        """Сохраняем файл в текстовом формате.
+
+        overwrite: существующий файл заменяется атомарно.
+        """
+        if overwrite:
+            self.save_atomic(file_path, txt_data.encode('utf-8'))
+            return
         self.check_not_exists(file_path)
         with io.open(file_path, mode='w', encoding='utf-8') as output_f:
             output_f.write(txt_data)
 
+    @staticmethod
+    def save_atomic(file_path: str, data: bytes):
+        """Атомарно записывает data в file_path: временный файл в том же каталоге и rename.
+
+        При сбое на диске остается либо прежний, либо новый файл целиком.
+        """
+        with Utils.open_atomic(file_path) as temp_f:
+            temp_f.write(data)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def open_atomic(file_path: str, mode: str = 'wb', **kwargs):
+        """Файл для атомарной записи в file_path (см. save_atomic) - для записи по частям.
+
+        kwargs передаются в open (encoding, newline для текстового mode).
+        """
+        directory = os.path.dirname(os.path.abspath(file_path))
+        fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(file_path), dir=directory)
+        umask = os.umask(0)
+        os.umask(umask)
+        try:
+            os.chmod(temp_path, 0o666 & ~umask)
+            with os.fdopen(fd, mode, **kwargs) as temp_f:
+                yield temp_f
+                temp_f.flush()
+                os.fsync(temp_f.fileno())
+            os.replace(temp_path, file_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
     def save_json_file(self, file_path: str, json_data):
         """Сохраняем файл в формате JSON."""
         self.check_not_exists(file_path)
@@ -162,6 +519,88 @@ class Utils:
             json.dump(json_data, json_file, sort_keys=True, indent=2, ensure_ascii=False)  # noqa
 
 
+class ThreadedReader(io.RawIOBase):
+    """Файловый объект, который читает источник в фоновом потоке.
+
+    Поток читает блоки block_size из opener() в очередь из max_blocks
+    элементов, потребитель забирает их через read/readinto. Распаковка
+    zlib отпускает GIL, поэтому она идет параллельно с разбором строк,
+    а память ограничена max_blocks * block_size.
+    """
+
+    def __init__(self, opener, block_size: int = 1048576, max_blocks: int = 4):
+        super().__init__()
+        self._queue = queue.Queue(max_blocks)
+        self._stop = threading.Event()
+        self._block, self._offset = b'', 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._fill, args=(opener, block_size), daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fill(self, opener, block_size: int):
+        try:
+            with opener() as f:
+                for block in iter(functools.partial(f.read, block_size), b''):
+                    if not self._put(block):
+                        return
+        except Exception as error:  # noqa
+            self._put(error)
+            return
+        self._put(None)
+
+    def readable(self):
+        return True
+
+    def _next_block(self) -> bool:
+        """Берет из очереди следующий блок, False - данные закончились."""
+        while self._offset >= len(self._block):
+            if self._eof:
+                return False
+            item = self._queue.get()
+            if item is None or isinstance(item, Exception):
+                self._eof = True
+                if item is not None:
+                    raise item
+                return False
+            self._block, self._offset = item, 0
+        return True
+
+    def readinto(self, buffer):
+        if not self._next_block():
+            return 0
+        size = min(len(buffer), len(self._block) - self._offset)
+        buffer[:size] = self._block[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+    def read(self, size: int = -1):
+        """Блок, помещающийся в size целиком, возвращается без копирования."""
+        if size is None or size < 0:
+            return self.readall()
+        if not self._next_block():
+            return b''
+        if self._offset == 0 and len(self._block) <= size:
+            self._offset = len(self._block)
+            return self._block
+        block = self._block[self._offset:self._offset + size]
+        self._offset += len(block)
+        return block
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        super().close()
+
+
 @singleton_decorator
 class Config(Utils):
     """Сущность конфига скрипта.
@@ -172,6 +611,9 @@ class Config(Utils):
         max_mismatch_count: количество промахов при котором структура считается корректной
         max_mismatch_percent и max_mismatch_count - связаны по принципу AND
         log_dir: каталог с обрабатываемыми логами
+        log_dir_recursive: искать логи и во вложенных каталогах log_dir
+        log_catalog_path: файл для сохранения каталога логов между запусками (если не указан - каталог
+                          строится заново при каждом запуске)
         log_name_pattern: re для поиска файлов с логами в каталоге log_dir
         log_name_date_pattern: формат даты для поиска в log_name_pattern
         report_dir: каталог для сохранятения итоговый отчет
@@ -180,8 +622,58 @@ class Config(Utils):
         date_fmt: внутренний формат даты для сравнения
         min_log_date: минимальная дата лога nginx для поиска
         web_server_log_pattern: паттерн для разбора строк в логе nginx
+        web_server_log_format: директива nginx log_format (или имя из LOG_FORMATS) для быстрого разбора строк,
+                               json - строки JSON (log_format ... escape=json)
+        json_url_field, json_time_field: ключи url и времени обработки в строках JSON лога
+        log_format_detect: выбирать формат по выборке строк лога из настроенного и LOG_FORMATS
+        validate_lines: размер выборки строк из начала (и середины) лога для проверки формата до полного разбора
+                        (0 - без проверки)
+        workers: количество процессов для параллельного разбора несжатого лога
+        read_mode: режим чтения лога: text - построчно с декодированием, bytes - блоками байт
+        read_buffer_size: размер блока чтения в режиме bytes, байт
+        decompress_backend: распаковка gzip: auto, gzip (в процессе), pipe (pigz/zcat), thread (фоновый поток)
+        report_backend: расчет отчета: auto (numpy, если установлен), python, numpy
+        incremental: инкрементальный разбор - статистика и позиция в логе сохраняются в checkpoint,
+                     следующий запуск дочитывает только новые строки и перезаписывает отчет
+        checkpoint_dir: каталог для checkpoint (если не указан - report_dir)
+        columnar_cache: сохранять разобранные записи лога в columns файл в checkpoint_dir - повторный
+                        разбор того же лога (при неизменных размере, mtime и начале файла) читает их без разбора строк
+        quantile_mode: режим расчета квантилей: exact - по всем значениям, approx - по QuantileSketch
+        quantile_accuracy: относительная погрешность квантилей в режиме approx
+        sample_rate: доля разбираемых строк лога (1 - все строки); count и time_sum в отчете
+                     масштабируются обратно, рядом - полуширина 95% доверительного интервала
+        sample_mode: выборка: block - участки файла по смещению (пропущенное не читается; для gz - как line),
+                     line - по хешу строки, url - по хешу url (выбранные url учитываются полностью)
+        sample_block_size: размер участка файла в режиме block, байт
+        report_percentiles: дополнительные перцентили в отчете, например [90, 95, 99]
+        report_rankings: рейтинги url в отчете {ключ сортировки: размер}, ключи из REPORT_RANKINGS
+                         (если не указаны - один рейтинг time_sum размером report_size)
+        history_path: база SQLite с историей дневных агрегатов url (HistoryStore) - каждый разобранный
+                      лог сохраняется в нее как день, --history строит по ней тренды (пусто - не ведется)
+        time_series: интервалы временного ряда url в отчете: minute или hour (TIME_SERIES_BUCKETS) по $time_local
+                     строки - count, time_sum, time_max и медиана за интервал (пусто - без ряда)
+        time_series_top: ряд строится для стольких первых url каждого рейтинга отчета
+        report_sinks: форматы отчета из REPORT_SINKS (html, json, ndjson, csv, sqlite) - все пишутся
+                      из одной статистики в файлы с общим именем и расширением формата
+        heavy_hitters: отслеживать только столько url с наибольшим весом (Space-Saving, память не зависит
+                       от числа разных url; 0 - все url)
+        heavy_hitters_key: вес url в режиме heavy_hitters: time_sum или count
+        url_normalize: правила нормализации url до агрегации - имена из URL_NORMALIZE_RULES
+                       (query, numeric, uuid) или пары [re, замена]
+        follow_log_path: активный (дописываемый) лог для режима --follow
+        follow_windows: скользящие окна отчетов режима --follow, минуты
+        follow_interval: период обновления отчетов режима --follow, секунды
+        server_port: порт HTTP сервера с топом url по окнам режима --follow (0 - сервер не запускается)
+        server_host: адрес HTTP сервера
+        benchmark_sizes: размеры синтетических логов (строк) для --benchmark-suite, не больше BENCHMARK_MAX_SIZE
+        benchmark_dir: каталог для синтетических логов --benchmark-suite (если не указан - временный)
+        benchmark_baseline: файл с baseline --benchmark-suite (если файла нет - результаты сохраняются в него)
+        benchmark_tolerance: допустимое ухудшение скорости и памяти относительно baseline, доля
 
     Параметры логгирования работы:
+        run_summary: замер времени этапов, объема и памяти запуска - итоги пишутся в лог и в JSON рядом с ts_f_path
+        prometheus_textfile: .prom файл для textfile collector node_exporter с метриками запуска
+                             (перезаписывается в конце запуска и при каждом обновлении отчетов --follow)
         log_level: уровень логгирования
         logfile_format: формат лога выполнения
         logfile_date_format: формат даты для лога выполнения
@@ -203,14 +695,55 @@ class Config(Utils):
         self.date_fmt = '%Y%m%d'
         self.min_log_date = '19700101'
         self.log_dir = ''
+        self.log_dir_recursive = False
+        self.log_catalog_path = ''
         self.log_name_pattern = r'nginx-access-ui\.log-[\d]{8}'
         self.log_name_date_pattern = r'[\d]{8}'
         self.report_dir = ''
         self.log_level = 'INFO'
         self.report_template_path = ''
         self.template_replace_tag = '$table_json'
+        self.workers = 1
+        self.read_mode = 'text'
+        self.read_buffer_size = 8 * 1024 * 1024
+        self.decompress_backend = 'auto'
+        self.report_backend = 'auto'
+        self.incremental = False
+        self.checkpoint_dir = ''
+        self.columnar_cache = False
+        self.quantile_mode = 'exact'
+        self.quantile_accuracy = 0.01
+        self.sample_rate = 1.0
+        self.sample_mode = 'block'
+        self.sample_block_size = 65536
+        self.report_percentiles = []
+        self.report_rankings = {}
+        self.report_sinks = ['html']
+        self.history_path = ''
+        self.time_series = ''
+        self.time_series_top = 10
+        self.heavy_hitters = 0
+        self.heavy_hitters_key = 'time_sum'
+        self.url_normalize = []
+        self.follow_log_path = ''
+        self.follow_windows = [5, 15, 60]
+        self.follow_interval = 60
+        self.server_host = '127.0.0.1'
+        self.server_port = 0
+        self.benchmark_sizes = [100000, 1000000]
+        self.benchmark_dir = ''
+        self.benchmark_baseline = ''
+        self.benchmark_tolerance = 0.2
+        self.web_server_log_format = ''
+        self.json_url_field = 'request'
+        self.json_time_field = 'request_time'
+        self.log_format_detect = False
+        self.validate_lines = 1000
         self.web_server_log_pattern = r'^\S+\s\S+\s{2}\S+\s\[.*?\]\s\"\S+\s(\S+)\s\S+\"\s\S+\s\S+\s.+?\s\".+?\"\s\S+\s\S+\s\S+\s(\S+)'  # noqa
 
+        self.run_summary = False
+        self.prometheus_textfile = ''
+
         # empty strings for proper config_template output
         self.logfile_path = ''
         self.ts_f_path = ''
@@ -218,6 +751,29 @@ class Config(Utils):
         if config_file:
             self.load(config_file)
 
+    @property
+    def run_summary(self):
+        """Замер этапов запуска с записью итогов в лог и JSON."""
+        return self.__run_summary
+
+    @run_summary.setter
+    def run_summary(self, enabled: bool):
+        """Замер этапов запуска с записью итогов в лог и JSON."""
+        assert (isinstance(enabled, bool))
+        self.__run_summary = enabled
+
+    @property
+    def prometheus_textfile(self):
+        """Файл метрик для textfile collector node_exporter."""
+        return self.__prometheus_textfile
+
+    @prometheus_textfile.setter
+    def prometheus_textfile(self, file_path: str):
+        """Файл метрик для textfile collector node_exporter."""
+        assert (isinstance(file_path, str))
+        assert (not file_path or file_path.endswith('.prom'))
+        self.__prometheus_textfile = file_path
+
     @property
     def max_mismatch_count(self):
         """Количество промахов при котором структура считается корректной."""
@@ -313,6 +869,28 @@ class Config(Utils):
         self.check_exists(directory)
         self.__log_dir = directory
 
+    @property
+    def log_dir_recursive(self):
+        """Искать логи во вложенных каталогах log_dir."""
+        return self.__log_dir_recursive
+
+    @log_dir_recursive.setter
+    def log_dir_recursive(self, enabled: bool):
+        """Искать логи во вложенных каталогах log_dir."""
+        assert (isinstance(enabled, bool))
+        self.__log_dir_recursive = enabled
+
+    @property
+    def log_catalog_path(self):
+        """Файл для сохранения каталога логов между запусками."""
+        return self.__log_catalog_path
+
+    @log_catalog_path.setter
+    def log_catalog_path(self, file_path: str):
+        """Файл для сохранения каталога логов между запусками."""
+        assert (isinstance(file_path, str))
+        self.__log_catalog_path = file_path
+
     @property
     def log_name_pattern(self):
         """Регулярное выражение по которому будут искаться файлы с логами в каталоге log_dir."""
@@ -324,6 +902,385 @@ class Config(Utils):
         assert (isinstance(pattern, str))
         self.__log_name_pattern = pattern
 
+    @property
+    def workers(self):
+        """Количество процессов для параллельного разбора несжатого лога."""
+        return self.__workers
+
+    @workers.setter
+    def workers(self, count: int):
+        """Количество процессов для параллельного разбора несжатого лога."""
+        assert (isinstance(count, int))
+        if count < 1:
+            count = 1
+        self.__workers = count
+
+    @property
+    def read_mode(self):
+        """Режим чтения лога: text или bytes."""
+        return self.__read_mode
+
+    @read_mode.setter
+    def read_mode(self, mode: str):
+        """Режим чтения лога: text или bytes."""
+        assert (isinstance(mode, str))
+        mode = mode.lower()
+        assert (mode in ('text', 'bytes'))
+        self.__read_mode = mode
+
+    @property
+    def read_buffer_size(self):
+        """Размер блока чтения в режиме bytes, байт."""
+        return self.__read_buffer_size
+
+    @read_buffer_size.setter
+    def read_buffer_size(self, size: int):
+        """Размер блока чтения в режиме bytes, байт."""
+        assert (isinstance(size, int))
+        if size < 65536:
+            size = 65536
+        self.__read_buffer_size = size
+
+    @property
+    def decompress_backend(self):
+        """Способ распаковки gzip: auto, gzip, pipe или thread."""
+        return self.__decompress_backend
+
+    @decompress_backend.setter
+    def decompress_backend(self, backend: str):
+        """Способ распаковки gzip: auto, gzip, pipe или thread."""
+        assert (isinstance(backend, str))
+        backend = backend.lower()
+        assert (backend in ('auto', 'gzip', 'pipe', 'thread'))
+        self.__decompress_backend = backend
+
+    @property
+    def report_backend(self):
+        """Расчет отчета: auto, python или numpy."""
+        return self.__report_backend
+
+    @report_backend.setter
+    def report_backend(self, backend: str):
+        """Расчет отчета: auto, python или numpy."""
+        assert (isinstance(backend, str))
+        backend = backend.lower()
+        assert (backend in ('auto', 'python', 'numpy'))
+        self.__report_backend = backend
+
+    @property
+    def incremental(self):
+        """Инкрементальный разбор лога с сохранением checkpoint."""
+        return self.__incremental
+
+    @incremental.setter
+    def incremental(self, enabled: bool):
+        """Инкрементальный разбор лога с сохранением checkpoint."""
+        assert (isinstance(enabled, bool))
+        self.__incremental = enabled
+
+    @property
+    def checkpoint_dir(self):
+        """Каталог для checkpoint инкрементального разбора."""
+        return self.__checkpoint_dir
+
+    @checkpoint_dir.setter
+    def checkpoint_dir(self, directory: str):
+        """Каталог для checkpoint инкрементального разбора."""
+        assert (isinstance(directory, str))
+        if directory:
+            self.check_exists(directory)
+        self.__checkpoint_dir = directory
+
+    @property
+    def columnar_cache(self):
+        """Сохранение разобранных записей лога в columns файл."""
+        return self.__columnar_cache
+
+    @columnar_cache.setter
+    def columnar_cache(self, enabled: bool):
+        """Сохранение разобранных записей лога в columns файл."""
+        assert (isinstance(enabled, bool))
+        self.__columnar_cache = enabled
+
+    @property
+    def quantile_mode(self):
+        """Режим расчета квантилей: exact или approx."""
+        return self.__quantile_mode
+
+    @quantile_mode.setter
+    def quantile_mode(self, mode: str):
+        """Режим расчета квантилей: exact или approx."""
+        assert (isinstance(mode, str))
+        mode = mode.lower()
+        assert (mode in ('exact', 'approx'))
+        self.__quantile_mode = mode
+
+    @property
+    def quantile_accuracy(self):
+        """Относительная погрешность квантилей в режиме approx."""
+        return self.__quantile_accuracy
+
+    @quantile_accuracy.setter
+    def quantile_accuracy(self, accuracy: float):
+        """Относительная погрешность квантилей в режиме approx."""
+        assert (isinstance(accuracy, (int, float)))
+        assert (0 < accuracy < 1)
+        self.__quantile_accuracy = accuracy
+
+    @property
+    def sample_rate(self):
+        """Доля разбираемых строк лога."""
+        return self.__sample_rate
+
+    @sample_rate.setter
+    def sample_rate(self, rate: float):
+        """Доля разбираемых строк лога."""
+        assert (isinstance(rate, (int, float)))
+        assert (0 < rate <= 1)
+        self.__sample_rate = rate
+
+    @property
+    def sample_mode(self):
+        """Способ выборки строк: block, line или url."""
+        return self.__sample_mode
+
+    @sample_mode.setter
+    def sample_mode(self, mode: str):
+        """Способ выборки строк: block, line или url."""
+        assert (isinstance(mode, str))
+        mode = mode.lower()
+        assert (mode in ('block', 'line', 'url'))
+        self.__sample_mode = mode
+
+    @property
+    def sample_block_size(self):
+        """Размер участка файла в режиме выборки block, байт."""
+        return self.__sample_block_size
+
+    @sample_block_size.setter
+    def sample_block_size(self, size: int):
+        """Размер участка файла в режиме выборки block, байт."""
+        assert (isinstance(size, int) and size > 0)
+        self.__sample_block_size = size
+
+    @property
+    def report_percentiles(self):
+        """Дополнительные перцентили времени обработки в отчете."""
+        return self.__report_percentiles
+
+    @report_percentiles.setter
+    def report_percentiles(self, percentiles: list):
+        """Дополнительные перцентили времени обработки в отчете."""
+        assert (isinstance(percentiles, list))
+        assert (all(isinstance(perc, int) and 0 < perc < 100 for perc in percentiles))
+        self.__report_percentiles = percentiles
+
+    @property
+    def report_rankings(self):
+        """Рейтинги url в отчете: ключ сортировки -> размер рейтинга."""
+        return self.__report_rankings
+
+    @report_rankings.setter
+    def report_rankings(self, rankings: dict):
+        """Рейтинги url в отчете: ключ сортировки -> размер рейтинга."""
+        assert (isinstance(rankings, dict))
+        assert (all(key in REPORT_RANKINGS for key in rankings))
+        assert (all(isinstance(size, int) and size > 0 for size in rankings.values()))
+        self.__report_rankings = rankings
+
+    @property
+    def report_sinks(self):
+        """Форматы отчета - имена из REPORT_SINKS."""
+        return self.__report_sinks
+
+    @report_sinks.setter
+    def report_sinks(self, sinks: list):
+        """Форматы отчета - имена из REPORT_SINKS."""
+        assert (isinstance(sinks, list) and sinks)
+        assert (all(sink in REPORT_SINKS for sink in sinks) and len(set(sinks)) == len(sinks))
+        self.__report_sinks = sinks
+
+    @property
+    def history_path(self):
+        """База SQLite с историей дневных агрегатов url."""
+        return self.__history_path
+
+    @history_path.setter
+    def history_path(self, file_path: str):
+        """База SQLite с историей дневных агрегатов url."""
+        assert (isinstance(file_path, str))
+        self.__history_path = file_path
+
+    @property
+    def time_series(self):
+        """Интервал временного ряда url: minute, hour или пусто."""
+        return self.__time_series
+
+    @time_series.setter
+    def time_series(self, interval: str):
+        """Интервал временного ряда url: minute, hour или пусто."""
+        assert (isinstance(interval, str))
+        interval = interval.lower()
+        assert (not interval or interval in TIME_SERIES_BUCKETS)
+        self.__time_series = interval
+
+    @property
+    def time_series_top(self):
+        """Количество первых url каждого рейтинга с временным рядом."""
+        return self.__time_series_top
+
+    @time_series_top.setter
+    def time_series_top(self, size: int):
+        """Количество первых url каждого рейтинга с временным рядом."""
+        assert (isinstance(size, int) and size > 0)
+        self.__time_series_top = size
+
+    @property
+    def heavy_hitters(self):
+        """Число отслеживаемых url в режиме heavy hitters (0 - все url)."""
+        return self.__heavy_hitters
+
+    @heavy_hitters.setter
+    def heavy_hitters(self, capacity: int):
+        """Число отслеживаемых url в режиме heavy hitters (0 - все url)."""
+        assert (isinstance(capacity, int) and capacity >= 0)
+        self.__heavy_hitters = capacity
+
+    @property
+    def heavy_hitters_key(self):
+        """Вес url в режиме heavy hitters: time_sum или count."""
+        return self.__heavy_hitters_key
+
+    @heavy_hitters_key.setter
+    def heavy_hitters_key(self, key: str):
+        """Вес url в режиме heavy hitters: time_sum или count."""
+        assert (key in HeavyHitterStat.keys)
+        self.__heavy_hitters_key = key
+
+    @property
+    def url_normalize(self):
+        """Правила нормализации url до агрегации."""
+        return self.__url_normalize
+
+    @url_normalize.setter
+    def url_normalize(self, rules: list):
+        """Правила нормализации url до агрегации: имена из URL_NORMALIZE_RULES или пары [re, замена]."""
+        assert (isinstance(rules, list))
+        for rule in rules:
+            if isinstance(rule, str):
+                assert (rule in URL_NORMALIZE_RULES)
+            else:
+                assert (isinstance(rule, list) and len(rule) == 2 and all(isinstance(part, str) for part in rule))
+                re.compile(rule[0])
+        self.__url_normalize = rules
+
+    @property
+    def follow_log_path(self):
+        """Активный лог для режима --follow."""
+        return self.__follow_log_path
+
+    @follow_log_path.setter
+    def follow_log_path(self, file_path: str):
+        """Активный лог для режима --follow."""
+        assert (isinstance(file_path, str))
+        self.__follow_log_path = file_path
+
+    @property
+    def follow_windows(self):
+        """Скользящие окна отчетов режима --follow, минуты."""
+        return self.__follow_windows
+
+    @follow_windows.setter
+    def follow_windows(self, windows: list):
+        """Скользящие окна отчетов режима --follow, минуты."""
+        assert (isinstance(windows, list) and windows)
+        assert (all(isinstance(window, int) and window > 0 for window in windows))
+        self.__follow_windows = windows
+
+    @property
+    def follow_interval(self):
+        """Период обновления отчетов режима --follow, секунды."""
+        return self.__follow_interval
+
+    @follow_interval.setter
+    def follow_interval(self, interval: int):
+        """Период обновления отчетов режима --follow, секунды."""
+        assert (isinstance(interval, int))
+        if interval < 1:
+            interval = 1
+        self.__follow_interval = interval
+
+    @property
+    def server_host(self):
+        """Адрес HTTP сервера режима --follow."""
+        return self.__server_host
+
+    @server_host.setter
+    def server_host(self, host: str):
+        """Адрес HTTP сервера режима --follow."""
+        assert (isinstance(host, str))
+        self.__server_host = host
+
+    @property
+    def server_port(self):
+        """Порт HTTP сервера режима --follow, 0 - сервер не запускается."""
+        return self.__server_port
+
+    @server_port.setter
+    def server_port(self, port: int):
+        """Порт HTTP сервера режима --follow, 0 - сервер не запускается."""
+        assert (isinstance(port, int))
+        assert (0 <= port < 65536)
+        self.__server_port = port
+
+    @property
+    def benchmark_sizes(self):
+        """Размеры синтетических логов для --benchmark-suite, строк."""
+        return self.__benchmark_sizes
+
+    @benchmark_sizes.setter
+    def benchmark_sizes(self, sizes: list):
+        """Размеры синтетических логов для --benchmark-suite, строк."""
+        assert (isinstance(sizes, list) and sizes)
+        assert (all(isinstance(size, int) and 0 < size <= BENCHMARK_MAX_SIZE for size in sizes))
+        self.__benchmark_sizes = sizes
+
+    @property
+    def benchmark_dir(self):
+        """Каталог для синтетических логов --benchmark-suite."""
+        return self.__benchmark_dir
+
+    @benchmark_dir.setter
+    def benchmark_dir(self, directory: str):
+        """Каталог для синтетических логов --benchmark-suite."""
+        assert (isinstance(directory, str))
+        if directory:
+            self.check_exists(directory)
+        self.__benchmark_dir = directory
+
+    @property
+    def benchmark_baseline(self):
+        """Файл с baseline --benchmark-suite."""
+        return self.__benchmark_baseline
+
+    @benchmark_baseline.setter
+    def benchmark_baseline(self, file_path: str):
+        """Файл с baseline --benchmark-suite."""
+        assert (isinstance(file_path, str))
+        self.__benchmark_baseline = file_path
+
+    @property
+    def benchmark_tolerance(self):
+        """Допустимое ухудшение результатов --benchmark-suite относительно baseline, доля."""
+        return self.__benchmark_tolerance
+
+    @benchmark_tolerance.setter
+    def benchmark_tolerance(self, tolerance: float):
+        """Допустимое ухудшение результатов --benchmark-suite относительно baseline, доля."""
+        assert (isinstance(tolerance, (int, float)))
+        assert (0 <= tolerance < 1)
+        self.__benchmark_tolerance = tolerance
+
     @property
     def web_server_log_pattern(self):
         """Паттерн для разбора строк в логе nginx."""
@@ -335,6 +1292,61 @@ class Config(Utils):
         assert (isinstance(pattern, str))
         self.__web_server_log_pattern = pattern
 
+    @property
+    def web_server_log_format(self):
+        """Директива nginx log_format для быстрого разбора строк (пусто - только паттерн)."""
+        return self.__web_server_log_format
+
+    @web_server_log_format.setter
+    def web_server_log_format(self, log_format: str):
+        """Директива nginx log_format для быстрого разбора строк (пусто - только паттерн)."""
+        assert (isinstance(log_format, str))
+        self.__web_server_log_format = log_format
+
+    @property
+    def json_url_field(self):
+        """Ключ url ($request или $request_uri) в строках JSON лога."""
+        return self.__json_url_field
+
+    @json_url_field.setter
+    def json_url_field(self, field: str):
+        """Ключ url ($request или $request_uri) в строках JSON лога."""
+        assert (isinstance(field, str) and field and '"' not in field)
+        self.__json_url_field = field
+
+    @property
+    def json_time_field(self):
+        """Ключ времени обработки запроса в строках JSON лога."""
+        return self.__json_time_field
+
+    @json_time_field.setter
+    def json_time_field(self, field: str):
+        """Ключ времени обработки запроса в строках JSON лога."""
+        assert (isinstance(field, str) and field and '"' not in field)
+        self.__json_time_field = field
+
+    @property
+    def log_format_detect(self):
+        """Выбор формата лога по выборке строк."""
+        return self.__log_format_detect
+
+    @log_format_detect.setter
+    def log_format_detect(self, enabled: bool):
+        """Выбор формата лога по выборке строк."""
+        assert (isinstance(enabled, bool))
+        self.__log_format_detect = enabled
+
+    @property
+    def validate_lines(self):
+        """Размер выборки строк для проверки формата лога (0 - без проверки)."""
+        return self.__validate_lines
+
+    @validate_lines.setter
+    def validate_lines(self, lines: int):
+        """Размер выборки строк для проверки формата лога (0 - без проверки)."""
+        assert (isinstance(lines, int) and lines >= 0)
+        self.__validate_lines = lines
+
     @property
     def log_name_date_pattern(self):
         """Формат даты для поиска в log_name_pattern."""
@@ -390,9 +1402,13 @@ class Config(Utils):
 
     @ts_f_path.setter
     def ts_f_path(self, file_path: str):
-        """Файл в который будет сохранено время завершения работы."""
+        """Файл в который будет сохранено время завершения работы.
+
+        В инкрементальном режиме файл перезаписывается - его отсутствие не проверяется.
+        """
         assert (isinstance(file_path, str))
-        self.check_not_exists(file_path)
+        if not self.incremental:
+            self.check_not_exists(file_path)
         self.__ts_f_path = file_path
 
     @property
@@ -429,15 +1445,18 @@ class Config(Utils):
         self.check_exists(file_path_directory)
         self.__logfile_path = file_path
 
-    def load(self, config_file):
-        """Читаем параметры из конфигурационного файла и записываем в атрибуты класса."""
+    def load(self, config_file, exclude: tuple = ()):
+        """Читаем параметры из конфигурационного файла и записываем в атрибуты класса.
+
+        exclude: параметры (в нижнем регистре), которые не задаются - остаются по умолчанию.
+        """
         config_file = self.check_exists(config_file)
         self.check_extension(config_file, self.__extension)
 
         with io.open(config_file, mode='r', encoding='utf-8') as json_config:
             file_config = json.load(json_config)
 
-        self.update(file_config)
+        self.update({attr: value for attr, value in file_config.items() if attr.lower() not in exclude})
 
     def create_template(self, file_path):
         """Создаем конфигурационный файл по атрибутам класса."""
@@ -455,6 +1474,7 @@ class Logging(Utils):
     logfile_format: формат сообщения для хендлера
     log_level: уровень логгирования для хендлера
     logfile_path: файл для записи лога выполнения. Если указан - пишем в файл, если нет - stdout
+    logger_name: имя логгера (у независимых экземпляров - свое, см. BatchRunner)
 
     """
 
@@ -463,9 +1483,10 @@ class Logging(Utils):
                  logfile_format: str,
                  log_level=logging.INFO,
                  logfile_path: str = None,
+                 logger_name: str = 'log_analyzer',
                  **kwargs):
         """Впервые класс инициализируется без обработки конфига."""
-        self.root_logger = logging.getLogger('log_analyzer')
+        self.root_logger = logging.getLogger(logger_name)
         self.root_logger.propagate = False
 
         self.file_handler = None
@@ -524,6 +1545,1795 @@ class Logging(Utils):
         self.root_logger.critical(message)
 
 
+LOG_FORMATS = {
+    'ui_short': '$remote_addr $remote_user  $http_x_real_ip [$time_local] "$request" '
+                '$status $body_bytes_sent "$http_referer" '
+                '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
+                '$request_time',
+    'combined_rt': '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent '
+                   '"$http_referer" "$http_user_agent" $request_time',
+    'timed_combined': '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent '
+                      '"$http_referer" "$http_user_agent" $request_time $upstream_response_time $pipe',
+}
+
+# Ключ сортировки рейтинга -> значение ключа по id url в LogStat.
+# Значения округляются так же, как в отчете, чтобы порядок равных строк не менялся.
+REPORT_RANKINGS = {
+    'time_sum': lambda stat, url_id: round(stat.sums[url_id] / 1000000, 3),
+    'time_avg': lambda stat, url_id: round(stat.sums[url_id] / 1000000 / stat.counts[url_id], 3),
+    'time_max': lambda stat, url_id: round(stat.maxs[url_id] / 1000000, 3),
+    'count': lambda stat, url_id: stat.counts[url_id],
+}
+
+# Правила нормализации url до агрегации: имя -> (re, замена).
+# Правило в url_normalize задается именем или парой [re, замена] и применяется в порядке списка.
+URL_NORMALIZE_RULES = {
+    'query': (r'\?.*', ''),
+    'numeric': (r'(?<=/)\d+(?=[/?]|$)', '{id}'),
+    'uuid': (r'(?<=/)[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?=[/?]|$)', '{uuid}'),
+}
+
+# Наибольший синтетический лог --benchmark-suite, строк: около 20 ГБ (строка LogGenerator - около 200 байт),
+# генерация и прогон этапов занимают часы. По умолчанию - 100000 и 1000000 строк (минуты).
+BENCHMARK_MAX_SIZE = 100000000
+
+# Интервал временного ряда url (time_series) -> длина интервала, секунды.
+TIME_SERIES_BUCKETS = {
+    'minute': 60,
+    'hour': 3600,
+}
+
+
+class ReportSink:
+    """Приемник отчета: рейтинги make_reports (ключ сортировки -> строки) пишутся в файл.
+
+    Строки сериализуются по одной прямо в файл, отчет целиком в памяти не собирается.
+    Файл записывается атомарно (Utils.open_atomic).
+    extension: расширение файла отчета
+    """
+
+    extension = ''
+    newline = None
+
+    def save(self, report_data: dict, file_path: str):
+        """Атомарно записывает отчет в file_path."""
+        with Utils.open_atomic(file_path, 'w', encoding='utf-8', newline=self.newline) as report_f:
+            self.write(report_f, report_data)
+
+    def write(self, report_f, report_data: dict):
+        """Записывает отчет в открытый текстовый файл."""
+        raise NotImplementedError
+
+    @staticmethod
+    def write_rows(report_f, rows: list):
+        """JSON массив rows по строке - тот же текст, что json.dumps(rows)."""
+        report_f.write('[')
+        for number, row in enumerate(rows):
+            if number:
+                report_f.write(', ')
+            report_f.write(json.dumps(row))
+        report_f.write(']')
+
+    @staticmethod
+    def flat_value(value):
+        """Значение поля строки для плоских форматов: вложенные (series) - текстом JSON."""
+        return json.dumps(value) if isinstance(value, (dict, list)) else value
+
+    @staticmethod
+    def ranked_rows(report_data: dict):
+        """Строки всех рейтингов: (ключ сортировки, место с 1, строка)."""
+        for sort_key, rows in report_data.items():
+            for rank, row in enumerate(rows, 1):
+                yield sort_key, rank, row
+
+
+class TemplateSink(ReportSink):
+    """HTML отчет по шаблону: шаблон делится по тегам, между частями пишутся рейтинги.
+
+    Первый рейтинг подставляется вместо replace_tag, каждый рейтинг - вместо replace_tag_<ключ>.
+    """
+
+    extension = '.html'
+
+    def __init__(self, template_path: str, replace_tag: str):
+        self.template_path = template_path
+        self.replace_tag = replace_tag
+
+    def write(self, report_f, report_data: dict):
+        with io.open(self.template_path, mode='r', encoding='utf-8') as template_f:
+            template = template_f.read()
+        tags = {'{}_{}'.format(self.replace_tag, sort_key): sort_key for sort_key in report_data}
+        tags[self.replace_tag] = next(iter(report_data))
+        # теги рейтингов длиннее replace_tag и начинаются с него - ищутся первыми
+        tag_re = re.compile('|'.join(re.escape(tag) for tag in sorted(tags, key=len, reverse=True)))
+
+        position = 0
+        for match in tag_re.finditer(template):
+            report_f.write(template[position:match.start()])
+            self.write_rows(report_f, report_data[tags[match.group()]])
+            position = match.end()
+        report_f.write(template[position:])
+
+
+class JsonSink(ReportSink):
+    """JSON объект {ключ сортировки: строки} - тот же текст, что json.dumps(report_data)."""
+
+    extension = '.json'
+
+    def write(self, report_f, report_data: dict):
+        report_f.write('{')
+        for number, (sort_key, rows) in enumerate(report_data.items()):
+            report_f.write('{}{}: '.format(', ' if number else '', json.dumps(sort_key)))
+            self.write_rows(report_f, rows)
+        report_f.write('}')
+
+
+class NdjsonSink(ReportSink):
+    """По JSON объекту на строку отчета: ranking, rank и поля строки."""
+
+    extension = '.ndjson'
+
+    def write(self, report_f, report_data: dict):
+        for sort_key, rank, row in self.ranked_rows(report_data):
+            report_f.write(json.dumps(dict(ranking=sort_key, rank=rank, **row)))
+            report_f.write('\n')
+
+
+class CsvSink(ReportSink):
+    """CSV: ranking, rank и поля строк отчета (по первой строке)."""
+
+    extension = '.csv'
+    newline = ''
+
+    def write(self, report_f, report_data: dict):
+        first_rows = next((rows for rows in report_data.values() if rows), [])
+        if not first_rows:
+            return
+        writer = csv.writer(report_f)
+        fields = list(first_rows[0])
+        writer.writerow(['ranking', 'rank'] + fields)
+        for sort_key, rank, row in self.ranked_rows(report_data):
+            writer.writerow([sort_key, rank] + [self.flat_value(row.get(field)) for field in fields])
+
+
+class SqliteSink(ReportSink):
+    """Таблица report в базе SQLite: ranking, rank и поля строк отчета.
+
+    Строки вставляются пачками по batch_size (executemany), база собирается
+    во временном файле и атомарно заменяет file_path.
+    """
+
+    extension = '.sqlite'
+    batch_size = 1000
+    column_types = ((bool, 'INTEGER'), (int, 'INTEGER'), (float, 'REAL'), (str, 'TEXT'))
+
+    def save(self, report_data: dict, file_path: str):
+        directory = os.path.dirname(os.path.abspath(file_path))
+        fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(file_path), dir=directory)
+        os.close(fd)
+        try:
+            connection = sqlite3.connect(temp_path)
+            try:
+                self.write(connection, report_data)
+                connection.commit()
+            finally:
+                connection.close()
+            os.replace(temp_path, file_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def column_type(self, value) -> str:
+        return next((column_type for value_type, column_type in self.column_types if isinstance(value, value_type)),
+                    'TEXT')
+
+    def write(self, connection, report_data: dict):
+        first_rows = next((rows for rows in report_data.values() if rows), [])
+        fields = list(first_rows[0]) if first_rows else ['url']
+        columns = ['ranking TEXT', 'rank INTEGER'] + ['"{}" {}'.format(field, self.column_type(first_rows[0][field])
+                                                                       if first_rows else 'TEXT') for field in fields]
+        connection.execute('DROP TABLE IF EXISTS report')
+        connection.execute('CREATE TABLE report ({})'.format(', '.join(columns)))
+        insert = 'INSERT INTO report VALUES ({})'.format(', '.join('?' * (len(fields) + 2)))
+        rows = ((sort_key, rank, *(self.flat_value(row.get(field)) for field in fields))
+                for sort_key, rank, row in self.ranked_rows(report_data))
+        for batch in iter(lambda: list(itertools.islice(rows, self.batch_size)), []):
+            connection.executemany(insert, batch)
+
+
+# Имя приемника отчета (report_sinks) -> класс ReportSink.
+REPORT_SINKS = {
+    'html': TemplateSink,
+    'json': JsonSink,
+    'ndjson': NdjsonSink,
+    'csv': CsvSink,
+    'sqlite': SqliteSink,
+}
+
+
+class LogFormatParser:
+    """Специализированный разборщик строк по директиве nginx log_format.
+
+    Формат делится на чередующиеся литералы и переменные. Для каждой
+    переменной до последней нужной генерируется поиск следующего литерала
+    (str.find), значение берется срезом - кавычки входят в литерал, поэтому
+    поиск "quote-aware". Если time_field - последняя переменная формата,
+    она берется от последнего вхождения предшествующего литерала (rfind).
+    Из $request извлекается только url.
+
+    Возвращает (url, request_time в мкс) или None, если строку разобрать не удалось.
+    binary: разбирать строки bytes, декодируется только url.
+    stamp_field: переменная метки времени (time_local) - ее значение без разбора
+    возвращается третьим элементом: (url, request_time, метка).
+
+    block_re: регулярное выражение по тому же формату, целиком разбирающее
+    строку (^...$ с re.M) - для поиска finditer сразу по блоку без деления
+    на строки. Группы url и time_field (и stamp_field) идут в порядке формата (time_first),
+    block_groups - номера групп url, time_field и stamp_field для match.group.
+    """
+
+    variable_re = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+
+    def __init__(self, log_format: str, url_field: str = 'request', time_field: str = 'request_time',
+                 binary: bool = False, stamp_field: str = None):
+        self.log_format = LOG_FORMATS.get(log_format, log_format)
+        self.url_field = url_field
+        self.time_field = time_field
+        self.binary = binary
+        self.stamp_field = stamp_field
+        self.source = self.generate()
+        namespace = {}
+        exec(compile(self.source, '<log_format>', 'exec'), namespace)  # noqa
+        self.parse = namespace['parse']
+        pattern = self.generate_pattern()
+        self.block_re = re.compile(pattern.encode('utf-8') if binary else pattern, re.MULTILINE)
+
+    def __reduce__(self):
+        """Сгенерированная функция не сериализуется - пересобираем по формату."""
+        return self.__class__, (self.log_format, self.url_field, self.time_field, self.binary, self.stamp_field)
+
+    def __call__(self, log_line):
+        return self.parse(log_line)
+
+    def tokenize(self):
+        """Делит формат на литералы и переменные: [literal, var, literal, ..., var, literal]."""
+        tokens, position = [], 0
+        for variable in self.variable_re.finditer(self.log_format):
+            tokens.append(self.log_format[position:variable.start()])
+            tokens.append(variable.group(1) or variable.group(2))
+            position = variable.end()
+        tokens.append(self.log_format[position:])
+        return tokens
+
+    def literal(self, text: str):
+        """Литерал в исходном коде разборщика."""
+        return repr(text.encode('utf-8') if self.binary else text)
+
+    def generate(self) -> str:
+        """Генерирует исходный код функции parse(line)."""
+        tokens = self.tokenize()
+        literals, variables = tokens[0::2], tokens[1::2]
+        for field in (self.url_field, self.time_field, self.stamp_field):
+            if field and field not in variables:
+                raise ValueError('Variable ${} not found in log_format'.format(field))
+
+        time_index = variables.index(self.time_field)
+        tail_time = time_index == len(variables) - 1 and literals[-1] == '' and literals[time_index]
+        last_forward = variables.index(self.url_field) if tail_time else max(variables.index(self.url_field),
+                                                                            time_index)
+        if self.stamp_field:
+            last_forward = max(last_forward, variables.index(self.stamp_field))
+        code = ['def parse(line):']
+        if literals[0]:
+            code += ['    if not line.startswith({}):'.format(self.literal(literals[0])),
+                     '        return None']
+        code.append('    pos = {}'.format(len(literals[0].encode('utf-8') if self.binary else literals[0])))
+
+        for index in range(last_forward + 1):
+            terminator = literals[index + 1]
+            if not terminator:
+                raise ValueError('Variables ${} and ${} are not separated'.format(
+                    variables[index], variables[index + 1] if index + 1 < len(variables) else ''))
+            size = len(terminator.encode('utf-8') if self.binary else terminator)
+            code += ['    end = line.find({}, pos)'.format(self.literal(terminator)),
+                     '    if end < 0:',
+                     '        return None']
+            if variables[index] == self.url_field:
+                code.append('    url_value = line[pos:end]')
+            elif variables[index] == self.time_field:
+                code.append('    time_value = line[pos:end]')
+            elif variables[index] == self.stamp_field:
+                code.append('    stamp_value = line[pos:end]')
+            code.append('    pos = end + {}'.format(size))
+
+        if tail_time:
+            code += ['    end = line.rfind({}, pos - 1)'.format(self.literal(literals[time_index])),
+                     '    if end < 0:',
+                     '        return None',
+                     '    time_value = line[end + {}:].strip()'.format(
+                         len(literals[time_index].encode('utf-8') if self.binary else literals[time_index]))]
+
+        if self.url_field == 'request':
+            code += ['    request = url_value.split({})'.format(self.literal(' ')),
+                     '    if len(request) != 3:',
+                     '        return None',
+                     '    url_value = request[1]']
+        if self.binary:
+            code.append("    url_value = url_value.decode('utf-8', 'replace')")
+        stamp = ', stamp_value' if self.stamp_field else ''
+        code += ['    if time_value == {}:'.format(self.literal('-')),
+                 '        return url_value, 0{}'.format(stamp),
+                 '    try:',
+                 '        return url_value, round(float(time_value) * 1000000){}'.format(stamp),
+                 '    except ValueError:',
+                 '        return None',
+                 '']
+        return '\n'.join(code)
+
+    def generate_pattern(self) -> str:
+        """Генерирует регулярное выражение строки лога.
+
+        Значение переменной - символы до первого символа следующего литерала,
+        переменные между url и последней переменной time_field пропускаются
+        одним [^\\n]* (аналог rfind в parse).
+        """
+        tokens = self.tokenize()
+        literals, variables = tokens[0::2], tokens[1::2]
+        url_index, time_index = variables.index(self.url_field), variables.index(self.time_field)
+        stamp_index = variables.index(self.stamp_field) if self.stamp_field else -1
+        self.time_first = time_index < url_index
+        captured = sorted(index for index in (url_index, time_index, stamp_index) if index >= 0)
+        self.block_groups = tuple(captured.index(index) + 1 for index in (url_index, time_index, stamp_index)
+                                  if index >= 0)
+        tail_time = time_index == len(variables) - 1 and literals[-1] == '' and literals[time_index]
+
+        parts = ['^', re.escape(literals[0])]
+        for index, variable in enumerate(variables):
+            if tail_time and index > max(url_index, stamp_index):
+                parts += [r'[^\n]*', re.escape(literals[time_index]), r'(\S*)']
+                break
+            terminator = literals[index + 1]
+            stop = re.escape(terminator[0]) if terminator else r'\s'
+            if index == url_index and self.url_field == 'request':
+                value = r'[^ {0}\n]+ ([^ {0}\n]+) [^ {0}\n]+'.format(stop)
+            elif index in (url_index, time_index, stamp_index):
+                value = r'([^{}\n]*)'.format(stop)
+            else:
+                value = r'[^{}\n]*'.format(stop)
+            parts += [value, re.escape(terminator)]
+        parts.append(r'\r?$')
+        return ''.join(parts)
+
+
+class JsonLineParser:
+    """Разборщик строк JSON лога (nginx log_format ... escape=json).
+
+    Строка не разбирается json.loads целиком: ключи url_field и time_field
+    ищутся в строке (str.find), берутся только их значения. Кавычки внутри
+    строк JSON экранируются, поэтому найденный "ключ": - всегда ключ.
+    Строки, в значениях которых есть экранирование (\\), разбираются json.loads.
+    Значение $request ("GET /url HTTP/1.1") сводится к url.
+
+    Возвращает (url, request_time в мкс) или None, как LogFormatParser.
+    binary: разбирать строки bytes, декодируется только url.
+    block_re: None - строки JSON не разбираются по блоку, только построчно.
+    """
+
+    block_re = None
+
+    def __init__(self, url_field: str = 'request', time_field: str = 'request_time', binary: bool = False):
+        self.url_field = url_field
+        self.time_field = time_field
+        self.binary = binary
+        self.log_format = 'json:{}:{}'.format(url_field, time_field)
+        self.parse = self.make_parse()
+
+    def __reduce__(self):
+        """Замыкание parse не сериализуется - пересобираем по ключам."""
+        return self.__class__, (self.url_field, self.time_field, self.binary)
+
+    def __call__(self, log_line):
+        return self.parse(log_line)
+
+    def make_parse(self):
+        """Функция parse(line) с константами разбора в замыкании."""
+        encode = (lambda text: text.encode('utf-8')) if self.binary else (lambda text: text)
+        url_key, time_key = encode('"{}":'.format(self.url_field)), encode('"{}":'.format(self.time_field))
+        url_size, time_size = len(url_key), len(time_key)
+        quote, backslash, space, dash, comma, brace = (encode(char) for char in ('"', '\\', ' ', '-', ',', '}'))
+        request_url = self.url_field == 'request'
+        binary = self.binary
+        parse_json = self.parse_json
+
+        def value(line, start):
+            """Значение, начинающееся с позиции start; None - нет конца, False - экранировано."""
+            if line.startswith(space, start):
+                start = len(line) - len(line[start:].lstrip())
+            if line.startswith(quote, start):
+                end = line.find(quote, start + 1)
+                if end < 0:
+                    return None
+                found = line[start + 1:end]
+                return False if backslash in found else found
+            end = line.find(comma, start)
+            if end < 0:
+                end = line.find(brace, start)
+                if end < 0:
+                    return None
+            return line[start:end].strip()
+
+        def parse(line):
+            # обычный случай - значения в кавычках сразу за ключом, остальные - через value
+            url_start = line.find(url_key)
+            if url_start < 0:
+                return None
+            url_start += url_size
+            if line.startswith(quote, url_start):
+                end = line.find(quote, url_start + 1)
+                url_value = line[url_start + 1:end] if end > 0 else None
+                if url_value and backslash in url_value:
+                    url_value = False
+            else:
+                url_value = value(line, url_start)
+
+            # ключ времени обычно после url - сначала ищем от url
+            start = line.find(time_key, url_start)
+            if start < 0:
+                start = line.find(time_key)
+                if start < 0:
+                    return None
+            start += time_size
+            if line.startswith(quote, start):
+                end = line.find(quote, start + 1)
+                time_value = line[start + 1:end] if end > 0 else None
+            else:
+                time_value = value(line, start)
+
+            if url_value is False or time_value is False:
+                return parse_json(line)
+            if url_value is None or time_value is None:
+                return None
+
+            if request_url:
+                request = url_value.split(space)
+                if len(request) != 3:
+                    return None
+                url_value = request[1]
+            if binary:
+                url_value = url_value.decode('utf-8', 'replace')
+            if time_value == dash:
+                return url_value, 0
+            try:
+                return url_value, round(float(time_value) * 1000000)
+            except ValueError:
+                return None
+
+        return parse
+
+    def parse_json(self, log_line):
+        """Разбор строки целиком json.loads - для значений с экранированием."""
+        try:
+            record = json.loads(log_line)
+            url_value, time_value = record[self.url_field], record[self.time_field]
+        except (ValueError, KeyError, TypeError):
+            return None
+        if not isinstance(url_value, str):
+            return None
+        if self.url_field == 'request':
+            request = url_value.split(' ')
+            if len(request) != 3:
+                return None
+            url_value = request[1]
+        if time_value == '-':
+            return url_value, 0
+        try:
+            return url_value, round(float(time_value) * 1000000)
+        except (ValueError, TypeError):
+            return None
+
+
+class TimeBuckets:
+    """Номер интервала времени строки лога: время $time_local (UTC, секунды) // bucket_seconds.
+
+    Метка времени выделяется без регулярных выражений: первое поле в [] (форматы nginx
+    с [$time_local]) или значение ключа time_local (time_iso8601) строки JSON.
+    В одну секунду лога приходит много строк с одной и той же меткой, поэтому номер
+    интервала кешируется по строке метки. Для новой секунды время считается арифметически:
+    начало минуты (кеш по метке без секунд) плюс секунды, разбор метки (parse_stamp) выполняется
+    раз на минуту лога. Кеши очищаются, когда в них больше cache_size меток.
+
+    Возвращает номер интервала или None, если метки нет или она не разбирается.
+    Разборщик строки (make_bucket с parse_line) для разобранной строки без метки
+    возвращает интервал NO_BUCKET: запрос учитывается в отчете, но не во временном ряду.
+    binary: разбирать строки bytes
+    json_lines: строки JSON (log_format ... escape=json)
+    """
+
+    MONTHS = {name: number for number, name in enumerate(
+        ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+    EPOCH = datetime.datetime(1970, 1, 1)
+    # логов до 1970 года не бывает, номера интервалов не отрицательные
+    NO_BUCKET = -1
+    cache_size = 100000
+
+    def __init__(self, bucket_seconds: int, binary: bool = False, json_lines: bool = False):
+        self.bucket_seconds = bucket_seconds
+        self.binary = binary
+        self.json_lines = json_lines
+        self.cache = {}
+        self.minutes = {}
+        self.bucket = self.make_bucket()
+
+    def __reduce__(self):
+        """Замыкание bucket не сериализуется - пересобираем по параметрам (кеши - пустые)."""
+        return self.__class__, (self.bucket_seconds, self.binary, self.json_lines)
+
+    def __call__(self, log_line):
+        return self.bucket(log_line)
+
+    @classmethod
+    def parse_stamp(cls, stamp: str):
+        """Время UTC в секундах по метке $time_local (29/Jun/2017:03:50:22 +0300)
+        или $time_iso8601 (2017-06-29T03:50:22+03:00); None - метка не разбирается.
+
+        Название месяца $time_local всегда английское, поэтому strptime (%b зависит от локали) не нужен.
+        """
+        try:
+            if stamp[4:5] == '-':
+                year, month, day = int(stamp[0:4]), int(stamp[5:7]), int(stamp[8:10])
+                clock, zone = stamp[11:19], stamp[19:].replace(':', '')
+            else:
+                day, month, year = int(stamp[0:2]), cls.MONTHS[stamp[3:6]], int(stamp[7:11])
+                clock, zone = stamp[12:20], stamp[21:]
+            moment = datetime.datetime(year, month, day, int(clock[0:2]), int(clock[3:5]), int(clock[6:8]))
+            offset = 0 if zone in ('', 'Z') else (int(zone[1:3]) * 3600 + int(zone[3:5]) * 60) * int(zone[0] + '1')
+        except (KeyError, ValueError):
+            return None
+        return (moment - cls.EPOCH) // datetime.timedelta(seconds=1) - offset
+
+    @staticmethod
+    def split_stamp(stamp):
+        """Метка без секунд и секунды метки (str или bytes)."""
+        position = 17 if stamp[4:5] in ('-', b'-') else 18
+        return stamp[:position] + stamp[position + 2:], stamp[position:position + 2]
+
+    def stamp_bucket(self, stamp):
+        """Номер интервала метки stamp, которой нет в кеше, с записью в кеш."""
+        cache, minutes = self.cache, self.minutes
+        if len(cache) >= self.cache_size:
+            cache.clear()
+            minutes.clear()
+        minute_stamp, second = self.split_stamp(stamp)
+        minute = minutes.get(minute_stamp)
+        if minute is None and minute_stamp not in minutes:
+            seconds = self.parse_stamp(stamp.decode('ascii', 'replace') if self.binary else stamp)
+            minute = minutes[minute_stamp] = None if seconds is None else seconds - int(second)
+        try:
+            line_bucket = (minute + int(second)) // self.bucket_seconds
+        except (TypeError, ValueError):
+            line_bucket = None
+        cache[stamp] = line_bucket
+        return line_bucket
+
+    def make_bucket(self, parse_line=None):
+        """Функция bucket(line) с кешем меток в замыкании.
+
+        parse_line: разборщик строки (url, мкс) - тогда возвращается функция разбора строки
+        (url, мкс, номер интервала или NO_BUCKET) или None, метка ищется в строке только после ее разбора.
+        """
+        encode = (lambda text: text.encode('ascii')) if self.binary else (lambda text: text)
+        cache, stamp_bucket, no_bucket = self.cache, self.stamp_bucket, self.NO_BUCKET
+
+        if self.json_lines:
+            keys, quote = (encode('"time_local":'), encode('"time_iso8601":')), encode('"')
+
+            def bucket(line):
+                for key in keys:
+                    start = line.find(key)
+                    if start >= 0:
+                        start = line.find(quote, start + len(key)) + 1
+                        end = line.find(quote, start)
+                        if not start or end < 0:
+                            return None
+                        stamp = line[start:end]
+                        try:
+                            return cache[stamp]
+                        except KeyError:
+                            return stamp_bucket(stamp)
+                return None
+        else:
+            # $time_local всегда одной длины - конец метки не ищется
+            opening, width = encode('['), len('29/Jun/2017:03:50:22 +0300')
+
+            def bucket(line):
+                start = line.find(opening) + 1
+                if not start:
+                    return None
+                stamp = line[start:start + width]
+                try:
+                    return cache[stamp]
+                except KeyError:
+                    return stamp_bucket(stamp)
+
+        if parse_line is None:
+            return bucket
+
+        if self.json_lines:
+            def parse_series(line):
+                parsed_line = parse_line(line)
+                if parsed_line:
+                    line_bucket = bucket(line)
+                    return parsed_line[0], parsed_line[1], no_bucket if line_bucket is None else line_bucket
+            return parse_series
+
+        def parse_series(line):
+            # bucket встроен - на строку одним вызовом меньше
+            parsed_line = parse_line(line)
+            if parsed_line:
+                line_bucket = None
+                start = line.find(opening) + 1
+                if start:
+                    stamp = line[start:start + width]
+                    try:
+                        line_bucket = cache[stamp]
+                    except KeyError:
+                        line_bucket = stamp_bucket(stamp)
+                return parsed_line[0], parsed_line[1], no_bucket if line_bucket is None else line_bucket
+        return parse_series
+
+
+class Benchmark:
+    """Встроенные микро-бенчмарки горячих участков Analyzer.
+
+    Результаты - строк в секунду, лучший из repeat прогонов.
+    suite - бенчмарк этапов STAGES на синтетических логах разного размера
+    со сравнением с сохраненным baseline.
+    """
+
+    STAGES = ('read_file_gen', 'parse_line', 'aggregate', 'make_report', 'end_to_end')
+
+    def __init__(self, analyzer, repeat: int = 5):
+        self.analyzer = analyzer
+        self.repeat = repeat
+
+    def lines_per_sec(self, func, lines) -> float:
+        """Лучшая скорость обработки lines функцией func, строк/сек."""
+        best = float('inf')
+        for __ in range(self.repeat):
+            started = time.perf_counter()
+            for line in lines:
+                func(line)
+            best = min(best, time.perf_counter() - started)
+        return len(lines) / best if best else float('inf')
+
+    def parsers(self, file_name: str) -> dict:
+        """Сравнивает regex web_server_log_pattern и разборщик log_format."""
+        analyzer = self.analyzer
+        lines = list(analyzer.read_file_gen(file_name))
+        results = {'regex': self.lines_per_sec(analyzer.parse_line_re, lines)}
+        if analyzer.log_format_parser:
+            results['log_format'] = self.lines_per_sec(analyzer.log_format_parser, lines)
+            results['parse_line'] = self.lines_per_sec(analyzer.parse_line, lines)
+        return results
+
+    def throughput(self, file_name: str, read_mode: str, backend: str = None) -> float:
+        """Лучшая скорость чтения и агрегации файла в режиме read_mode, строк/сек."""
+        analyzer = self.analyzer
+        default_mode, analyzer.read_mode = analyzer.read_mode, read_mode
+        default_backend, analyzer.decompress_backend = analyzer.decompress_backend, backend or analyzer.decompress_backend
+        best, total_count = float('inf'), 0
+        try:
+            for __ in range(self.repeat):
+                started = time.perf_counter()
+                total_count = analyzer.parse_range(file_name).total_count
+                best = min(best, time.perf_counter() - started)
+        finally:
+            analyzer.read_mode, analyzer.decompress_backend = default_mode, default_backend
+        return total_count / best if best else float('inf')
+
+    def decompressors(self, file_name: str) -> dict:
+        """Сравнивает способы распаковки gzip в текущем режиме чтения."""
+        backends = ['gzip', 'thread'] + (['pipe'] if self.analyzer.decompress_command() else [])
+        return {backend: self.throughput(file_name, self.analyzer.read_mode, backend) for backend in backends}
+
+    def readers(self, file_name: str) -> dict:
+        """Сравнивает режимы чтения text и bytes на gzip и несжатом файле.
+
+        Недостающий вариант файла создается во временном каталоге.
+        """
+        results = {}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            if file_name.endswith('.gz'):
+                gz_file, plain_file = file_name, os.path.join(temp_dir, 'log')
+                with gzip.open(gz_file, 'rb') as src, open(plain_file, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+            else:
+                gz_file, plain_file = os.path.join(temp_dir, 'log.gz'), file_name
+                with open(plain_file, 'rb') as src, gzip.open(gz_file, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+
+            for file_type, path in (('gz', gz_file), ('plain', plain_file)):
+                for read_mode in ('text', 'bytes'):
+                    results['{} {}'.format(file_type, read_mode)] = self.throughput(path, read_mode)
+        return results
+
+    @staticmethod
+    def run_stage(analyzer, stage: str, file_name: str, sample_lines: int = 100000) -> dict:
+        """Выполняет этап stage на файле file_name, возвращает строки, секунды и пиковый RSS.
+
+        Запускается в отдельном процессе, чтобы пиковая память относилась только к этапу.
+        Время подготовки (разбор перед make_report) в секунды этапа не входит.
+        end_to_end запускает копию analyzer с каталогами во временном каталоге, analyzer не изменяется.
+        """
+        lines, seconds = 0, 0.0
+        if stage == 'read_file_gen':
+            started = time.perf_counter()
+            for __ in analyzer.read_file_gen(file_name, analyzer.decompress_backend):
+                lines += 1
+            seconds = time.perf_counter() - started
+        elif stage == 'parse_line':
+            # строки читаются пачками вне замера, замеряется только разбор
+            line_gen = analyzer.read_file_gen(file_name, analyzer.decompress_backend)
+            parse_line = analyzer.parse_line
+            for chunk in iter(lambda: list(itertools.islice(line_gen, sample_lines)), []):
+                started = time.perf_counter()
+                for line in chunk:
+                    parse_line(line)
+                seconds += time.perf_counter() - started
+                lines += len(chunk)
+        elif stage == 'aggregate':
+            started = time.perf_counter()
+            lines = analyzer.parse_log(file_name).total_count
+            seconds = time.perf_counter() - started
+        elif stage == 'make_report':
+            stat = analyzer.parse_log(file_name)
+            started = time.perf_counter()
+            analyzer.make_reports(stat)
+            seconds = time.perf_counter() - started
+            lines = stat.total_count
+        elif stage == 'end_to_end':
+            analyzer = copy.copy(analyzer)
+            with tempfile.TemporaryDirectory() as temp_dir:
+                log_name = 'nginx-access-ui.log-{}'.format(analyzer.date_to_str(datetime.date.today(),
+                                                                                 analyzer.date_fmt))
+                os.symlink(os.path.abspath(file_name), os.path.join(temp_dir, log_name))
+                analyzer.log_dir = analyzer.report_dir = temp_dir
+                analyzer.nginx_log_name_re = re.escape(log_name)
+                analyzer.log_catalog_path = ''
+                analyzer.incremental = False
+                started = time.perf_counter()
+                analyzer.start()
+                seconds = time.perf_counter() - started
+            lines = sum(1 for __ in analyzer.read_file_gen(file_name))
+        else:
+            raise ValueError('Unknown benchmark stage {}'.format(stage))
+
+        return {'lines_per_sec': lines / seconds if seconds else float('inf'),
+                'seconds': seconds, 'peak_rss_kb': Utils.peak_rss()}
+
+    def suite(self, sizes: list, work_dir: str, baseline_path: str = '', tolerance: float = 0.2) -> dict:
+        """Бенчмарк этапов STAGES на синтетических логах размером sizes строк.
+
+        Логи генерируются LogGenerator в work_dir (повторно используются).
+        Каждый этап выполняется в отдельном процессе (spawn). Если baseline_path
+        задан и существует - результаты сравниваются с ним и при регрессии
+        больше tolerance (скорость ниже или память выше) выбрасывается AssertionError,
+        если не существует - результаты сохраняются как baseline.
+        """
+        results = {}
+        context = multiprocessing.get_context('spawn')
+        for size in sizes:
+            log_file = LogGenerator().generate(os.path.join(work_dir, 'bench-{}.log'.format(size)), size)
+            results[str(size)] = {}
+            for stage in self.STAGES:
+                with context.Pool(1) as pool:
+                    result = pool.apply(self.run_stage, (self.analyzer, stage, log_file))
+                results[str(size)][stage] = result
+                self.analyzer.root_logger.info('Benchmark {} lines {}: {:.0f} lines/sec, {:.3f} sec, '
+                                               'peak RSS {} KB'.format(size, stage, result['lines_per_sec'],
+                                                                       result['seconds'], result['peak_rss_kb']))
+
+        if baseline_path and os.path.exists(baseline_path):
+            with open(baseline_path) as baseline_f:
+                regressions = self.regressions(results, json.load(baseline_f), tolerance)
+            if regressions:
+                raise AssertionError('Benchmark regression: {}'.format('; '.join(regressions)))
+        elif baseline_path:
+            self.save_baseline(baseline_path, results)
+            self.analyzer.root_logger.info('Benchmark baseline saved: {}'.format(baseline_path))
+        return results
+
+    @staticmethod
+    def save_baseline(baseline_path: str, results: dict):
+        """Сохраняет результаты как baseline."""
+        Utils.save_atomic(baseline_path, json.dumps(results, sort_keys=True, indent=2).encode('utf-8'))
+
+    @staticmethod
+    def regressions(results: dict, baseline: dict, tolerance: float) -> list:
+        """Описания регрессий results относительно baseline (размеры и этапы, которые есть в обоих)."""
+        regressions = []
+        for size, stages in results.items():
+            for stage, result in stages.items():
+                base = baseline.get(size, {}).get(stage)
+                if not base:
+                    continue
+                if result['lines_per_sec'] < base['lines_per_sec'] * (1 - tolerance):
+                    regressions.append('{} lines {}: {:.0f} lines/sec < {:.0f}'.format(
+                        size, stage, result['lines_per_sec'], base['lines_per_sec']))
+                if result['peak_rss_kb'] and base.get('peak_rss_kb') and \
+                        result['peak_rss_kb'] > base['peak_rss_kb'] * (1 + tolerance):
+                    regressions.append('{} lines {}: peak RSS {} KB > {} KB'.format(
+                        size, stage, result['peak_rss_kb'], base['peak_rss_kb']))
+        return regressions
+
+    def run(self, file_name: str) -> dict:
+        """Запускает бенчмарки и выводит результаты в лог."""
+        results = {'parsers': self.parsers(file_name), 'readers': self.readers(file_name)}
+        if file_name.endswith('.gz'):
+            results['decompressors'] = self.decompressors(file_name)
+        for group, group_results in results.items():
+            for name, value in group_results.items():
+                self.analyzer.root_logger.info('Benchmark {} {}: {:.0f} lines/sec'.format(group, name, value))
+        return results
+
+
+class LogGenerator:
+    """Генератор синтетического лога nginx в формате ui_short (web_server_log_pattern по умолчанию).
+
+    url распределены по Zipf (url с рангом k встречается с весом 1 / k ** zipf_s),
+    время обработки - логнормальное; доля dash_share строк содержит '-' вместо
+    времени обработки, доля malformed_share строк обрезана (не разбирается).
+    """
+
+    line_fmt = ('{ip} -  - [{time_local}] "GET {url} HTTP/1.1" 200 {size} "-" "Lynx/2.8.8dev.9 libwww-FM/2.14" '
+                '"-" "1498697422-2190034393-4708-{line}" "dc7161be3" {request_time}\n')
+
+    def __init__(self, urls: int = 10000, zipf_s: float = 1.1, dash_share: float = 0.01,
+                 malformed_share: float = 0.001, seed: int = 42):
+        self.urls = ['/api/v2/banner/{}'.format(url_id) if url_id % 3 else '/api/1/campaigns/?id={}'.format(url_id)
+                     for url_id in range(urls)]
+        self.cum_weights = list(itertools.accumulate(1 / rank ** zipf_s for rank in range(1, urls + 1)))
+        self.dash_share = dash_share
+        self.malformed_share = malformed_share
+        self.seed = seed
+
+    def lines_gen(self, lines: int, chunk_size: int = 10000):
+        """Строки лога: lines строк за сутки 30.06.2017."""
+        rnd = random.Random(self.seed)
+        started = datetime.datetime(2017, 6, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=3)))
+        step = 86400 / max(lines, 1)
+        time_local, time_second = '', -1
+
+        for chunk_start in range(0, lines, chunk_size):
+            chunk = min(chunk_size, lines - chunk_start)
+            for line_no, url in enumerate(rnd.choices(self.urls, cum_weights=self.cum_weights, k=chunk),
+                                          chunk_start):
+                second = int(line_no * step)
+                if second != time_second:
+                    time_second = second
+                    time_local = (started + datetime.timedelta(seconds=second)).strftime('%d/%b/%Y:%H:%M:%S %z')
+                share = rnd.random()
+                request_time = '-' if share < self.dash_share else '{:.3f}'.format(rnd.lognormvariate(-2, 1))
+                line = self.line_fmt.format(ip='1.196.{}.{}'.format(line_no % 256, line_no // 256 % 256),
+                                            time_local=time_local, url=url, size=line_no % 20000,
+                                            line=line_no, request_time=request_time)
+                if share > 1 - self.malformed_share:
+                    line = line[:len(line) // 3] + '\n'
+                yield line
+
+    def generate(self, file_name: str, lines: int) -> str:
+        """Создает лог file_name из lines строк (.gz - сжатый), существующий файл не перезаписывается."""
+        if os.path.exists(file_name):
+            return file_name
+        opener = gzip.open if file_name.endswith('.gz') else open
+        temp_name = file_name + '.tmp'
+        with opener(temp_name, 'wt', encoding='utf-8') as log_f:
+            log_f.writelines(self.lines_gen(lines))
+        os.replace(temp_name, file_name)
+        return file_name
+
+
+class QuantileSketch:
+    """Потоковая оценка квантилей на логарифмических корзинах.
+
+    Значение x попадает в корзину k = ceil(log(x) / log(gamma)),
+    gamma = (1 + accuracy) / (1 - accuracy). Оценка квантиля - середина
+    корзины, поэтому относительная ошибка не превышает accuracy.
+    Значения - время в микросекундах; меньше min_value (1 мс) попадают
+    в нулевую корзину и оцениваются как 0 (абсолютная ошибка меньше min_value).
+    Число корзин ограничено max_buckets: при переполнении младшие корзины
+    сливаются, точность теряется только на нижних квантилях.
+
+    Интерфейс append/extend совместим со списком времен, поэтому скетч
+    используется в LogStat вместо списка без изменения цикла разбора.
+    count, sum, max считаются точно.
+    """
+
+    def __init__(self, accuracy: float = 0.01, min_value: int = 1000, max_buckets: int = 2048):
+        assert (0 < accuracy < 1)
+        self.accuracy = accuracy
+        self.min_value = min_value
+        self.max_buckets = max_buckets
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value: float):
+        """Добавляет значение в скетч."""
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+        if value < self.min_value:
+            self.zero_count += 1
+            return
+
+        key = math.ceil(math.log(value) / self._log_gamma)
+        buckets = self.buckets
+        if key in buckets:
+            buckets[key] += 1
+        else:
+            buckets[key] = 1
+            if len(buckets) > self.max_buckets:
+                self._collapse()
+
+    def extend(self, other):
+        """Сливает скетч other (с той же точностью) в текущий."""
+        assert (isinstance(other, QuantileSketch) and other.gamma == self.gamma)
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+        self.zero_count += other.zero_count
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def _collapse(self):
+        """Сливает младшие корзины, пока их число не уложится в max_buckets."""
+        keys = sorted(self.buckets)
+        overflow = len(keys) - self.max_buckets
+        target = keys[overflow]
+        for key in keys[:overflow]:
+            self.buckets[target] += self.buckets.pop(key)
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля q (0 <= q <= 1).
+
+        Ранг выбирается так же, как в Analyzer.median: элемент int(count * q)
+        отсортированной выборки.
+        """
+        if not self.count:
+            return 0
+        rank = min(int(self.count * q), self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                return min(2 * self.gamma ** key / (self.gamma + 1), self.max)
+        return self.max
+
+    def sum_squares(self) -> float:
+        """Оценка суммы квадратов значений по серединам корзин (нулевая корзина - по min_value / 2)."""
+        total = self.zero_count * (self.min_value / 2) ** 2
+        for key, count in self.buckets.items():
+            total += count * min(2 * self.gamma ** key / (self.gamma + 1), self.max) ** 2
+        return total
+
+    def to_dict(self) -> dict:
+        """Состояние скетча для JSON (корзины - списком [ключ, количество])."""
+        return {'accuracy': self.accuracy, 'min_value': self.min_value, 'max_buckets': self.max_buckets,
+                'buckets': sorted(self.buckets.items()), 'zero_count': self.zero_count,
+                'count': self.count, 'sum': self.sum, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """Скетч из состояния to_dict."""
+        sketch = cls(data['accuracy'], data['min_value'], data['max_buckets'])
+        sketch.buckets = {key: count for key, count in data['buckets']}
+        sketch.zero_count, sketch.count, sketch.sum, sketch.max = (data['zero_count'], data['count'],
+                                                                   data['sum'], data['max'])
+        return sketch
+
+
+class LogStat:
+    """Частичный агрегат разбора лога.
+
+    url хранятся один раз и заменяются целочисленным id (интернирование),
+    время обработки хранится в микросекундах в компактных array-буферах.
+    count, sum и max по url накапливаются по ходу разбора.
+    Агрегаты, собранные по разным частям файла, объединяются через merge
+    в порядке следования частей - так выборки времен по url совпадают
+    с выборками однопроцессного разбора.
+
+    total_count: количество прочитанных строк
+    matched_count: количество разобранных строк
+    mismatch_count: количество строк, не подошедших под паттерн
+    total_time: суммарное время обработки разобранных запросов, мкс
+    url_ids: url -> id
+    urls: url по id
+    counts, sums, maxs: количество, сумма и максимум времени по id, мкс
+    samples: выборка времен по id - array (точный режим)
+             или QuantileSketch (приближенный режим, accuracy задана).
+             Выборка хранится в 4-байтном array('i') и расширяется до array('l'),
+             только если время не помещается в int32 (больше ~35 минут).
+    series: временной ряд по id (None - не собирается): array('i') номеров интервалов TimeBuckets
+            параллельно выборке samples (точный режим) или {номер интервала: QuantileSketch}
+            (приближенный режим). Агрегаты с рядом и без него при merge дают агрегат без ряда.
+    """
+
+    def __init__(self, accuracy: float = None, series: bool = False):
+        self.accuracy = accuracy
+        self.total_count = 0
+        self.matched_count = 0
+        self.mismatch_count = 0
+        self.total_time = 0
+        self.url_ids = {}
+        self.urls = []
+        self.counts = array.array('l')
+        self.sums = array.array('q')
+        self.maxs = array.array('l')
+        self.samples = []
+        self.series = [] if series else None
+
+    def __len__(self):
+        return len(self.urls)
+
+    def new_series(self):
+        """Пустой временной ряд url."""
+        return {} if self.accuracy else array.array('i')
+
+    def url_id(self, url: str) -> int:
+        """Возвращает id url, при необходимости регистрируя его."""
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            url_id = self.url_ids[url] = len(self.urls)
+            self.urls.append(url)
+            self.counts.append(0)
+            self.sums.append(0)
+            self.maxs.append(0)
+            self.samples.append(QuantileSketch(self.accuracy) if self.accuracy else array.array('i'))
+            if self.series is not None:
+                self.series.append(self.new_series())
+        return url_id
+
+    def widen(self, url_id: int):
+        """Переводит выборку url_id в array('l') и возвращает ее."""
+        samples = self.samples[url_id]
+        if isinstance(samples, array.array) and samples.typecode != 'l':
+            samples = self.samples[url_id] = array.array('l', samples)
+        return samples
+
+    def add_series(self, url_id: int, bucket: int, request_time: int):
+        """Учитывает запрос url_id в интервале bucket временного ряда.
+
+        Точный ряд параллелен выборке, поэтому TimeBuckets.NO_BUCKET в нем хранится, в скетчи не попадает.
+        """
+        series = self.series[url_id]
+        if isinstance(series, dict):
+            if bucket == TimeBuckets.NO_BUCKET:
+                return
+            sketch = series.get(bucket)
+            if sketch is None:
+                sketch = series[bucket] = QuantileSketch(self.accuracy)
+            sketch.append(request_time)
+        else:
+            series.append(bucket)
+
+    def merge_series(self, series, other_series):
+        """Добавляет к временному ряду series ряд other_series (скетчи other_series не изменяются)."""
+        if isinstance(series, dict):
+            for bucket, other_sketch in other_series.items():
+                sketch = series.get(bucket)
+                if sketch is None:
+                    sketch = series[bucket] = QuantileSketch(self.accuracy)
+                sketch.extend(other_sketch)
+        else:
+            series.extend(other_series)
+
+    def add(self, url: str, request_time: int, bucket: int = None):
+        """Учитывает один запрос url со временем обработки request_time, мкс (bucket - интервал ряда)."""
+        url_id = self.url_id(url)
+        if self.series is not None:
+            self.add_series(url_id, bucket, request_time)
+        try:
+            self.samples[url_id].append(request_time)
+        except OverflowError:
+            self.widen(url_id).append(request_time)
+        self.counts[url_id] += 1
+        self.sums[url_id] += request_time
+        if request_time > self.maxs[url_id]:
+            self.maxs[url_id] = request_time
+        self.matched_count += 1
+        self.total_time += request_time
+
+    def merge(self, other):
+        """Добавляет к агрегату статистику other."""
+        self.total_count += other.total_count
+        self.matched_count += other.matched_count
+        self.mismatch_count += other.mismatch_count
+        self.total_time += other.total_time
+        if other.series is None:
+            self.series = None
+        for other_id, url in enumerate(other.urls):
+            url_id = self.url_id(url)
+            if self.series is not None:
+                self.merge_series(self.series[url_id], other.series[other_id])
+            other_samples = other.samples[other_id]
+            if isinstance(other_samples, array.array) and other_samples.typecode != self.samples[url_id].typecode:
+                other_samples = other.widen(other_id)
+                self.widen(url_id)
+            self.samples[url_id].extend(other_samples)
+            self.counts[url_id] += other.counts[other_id]
+            self.sums[url_id] += other.sums[other_id]
+            if other.maxs[other_id] > self.maxs[url_id]:
+                self.maxs[url_id] = other.maxs[other_id]
+        return self
+
+    @staticmethod
+    def array_to_json(values: array.array) -> dict:
+        """array для JSON: typecode, размер элемента и байты в base64 (порядок байт платформы)."""
+        return {'typecode': values.typecode, 'itemsize': values.itemsize,
+                'data': base64.b64encode(values.tobytes()).decode('ascii')}
+
+    @staticmethod
+    def array_from_json(data: dict) -> array.array:
+        """array из array_to_json, ValueError - другой размер элемента typecode на этой платформе."""
+        values = array.array(data['typecode'])
+        if values.itemsize != data['itemsize']:
+            raise ValueError('array {} item size {} != {}'.format(data['typecode'], data['itemsize'],
+                                                                  values.itemsize))
+        values.frombytes(base64.b64decode(data['data']))
+        return values
+
+    def to_dict(self) -> dict:
+        """Состояние агрегата для JSON (checkpoint): array - array_to_json, QuantileSketch - to_dict,
+        ряд приближенного режима - списком [номер интервала, скетч].
+        """
+        def samples_json(samples):
+            return self.array_to_json(samples) if isinstance(samples, array.array) else samples.to_dict()
+
+        def series_json(series):
+            if isinstance(series, array.array):
+                return self.array_to_json(series)
+            return [[bucket, sketch.to_dict()] for bucket, sketch in sorted(series.items())]
+
+        return {'accuracy': self.accuracy, 'total_count': self.total_count, 'matched_count': self.matched_count,
+                'mismatch_count': self.mismatch_count, 'total_time': self.total_time, 'urls': self.urls,
+                'counts': self.array_to_json(self.counts), 'sums': self.array_to_json(self.sums),
+                'maxs': self.array_to_json(self.maxs), 'samples': [samples_json(samples) for samples in self.samples],
+                'series': None if self.series is None else [series_json(series) for series in self.series]}
+
+    @staticmethod
+    def from_dict(data: dict):
+        """Агрегат из состояния to_dict: HeavyHitterStat, если в нем есть capacity, иначе LogStat."""
+        def samples_from_json(samples):
+            return LogStat.array_from_json(samples) if 'typecode' in samples else QuantileSketch.from_dict(samples)
+
+        def series_from_json(series):
+            if isinstance(series, dict):
+                return LogStat.array_from_json(series)
+            return {bucket: QuantileSketch.from_dict(sketch) for bucket, sketch in series}
+
+        if 'capacity' in data:
+            stat = HeavyHitterStat(data['capacity'], data['key'], data['accuracy'], data['series'] is not None)
+        else:
+            stat = LogStat(data['accuracy'], data['series'] is not None)
+        stat.total_count, stat.matched_count = data['total_count'], data['matched_count']
+        stat.mismatch_count, stat.total_time = data['mismatch_count'], data['total_time']
+        stat.urls = data['urls']
+        stat.url_ids = {url: url_id for url_id, url in enumerate(stat.urls)}
+        stat.counts, stat.sums = LogStat.array_from_json(data['counts']), LogStat.array_from_json(data['sums'])
+        stat.maxs = LogStat.array_from_json(data['maxs'])
+        stat.samples = [samples_from_json(samples) for samples in data['samples']]
+        if stat.series is not None:
+            stat.series = [series_from_json(series) for series in data['series']]
+        if isinstance(stat, HeavyHitterStat):
+            stat.errors = LogStat.array_from_json(data['errors'])
+            stat.heap = [(stat.weight(url_id), url_id) for url_id in range(len(stat.urls))]
+            heapq.heapify(stat.heap)
+        return stat
+
+
+class HeavyHitterStat(LogStat):
+    """LogStat с ограниченным числом url (heavy hitters, алгоритм Space-Saving).
+
+    Отслеживается не больше capacity url. Новый url при заполнении вытесняет url
+    с наименьшей оценкой веса (time_sum или count, см. key) и наследует эту оценку
+    как погрешность errors. Оценка веса url (sums или counts плюс errors) не меньше
+    истинного веса и превышает его не больше чем на errors <= общий вес / capacity,
+    поэтому любой url тяжелее общий вес / capacity гарантированно остается в агрегате.
+    count, sum, max и выборка вытесненного url начинаются заново - это точные значения
+    с момента, когда url занял место; url с нулевой погрешностью учтены полностью.
+    Память не зависит от числа разных url в логе, выборки - только QuantileSketch.
+
+    capacity: максимальное число отслеживаемых url
+    key: вес url: time_sum (мкс) или count (запросов)
+    errors: погрешность оценки веса по id, в единицах key
+    heap: (оценка веса, id) - куча для поиска наименьшей оценки; оценки в ней могут
+          быть устаревшими (только меньше текущих), устаревшая запись обновляется при извлечении
+    """
+
+    keys = ('time_sum', 'count')
+
+    def __init__(self, capacity: int, key: str = 'time_sum', accuracy: float = None, series: bool = False):
+        assert (key in self.keys)
+        super().__init__(accuracy or 0.01, series)
+        self.capacity = capacity
+        self.key = key
+        self.errors = array.array('q')
+        self.heap = []
+
+    def weight(self, url_id: int) -> int:
+        """Оценка веса url сверху."""
+        weights = self.sums if self.key == 'time_sum' else self.counts
+        return weights[url_id] + self.errors[url_id]
+
+    def min_weight(self) -> int:
+        """Наименьшая оценка веса отслеживаемых url (0, пока агрегат не заполнен)."""
+        if len(self.urls) < self.capacity:
+            return 0
+        heap = self.heap
+        while heap[0][0] != self.weight(heap[0][1]):
+            heapq.heapreplace(heap, (self.weight(heap[0][1]), heap[0][1]))
+        return heap[0][0]
+
+    def url_id(self, url: str) -> int:
+        """Возвращает id url; при заполнении url занимает место url с наименьшей оценкой веса."""
+        url_id = self.url_ids.get(url)
+        if url_id is not None:
+            return url_id
+        if len(self.urls) < self.capacity:
+            url_id = super().url_id(url)
+            self.errors.append(0)
+            heapq.heappush(self.heap, (0, url_id))
+            return url_id
+
+        error = self.min_weight()
+        url_id = self.heap[0][1]
+        del self.url_ids[self.urls[url_id]]
+        self.url_ids[url] = url_id
+        self.urls[url_id] = url
+        self.counts[url_id] = self.sums[url_id] = self.maxs[url_id] = 0
+        self.samples[url_id] = QuantileSketch(self.accuracy)
+        if self.series is not None:
+            self.series[url_id] = self.new_series()
+        self.errors[url_id] = error
+        heapq.heapreplace(self.heap, (error, url_id))
+        return url_id
+
+    def merge(self, other):
+        """Добавляет к агрегату статистику other (слияние сводок Space-Saving).
+
+        Если url нет в одной из сводок, его вес в ней не больше ее наименьшей оценки -
+        она добавляется к погрешности. Из объединения остаются capacity url
+        с наибольшими оценками в порядке первого появления.
+        """
+        self.total_count += other.total_count
+        self.matched_count += other.matched_count
+        self.mismatch_count += other.mismatch_count
+        self.total_time += other.total_time
+        self_min, other_min = self.min_weight(), other.min_weight()
+        if other.series is None:
+            self.series = None
+
+        entries = {}
+        for url_id, url in enumerate(self.urls):
+            error = self.errors[url_id] + (0 if url in other.url_ids else other_min)
+            series = None if self.series is None else self.series[url_id]
+            entries[url] = [self.counts[url_id], self.sums[url_id], self.maxs[url_id], self.samples[url_id], error,
+                            series]
+        for other_id, url in enumerate(other.urls):
+            entry = entries.get(url)
+            if entry is None:
+                series = None if self.series is None else self.new_series()
+                entry = entries[url] = [0, 0, 0, QuantileSketch(self.accuracy), self_min, series]
+            entry[0] += other.counts[other_id]
+            entry[1] += other.sums[other_id]
+            entry[2] = max(entry[2], other.maxs[other_id])
+            entry[3].extend(other.samples[other_id])
+            entry[4] += other.errors[other_id]
+            if entry[5] is not None:
+                self.merge_series(entry[5], other.series[other_id])
+
+        weight_index = 1 if self.key == 'time_sum' else 0
+        kept = set(heapq.nlargest(self.capacity, entries, key=lambda url: entries[url][weight_index] + entries[url][4]))
+        self.url_ids, self.urls, self.heap = {}, [], []
+        self.counts, self.sums, self.maxs = array.array('l'), array.array('q'), array.array('l')
+        self.samples, self.errors = [], array.array('q')
+        self.series = None if self.series is None else []
+        for url, (count, time_sum, time_max, samples, error, series) in entries.items():
+            if url in kept:
+                self.url_ids[url] = len(self.urls)
+                self.urls.append(url)
+                self.counts.append(count)
+                self.sums.append(time_sum)
+                self.maxs.append(time_max)
+                self.samples.append(samples)
+                self.errors.append(error)
+                if self.series is not None:
+                    self.series.append(series)
+        self.heap = [(self.weight(url_id), url_id) for url_id in range(len(self.urls))]
+        heapq.heapify(self.heap)
+        return self
+
+    def to_dict(self) -> dict:
+        """LogStat.to_dict с capacity, key и errors (куча по from_dict строится заново)."""
+        return dict(super().to_dict(), capacity=self.capacity, key=self.key, errors=self.array_to_json(self.errors))
+
+
+class LogFollower:
+    """Чтение растущего лога (tail -f).
+
+    read_lines возвращает полные строки (bytes без перевода строки), дописанные
+    с прошлого вызова. Ротация определяется по смене inode файла log_path:
+    старый файл дочитывается до конца, затем открывается новый. Если файл стал
+    короче позиции чтения (truncate) - чтение начинается с начала файла.
+
+    log_path: путь к активному логу
+    block_size: размер блока чтения, байт
+    from_end: начать с конца файла (иначе - с начала)
+    """
+
+    def __init__(self, log_path: str, block_size: int = 1048576, from_end: bool = True):
+        self.log_path = log_path
+        self.block_size = block_size
+        self.file = None
+        self.position = 0
+        self.pending = b''
+        self.open(from_end)
+
+    def open(self, from_end: bool = False):
+        """Открывает log_path, если он существует (во время ротации файла может не быть)."""
+        try:
+            self.file = open(self.log_path, 'rb')
+        except FileNotFoundError:
+            self.file = None
+            return
+        self.position = self.file.seek(0, os.SEEK_END) if from_end else 0
+        self.pending = b''
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def read_lines(self) -> list:
+        """Полные строки, дописанные в лог с прошлого вызова."""
+        if self.file is None:
+            self.open()
+            if self.file is None:
+                return []
+
+        chunks = [self.pending]
+        data = self.file.read(self.block_size)
+        while data:
+            chunks.append(data)
+            self.position += len(data)
+            data = self.file.read(self.block_size)
+        lines = b''.join(chunks).split(b'\n')
+        self.pending = lines.pop()
+
+        try:
+            path_stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            return lines
+        if path_stat.st_ino != os.fstat(self.file.fileno()).st_ino:
+            # старый файл дочитан выше, недописанная строка в нем уже не появится
+            if self.pending:
+                lines.append(self.pending)
+            self.close()
+            self.open()
+        elif path_stat.st_size < self.position:
+            self.file.seek(0)
+            self.position = 0
+            self.pending = b''
+        return lines
+
+
+class WindowStat:
+    """Статистика в скользящем окне времени.
+
+    Запросы учитываются в LogStat интервала (bucket) bucket_seconds по времени
+    поступления строки; интервалы старше window_seconds удаляются, поэтому
+    память ограничена окном. Статистика окна - слияние его интервалов,
+    граница окна точна до bucket_seconds.
+
+    new_stat: фабрика пустого агрегата интервала (по умолчанию - LogStat(accuracy))
+    """
+
+    def __init__(self, window_seconds: int, bucket_seconds: int = 60, accuracy: float = None, new_stat=None):
+        self.window_seconds = window_seconds
+        self.bucket_seconds = bucket_seconds
+        self.accuracy = accuracy
+        self.new_stat = new_stat or functools.partial(LogStat, accuracy)
+        self.buckets = collections.deque()
+
+    def bucket(self, now: float) -> LogStat:
+        """LogStat интервала, в который попадает время now."""
+        bucket_start = int(now // self.bucket_seconds) * self.bucket_seconds
+        if not self.buckets or self.buckets[-1][0] != bucket_start:
+            self.buckets.append((bucket_start, self.new_stat()))
+            self.expire(now)
+        return self.buckets[-1][1]
+
+    def expire(self, now: float):
+        """Удаляет интервалы, целиком вышедшие за окно."""
+        while self.buckets and self.buckets[0][0] + self.bucket_seconds <= now - self.window_seconds:
+            self.buckets.popleft()
+
+    def stat(self, window_seconds: int, now: float) -> LogStat:
+        """Статистика за последние window_seconds (не больше окна)."""
+        stat = self.new_stat()
+        for bucket_start, bucket_stat in self.buckets:
+            if bucket_start + self.bucket_seconds > now - window_seconds:
+                stat.merge(bucket_stat)
+        return stat
+
+
+class ReportServer:
+    """HTTP сервер (asyncio, только стандартная библиотека) с топом url по последней статистике.
+
+    GET /top?window=5m&limit=50&sort=time_avg&prefix=/api - строки отчета (JSON)
+        window: имя опубликованной статистики (по умолчанию - первая),
+        limit: размер топа, sort: ключ из REPORT_RANKINGS, prefix: префикс url
+    GET /stats - опубликованная статистика: имя -> версия и счетчики
+
+    Статистика публикуется методом publish из потока разбора (передается в event loop
+    сервера), опубликованный LogStat больше не изменяется. Сервер работает в своем потоке с отдельным event loop,
+    ответ строится в пуле потоков один раз на версию статистики и параметры запроса
+    и хранится в кеше (вместе со сжатым gzip), пока статистика не сменится.
+    Ошибка построения ответа - 500 с JSON ошибкой, такой ответ не кешируется.
+    """
+
+    cache_size = 256
+    max_limit = 10000
+    reasons = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               500: 'Internal Server Error'}
+
+    def __init__(self, analyzer, host: str = '127.0.0.1', port: int = 8080):
+        self.analyzer = analyzer
+        self.host = host
+        self.port = port
+        self.version = 0
+        self.stats = collections.OrderedDict()
+        self.cache = collections.OrderedDict()
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.error = None
+
+    def publish(self, name: str, stat: LogStat):
+        """Публикует статистику name, закешированные ответы по прошлой версии больше не используются.
+
+        Из другого потока при запущенном сервере stats изменяется в event loop (call_soon_threadsafe),
+        чтобы не меняться во время обхода в response.
+        """
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.set_stat, name, stat)
+        else:
+            self.set_stat(name, stat)
+
+    def set_stat(self, name: str, stat: LogStat):
+        """Сохраняет статистику name со следующей версией."""
+        self.version += 1
+        self.stats[name] = (self.version, stat)
+
+    def start(self):
+        """Запускает сервер в отдельном потоке, port 0 - любой свободный порт."""
+        started = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.serve, args=(started,), daemon=True)
+        self.thread.start()
+        started.wait()
+        if self.error:
+            self.thread.join()
+            raise self.error
+
+    def serve(self, started: threading.Event):
+        """Event loop сервера, работает до stop."""
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.host, self.port))
+        except OSError as error:
+            self.error = error
+            self.loop.close()
+            started.set()
+            return
+        self.port = self.server.sockets[0].getsockname()[1]
+        started.set()
+
+        self.loop.run_forever()
+        self.server.close()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def stop(self):
+        """Останавливает сервер и ждет завершения его потока."""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def handle(self, reader, writer):
+        """Соединение клиента: запросы GET, keep-alive для HTTP/1.1."""
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                request_line, *header_lines = head.decode('latin-1').split('\r\n')
+                headers = dict((name.strip().lower(), value.strip())
+                               for name, __, value in (line.partition(':') for line in header_lines if line))
+                try:
+                    method, target, http_version = request_line.split(' ')
+                except ValueError:
+                    method, target, http_version = '', '', 'HTTP/1.0'
+
+                status, body, etag = await self.response(method, target, headers)
+                encoding = None
+                if isinstance(body, tuple):
+                    accept_gzip = 'gzip' in headers.get('accept-encoding', '')
+                    body, encoding = (body[1], 'gzip') if accept_gzip else (body[0], 'identity')
+                keep_alive = http_version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                response_head = ['HTTP/1.1 {} {}'.format(status, self.reasons[status]),
+                                 'Content-Type: application/json',
+                                 'Content-Length: {}'.format(len(body)),
+                                 'Connection: {}'.format('keep-alive' if keep_alive else 'close')]
+                if etag:
+                    response_head.append('ETag: {}'.format(etag))
+                if encoding:
+                    response_head.append('Vary: Accept-Encoding')
+                if encoding == 'gzip':
+                    response_head.append('Content-Encoding: gzip')
+                writer.write('\r\n'.join(response_head).encode('latin-1') + b'\r\n\r\n' + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def json_body(data) -> bytes:
+        return json.dumps(data).encode('utf-8')
+
+    async def response(self, method: str, target: str, headers: dict):
+        """(status, тело или (тело, тело gzip), etag) для запроса."""
+        if method != 'GET':
+            return 405, self.json_body({'error': 'Only GET is supported'}), None
+        url = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        if url.path == '/stats':
+            return 200, self.json_body({name: {'version': version, 'total_count': stat.total_count,
+                                               'matched_count': stat.matched_count, 'urls': len(stat)}
+                                        for name, (version, stat) in self.stats.items()}), None
+        if url.path != '/top':
+            return 404, self.json_body({'error': 'Unknown path {}'.format(url.path)}), None
+
+        name = query.get('window') or next(iter(self.stats), None)
+        if name not in self.stats:
+            return 404, self.json_body({'error': 'No statistics {}'.format(name)}), None
+        sort_key = query.get('sort', 'time_sum')
+        try:
+            limit = int(query.get('limit', self.analyzer.report_size))
+        except ValueError:
+            limit = 0
+        if sort_key not in REPORT_RANKINGS or not 0 < limit <= self.max_limit:
+            return 400, self.json_body({'error': 'Bad sort or limit'}), None
+
+        version, stat = self.stats[name]
+        prefix = query.get('prefix', '')
+        etag = '"{}-{}-{}-{}"'.format(version, sort_key, limit, zlib.crc32(prefix.encode('utf-8')))
+        if headers.get('if-none-match') == etag:
+            return 304, b'', etag
+
+        cache_key = (name, version, sort_key, limit, prefix)
+        future = self.cache.get(cache_key)
+        if future is None:
+            future = self.loop.run_in_executor(None, self.top_body, name, version, stat, limit, sort_key, prefix)
+            self.cache[cache_key] = future
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(cache_key)
+        try:
+            body = await future
+        except Exception as error:
+            # ошибка не кешируется - следующий такой же запрос строит ответ заново
+            if self.cache.get(cache_key) is future:
+                del self.cache[cache_key]
+            self.analyzer.root_logger.error('Report for {} failed: {!r}'.format(target, error))
+            return 500, self.json_body({'error': 'Report failed: {}'.format(error)}), None
+        return 200, body, etag
+
+    def top_body(self, name: str, version: int, stat: LogStat, limit: int, sort_key: str, prefix: str):
+        """Тело ответа /top: (JSON, JSON сжатый gzip)."""
+        url_ids = [url_id for url_id, url in enumerate(stat.urls) if url.startswith(prefix)] if prefix else None
+        rows = self.analyzer.make_report(stat, limit, sort_key, url_ids=url_ids)
+        body = self.json_body({'window': name, 'version': version, 'sort': sort_key, 'rows': rows})
+        return body, gzip.compress(body, 6)
+
+
+class RunStats:
+    """Метрики одного запуска Analyzer: время по этапам, объем, промахи, пиковая память.
+
+    stages: этап -> {'wall': сек, 'cpu': сек}. Время вложенного этапа не входит
+            во время внешнего, время повторных вызовов этапа суммируется.
+    counters: lines, matched, mismatch - разобранные в этом запуске строки,
+              bytes - прочитанные байты лога (сжатого для gz), urls - url в отчете.
+    Пиковая память - ru_maxrss процесса и, если tracemalloc запущен, его пик.
+    """
+
+    STAGES = ('discovery', 'validate', 'read', 'parse', 'aggregate', 'report', 'write', 'history')
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = collections.OrderedDict((name, {'wall': 0.0, 'cpu': 0.0}) for name in self.STAGES)
+        self.counters = collections.Counter()
+        self._nested = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Замеряет wall и CPU время блока как этап name."""
+        self._nested.append([0.0, 0.0])
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            nested_wall, nested_cpu = self._nested.pop()
+            times = self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+            times['wall'] += wall - nested_wall
+            times['cpu'] += cpu - nested_cpu
+            if self._nested:
+                self._nested[-1][0] += wall
+                self._nested[-1][1] += cpu
+
+    def timed_gen(self, iterable, name: str):
+        """Элементы iterable, время получения каждого учитывается как этап name.
+
+        Конец iterable - отдельный маркер: элементы None (промахи разбора) не обрывают перебор.
+        """
+        iterator, end = iter(iterable), object()
+        while True:
+            with self.stage(name):
+                item = next(iterator, end)
+            if item is end:
+                return
+            yield item
+
+    def count_stat(self, stat: LogStat):
+        """Учитывает строки, разобранные в stat."""
+        self.counters['lines'] += stat.total_count
+        self.counters['matched'] += stat.matched_count
+        self.counters['mismatch'] += stat.mismatch_count
+
+    def summary(self) -> dict:
+        """Итоги запуска для лога и JSON."""
+        lines, read_bytes = self.counters['lines'], self.counters['bytes']
+        parse_wall = sum(self.stages[name]['wall'] for name in ('read', 'parse', 'aggregate'))
+        return {'started': round(self.started, 3),
+                'duration': round(time.time() - self.started, 6),
+                'stages': {name: {key: round(value, 6) for key, value in times.items()}
+                           for name, times in self.stages.items()},
+                'counters': dict(self.counters),
+                'lines_per_sec': round(lines / parse_wall, 1) if parse_wall else None,
+                'bytes_per_sec': round(read_bytes / parse_wall, 1) if parse_wall else None,
+                'mismatch_ratio': round(self.counters['mismatch'] / lines, 6) if lines else 0.0,
+                'peak_rss_kb': Utils.peak_rss(),
+                'tracemalloc_peak_kb': tracemalloc.get_traced_memory()[1] // 1024 if tracemalloc.is_tracing() else None}
+
+
+class HistoryStore:
+    """История дневных агрегатов url в базе SQLite для запросов трендов без разбора логов.
+
+    url_day: строка на дату (ISO) и url - count, time_sum, time_avg, time_max и квантили
+             QUANTILES (time_med, time_pNN), время в секундах. Первичный ключ (date, url) -
+             строки дня пишутся подряд и читаются для сравнения дней, индекс (url, date) - для
+             трендов url, индекс (date, time_sum) - для топа дня.
+    days: итоги дня - строк разобрано, совпало, суммарное время.
+    День сохраняется целиком (прежние строки дня заменяются) одной транзакцией, вставка
+    пачками по batch_size, журнал WAL - запросы не блокируются записью.
+    """
+
+    QUANTILES = (50, 90, 95, 99)
+    METRICS = ('count', 'time_sum', 'time_avg', 'time_max', 'time_med', 'time_p90', 'time_p95', 'time_p99')
+    batch_size = 1000
+
+    def __init__(self, path: str):
+        assert (isinstance(path, str) and path), 'HISTORY_PATH is not set.'
+        self.path = path
+
+    @contextlib.contextmanager
+    def connect(self):
+        """Соединение с базой (схема создается при первом подключении), commit при выходе без ошибки."""
+        connection = sqlite3.connect(self.path)
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS url_day (date TEXT NOT NULL, url TEXT NOT NULL, {}, '
+                               'PRIMARY KEY (date, url)) WITHOUT ROWID'.format(
+                                   ', '.join('{} {}'.format(metric, 'INTEGER' if metric == 'count' else 'REAL')
+                                             for metric in self.METRICS)))
+            connection.execute('CREATE INDEX IF NOT EXISTS url_day_url ON url_day (url, date)')
+            connection.execute('CREATE INDEX IF NOT EXISTS url_day_time ON url_day (date, time_sum)')
+            connection.execute('CREATE TABLE IF NOT EXISTS days (date TEXT PRIMARY KEY, total_count INTEGER, '
+                               'matched_count INTEGER, total_time REAL)')
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def save_day(self, date: datetime.date, rows, total_count: int, matched_count: int, total_time: float):
+        """Заменяет агрегаты дня date строками rows: (url, *METRICS), возвращает число строк."""
+        insert = 'INSERT INTO url_day (date, url, {}) VALUES (?, ?, {})'.format(
+            ', '.join(self.METRICS), ', '.join('?' * len(self.METRICS)))
+        day, saved = date.isoformat(), 0
+        rows = ((day, *row) for row in rows)
+        with self.connect() as connection:
+            connection.execute('DELETE FROM url_day WHERE date = ?', (day,))
+            for batch in iter(lambda: list(itertools.islice(rows, self.batch_size)), []):
+                connection.executemany(insert, batch)
+                saved += len(batch)
+            connection.execute('INSERT OR REPLACE INTO days VALUES (?, ?, ?, ?)',
+                               (day, total_count, matched_count, total_time))
+        return saved
+
+    @staticmethod
+    def date_range(date_from: datetime.date = None, date_to: datetime.date = None) -> tuple:
+        """Границы интервала дат для запроса (ISO, None - без ограничения)."""
+        return (date_from.isoformat() if date_from else '0000-00-00', date_to.isoformat() if date_to else '9999-99-99')
+
+    def trend(self, url: str, date_from: datetime.date = None, date_to: datetime.date = None) -> list:
+        """Агрегаты url по дням интервала: [{date, count, time_sum, ...}] по возрастанию даты."""
+        with self.connect() as connection:
+            cursor = connection.execute('SELECT date, {} FROM url_day WHERE url = ? AND date BETWEEN ? AND ? '
+                                        'ORDER BY date'.format(', '.join(self.METRICS)),
+                                        (url, *self.date_range(date_from, date_to)))
+            return [dict(zip(('date',) + self.METRICS, row)) for row in cursor]
+
+    def movers(self, date_from: datetime.date = None, date_to: datetime.date = None, metric: str = 'time_sum',
+               limit: int = 10) -> list:
+        """Url с наибольшим изменением metric между первым и последним днем истории в интервале.
+
+        [{url, before, after, delta, date_from, date_to}] по убыванию |delta|, date_from и date_to -
+        сравниваемые дни; url, которого не было в один из дней, имеет в нем значение 0.
+        """
+        assert (metric in self.METRICS), 'Unknown history metric {}.'.format(metric)
+        with self.connect() as connection:
+            first, last = connection.execute('SELECT MIN(date), MAX(date) FROM days WHERE date BETWEEN ? AND ?',
+                                             self.date_range(date_from, date_to)).fetchone()
+            if first is None:
+                return []
+            cursor = connection.execute(
+                'SELECT url, TOTAL(CASE WHEN date = :first THEN {metric} END) AS before, '
+                'TOTAL(CASE WHEN date = :last THEN {metric} END) AS after FROM url_day '
+                'WHERE date IN (:first, :last) GROUP BY url ORDER BY ABS(after - before) DESC, url '
+                'LIMIT :limit'.format(metric=metric), {'first': first, 'last': last, 'limit': limit})
+            return [{'url': url, 'before': before, 'after': after, 'delta': round(after - before, 6),
+                     'date_from': first, 'date_to': last} for url, before, after in cursor]
+
+
+# Лог в каталоге: дата из имени файла, путь, размер и mtime на момент построения каталога.
+LogFile = collections.namedtuple('LogFile', 'date path size mtime')
+
+
 class Analyzer(Utils):
     """Сущность обработки входящих логов и генерации отчета.
 
@@ -531,48 +3341,144 @@ class Analyzer(Utils):
     Параметры работы:
         date_fmt: внутренний формат даты для сравнения
         log_dir: каталог с обрабатываемыми логами
+        log_dir_recursive: искать логи и во вложенных каталогах log_dir
+        log_catalog_path: файл для сохранения каталога логов между запусками
         report_dir: каталог для сохранятения итоговый отчет
         max_mismatch_percent: % при котором обрабатываемый файл считается корректным
         max_mismatch_count: количество промахов при котором структура считается корректной
         max_mismatch_percent и max_mismatch_count - связаны по принципу AND
         report_size: кол-во url с наибольшим суммарным временем обработки для сохранения
+        workers: количество процессов для параллельного разбора несжатого лога
+        read_mode: режим чтения лога: text или bytes
+        read_buffer_size: размер блока чтения в режиме bytes, байт
+        decompress_backend: способ распаковки gzip (auto заменяется доступным при инициализации)
+        report_backend: расчет отчета: python или numpy (auto заменяется при инициализации)
+        incremental: инкрементальный разбор с сохранением checkpoint
+        checkpoint_dir: каталог для checkpoint
+        columnar_cache: разбор лога целиком через columns файл в checkpoint_dir
+        quantile_accuracy: погрешность QuantileSketch (None - точный расчет квантилей)
+        sample_rate, sample_mode, sample_block_size: выборка строк лога (sample_rate 1 - без выборки)
+        report_percentiles: дополнительные перцентили в отчете
+        report_rankings: рейтинги url в отчете {ключ сортировки: размер}, первый - основной
+        report_sinks: форматы отчета (REPORT_SINKS), файл html - основное имя отчета
+        history_path: база HistoryStore дневных агрегатов url (пусто - история не ведется)
+        series_seconds: интервал временного ряда url, секунды (TIME_SERIES_BUCKETS; 0 - ряд не собирается)
+        series_top: количество первых url каждого рейтинга с временным рядом в отчете
+        heavy_hitters, heavy_hitters_key: размер и вес HeavyHitterStat (0 - LogStat со всеми url)
+        url_normalize: скомпилированные правила нормализации url [(re, замена)] (пусто - без нормализации)
+        follow_log_path: активный лог для режима follow
+        follow_windows: скользящие окна отчетов режима follow, минуты
+        follow_interval: период обновления отчетов режима follow, секунды
+        server_host, server_port: HTTP сервер (ReportServer) режима follow, порт 0 - без сервера
         template_path: шаблон для генерации отчета
         replace_tag: тэг в шаблоне для замены
         min_log_date: минимальная дата лога nginx для поиска
         nginx_log_name_re: скомпилированный паттерн для поиска логов nginx
         web_server_re: скомпилированный паттерн для разбора строк в логе nginx
+        log_format_parser: разборщик, сгенерированный по web_server_log_format (None - только паттерн),
+                           для json - JsonLineParser по ключам json_url_field и json_time_field
+        log_format_bytes_parser: тот же разборщик для строк bytes
+        log_format_detect: выбор формата по выборке строк (validate_log)
+        validate_lines: размер выборки строк для проверки формата (0 - без проверки)
         log_name_date_re: спомпилированный паттерн формата даты для поиска в log_name
 
     Параметры логгирования работы:
         ts_f_path: внутренний формат даты для сравнения
         root_logger: настроенный logger для вывода сообщений
+        run_summary: замер этапов запуска (RunStats), итоги - в лог и в summary_path
+        profile: cProfile разбора лога, статистика - в лог и в файл рядом с summary_path
+        prometheus_textfile: .prom файл с метриками запуска (пусто - не пишется)
+        run_stats: RunStats текущего запуска (None - замер выключен)
+        shard: экземпляр разбирает диапазон лога в процессе пула (промахи проверяются после слияния)
 
     Вычисляемые атрибуты:
+        log_catalog: каталог логов - список LogFile по возрастанию даты
         latest_log: самый свежий лог-файл nginx для парсинга
         web_server_log_gen: генератор с лог-файлами
     """
 
+    # меньшие выборки и списки url NumPy backend считает как python
+    numpy_min_size = 10000
+
     def __init__(self, config: Config, log: Logging):
         """Атрибуты принимающие значения из config не проверяются."""
         self.__max_log_date = None
+        self.__log_catalog = None
         self.root_logger = log
 
         self.date_fmt = config.date_fmt
         self.log_dir = config.log_dir
+        self.log_dir_recursive = config.log_dir_recursive
+        self.log_catalog_path = config.log_catalog_path
         self.nginx_log_name_re = config.log_name_pattern
         self.web_server_re = config.web_server_log_pattern
+        self.json_url_field = config.json_url_field
+        self.json_time_field = config.json_time_field
+        self.log_format_parser = config.web_server_log_format
+        self.log_format_detect = config.log_format_detect
+        self.validate_lines = config.validate_lines
         self.log_name_date_re = config.log_name_date_pattern
         self.report_dir = config.report_dir
         self.max_mismatch_count = config.max_mismatch_count
         self.max_mismatch_percent = config.max_mismatch_percent
         self.report_size = config.report_size
+        self.workers = config.workers
+        self.read_mode = config.read_mode
+        self.read_buffer_size = config.read_buffer_size
+        self.decompress_backend = self.resolve_decompress_backend(config.decompress_backend)
+        self.report_backend = self.resolve_report_backend(config.report_backend)
+        self.incremental = config.incremental
+        self.checkpoint_dir = config.checkpoint_dir or config.report_dir
+        self.columnar_cache = config.columnar_cache
+        self.quantile_accuracy = config.quantile_accuracy if config.quantile_mode == 'approx' else None
+        self.sample_rate = config.sample_rate
+        self.sample_mode = config.sample_mode
+        self.sample_block_size = config.sample_block_size
+        self.report_percentiles = config.report_percentiles
+        self.report_rankings = config.report_rankings or {'time_sum': config.report_size}
+        self.report_sinks = config.report_sinks
+        self.history_path = config.history_path
+        self.series_seconds = TIME_SERIES_BUCKETS.get(config.time_series, 0)
+        self.series_top = config.time_series_top
+        self.heavy_hitters = config.heavy_hitters
+        self.heavy_hitters_key = config.heavy_hitters_key
+        self.url_normalize = config.url_normalize
+        self.follow_log_path = config.follow_log_path
+        self.follow_windows = config.follow_windows
+        self.follow_interval = config.follow_interval
+        self.server_host = config.server_host
+        self.server_port = config.server_port
         self.template_path = config.report_template_path
         self.replace_tag = config.template_replace_tag
         self.ts_f_path = config.ts_f_path
+        self.run_summary = config.run_summary
+        self.prometheus_textfile = config.prometheus_textfile
+        self.profile = False
+        self.run_stats = None
+        self.shard = False
         self.min_log_date = self.str_to_date(config.min_log_date, config.date_fmt)  # noqa
 
+        log.debug('Decompress backend: {}'.format(self.decompress_backend))
+        log.debug('Report backend: {}'.format(self.report_backend))
         log.debug('Analyzer initialization complete.')
 
+    def __getstate__(self):
+        """Логгер не сериализуется - в дочерний процесс передается его имя.
+
+        Каталог логов и замер этапов (RunStats) в дочерний процесс не передаются.
+        В дочернем процессе root_logger - уже logging.Logger (см. __setstate__).
+        """
+        state = self.__dict__.copy()
+        state['root_logger'] = getattr(self.root_logger, 'root_logger', self.root_logger).name
+        state['_Analyzer__log_catalog'] = None
+        state['run_stats'] = None
+        return state
+
+    def __setstate__(self, state):
+        """Logger предоставляет тот же интерфейс, что и обертка Logging."""
+        self.__dict__.update(state)
+        self.root_logger = logging.getLogger(state['root_logger'])
+
     @property
     def max_mismatch_count(self):
         """Максимальное количество несовпадения при парсинге лога."""
@@ -613,7 +3519,9 @@ class Analyzer(Utils):
         """Имя файла с результатам обработки логов."""
         max_log_date = self.date_to_str(self.max_log_date, self.date_fmt)
         file_name = os.path.join(self.report_dir, 'report-{}.html'.format(max_log_date))
-        self.check_not_exists(file_name)
+        if not self.incremental:
+            for __, sink_path in self.report_sink_paths(file_name):
+                self.check_not_exists(sink_path)
         return file_name
 
     @property
@@ -639,6 +3547,61 @@ class Analyzer(Utils):
         """Скомпилированный паттерн для разбора строк в логе nginx."""
         compiled_re = re.compile(pattern)
         self.__web_server_re = compiled_re
+        self.__web_server_bytes_re = re.compile(pattern.encode('utf-8'))
+
+    @property
+    def web_server_bytes_re(self):
+        """Скомпилированный паттерн для разбора строк bytes."""
+        return self.__web_server_bytes_re
+
+    @property
+    def log_format_parser(self):
+        """Разборщик, сгенерированный по директиве nginx log_format."""
+        return self.__log_format_parser
+
+    @log_format_parser.setter
+    @log_property_decorator
+    def log_format_parser(self, log_format: str):
+        """Разборщик, сгенерированный по директиве nginx log_format (json - разборщик строк JSON)."""
+        if log_format == 'json':
+            self.__log_format_parser = JsonLineParser(self.json_url_field, self.json_time_field)
+            self.__log_format_bytes_parser = JsonLineParser(self.json_url_field, self.json_time_field, binary=True)
+            return
+        self.__log_format_parser = LogFormatParser(log_format) if log_format else None
+        self.__log_format_bytes_parser = LogFormatParser(log_format, binary=True) if log_format else None
+
+    @property
+    def url_normalize(self):
+        """Скомпилированные правила нормализации url: [(re, замена)]."""
+        return self.__url_normalize
+
+    @url_normalize.setter
+    @log_property_decorator
+    def url_normalize(self, rules: list):
+        """Скомпилированные правила нормализации url: [(re, замена)]."""
+        rules = [URL_NORMALIZE_RULES[rule] if isinstance(rule, str) else rule for rule in rules]
+        self.__url_normalize = [(re.compile(pattern), replacement) for pattern, replacement in rules]
+
+    def normalize_url(self, url: str) -> str:
+        """Применяет к url правила url_normalize."""
+        for pattern, replacement in self.url_normalize:
+            url = pattern.sub(replacement, url)
+        return url
+
+    def new_stat(self, series: bool = None) -> LogStat:
+        """Пустой агрегат: HeavyHitterStat в режиме heavy_hitters, иначе LogStat.
+
+        series: собирать временной ряд url (по умолчанию - если задан series_seconds).
+        """
+        series = bool(self.series_seconds) if series is None else series
+        if self.heavy_hitters:
+            return HeavyHitterStat(self.heavy_hitters, self.heavy_hitters_key, self.quantile_accuracy, series)
+        return LogStat(self.quantile_accuracy, series)
+
+    @property
+    def log_format_bytes_parser(self):
+        """Разборщик log_format для строк bytes."""
+        return self.__log_format_bytes_parser
 
     @property
     def log_name_date_re(self):
@@ -652,135 +3615,1265 @@ class Analyzer(Utils):
         compiled_re = re.compile(pattern)
         self.__log_name_date_re = re.compile(compiled_re)
 
+    @property
+    def catalog_fingerprint(self) -> list:
+        """Настройки, от которых зависит содержимое каталога логов."""
+        return [os.path.abspath(self.log_dir), self.log_dir_recursive, self.nginx_log_name_re.pattern,
+                self.log_name_date_re.pattern, self.date_fmt]
+
+    def scan_log_dir(self) -> dict:
+        """Строит каталог логов просмотром log_dir (scan_logs, во вложенные каталоги - только при log_dir_recursive).
+
+        Кроме списка логов сохраняются mtime просмотренных каталогов и время построения:
+        пока mtime каталогов не изменились, каталог логов актуален.
+        """
+        dir_mtimes, logs, undated = self.scan_logs(self.log_dir, self.log_dir_recursive, self.nginx_log_name_re,
+                                                   self.log_name_date_re, self.date_fmt)
+        for log_path in undated:
+            self.root_logger.debug('No date in the log name: {}'.format(log_path))
+        return {'fingerprint': self.catalog_fingerprint, 'scan_time': int(time.time() * 1000000000),
+                'dir_mtimes': dir_mtimes, 'logs': logs}
+
+    def log_catalog_actual(self, catalog: dict) -> bool:
+        """Каталог построен с текущими настройками и mtime каталогов не изменились.
+
+        mtime, отстающий от времени построения меньше чем на 2 секунды, не доверяется:
+        изменение в тот же квант времени файловой системы по mtime не видно.
+        """
+        if catalog.get('fingerprint') != self.catalog_fingerprint:
+            return False
+        for dir_path, mtime_ns in catalog['dir_mtimes'].items():
+            try:
+                dir_mtime_ns = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                return False
+            if dir_mtime_ns != mtime_ns or catalog['scan_time'] - mtime_ns < 2000000000:
+                return False
+        return True
+
+    def load_log_catalog(self):
+        """Читает сохраненный каталог логов, None - каталога нет или он не читается."""
+        if not self.log_catalog_path or not os.path.exists(self.log_catalog_path):
+            return None
+        try:
+            with open(self.log_catalog_path, 'rb') as catalog_f:
+                catalog = json.load(catalog_f)
+            catalog['logs'] = [LogFile(datetime.date.fromisoformat(log_date), path, size, mtime)
+                               for log_date, path, size, mtime in catalog['logs']]
+        except (OSError, ValueError, KeyError, TypeError):
+            self.root_logger.info('Log catalog {} is broken, ignored'.format(self.log_catalog_path))
+            return None
+        return catalog
+
+    def save_log_catalog(self, catalog: dict):
+        """Атомарно сохраняет каталог логов в log_catalog_path (JSON, даты логов - ISO 8601)."""
+        logs = [[log_file.date.isoformat(), log_file.path, log_file.size, log_file.mtime]
+                for log_file in catalog['logs']]
+        self.save_atomic(self.log_catalog_path, json.dumps(dict(catalog, logs=logs)).encode('utf-8'))
+
+    @property
+    def log_catalog(self) -> list:
+        """Каталог логов: список LogFile по возрастанию даты.
+
+        Каталог берется из памяти или из log_catalog_path и перестраивается,
+        только если изменились mtime каталогов с логами или настройки поиска.
+        """
+        catalog = self.__log_catalog or self.load_log_catalog()
+        if catalog is None or not self.log_catalog_actual(catalog):
+            catalog = self.scan_log_dir()
+            self.root_logger.debug('Log catalog rebuilt: {} files'.format(len(catalog['logs'])))
+            if self.log_catalog_path:
+                self.save_log_catalog(catalog)
+        self.__log_catalog = catalog
+        return catalog['logs']
+
     @property
     def web_server_log_gen(self):
-        """Iterable web server log files."""  # noqa
-        for __, __, file_list in os.walk(self.log_dir):
-            for file in file_list:
-                if self.nginx_log_name_re.match(file):
-                    yield file
+        """Лог-файлы web сервера (LogFile) из каталога логов."""
+        for log_file in self.log_catalog:
+            yield log_file
 
     @property
     @log_property_decorator
     def latest_log(self):
         """Find the newest log in the self.log_dir."""
-        max_log_date, max_log_f_name = self.min_log_date, None
+        logs = self.log_catalog
+        if logs and logs[-1].date >= self.min_log_date:
+            self.max_log_date = logs[-1].date
+            return logs[-1].path
+
+        raise FileExistsError('Web server log file not found.')
 
-        for log_file in self.web_server_log_gen:
-            log_date = self.str_to_date(self.log_name_date_re.search(log_file).group(),
-                                        self.date_fmt)
+    def logs_in_range(self, date_from: datetime.date = None, date_to: datetime.date = None) -> list:
+        """Логи с датой в имени в интервале [date_from, date_to]: список (дата, путь) по возрастанию даты."""
+        date_from = max(date_from, self.min_log_date) if date_from else self.min_log_date
+        logs = [(log_file.date, log_file.path) for log_file in self.log_catalog
+                if date_from <= log_file.date and (date_to is None or log_file.date <= date_to)]
 
-            if log_date >= max_log_date:
-                max_log_date = log_date
-                max_log_f_name = os.path.join(self.log_dir, log_file)
+        if not logs:
+            raise FileExistsError('Web server log files not found in the date range.')
+        return logs
 
-        if max_log_f_name:
-            self.max_log_date = max_log_date
-            return max_log_f_name
+    @log_property_decorator
+    def range_report_file_name(self, date_from: datetime.date, date_to: datetime.date) -> str:
+        """Имя файла отчета за интервал дат."""
+        file_name = os.path.join(self.report_dir, 'report-{}-{}.html'.format(self.date_to_str(date_from, self.date_fmt),
+                                                                             self.date_to_str(date_to, self.date_fmt)))
+        if not self.incremental:
+            for __, sink_path in self.report_sink_paths(file_name):
+                self.check_not_exists(sink_path)
+        return file_name
 
-        raise FileExistsError('Web server log file not found.')
+    def parse_logs(self, log_files, log_stats: list = None) -> LogStat:
+        """Сливает статистику нескольких логов.
+
+        При incremental статистика каждого лога кешируется в checkpoint (см. parse_log_incremental):
+        заново разбираются только новые или изменившиеся файлы. Без incremental логи разбираются целиком.
+        log_stats: если задан, в него по порядку добавляется статистика каждого лога (не изменяется слиянием).
+        """
+        stat = self.new_stat()
+        for log_file in log_files:
+            log_stat = self.parse_log_incremental(log_file) if self.incremental else self.parse_log(log_file)
+            if log_stats is not None:
+                log_stats.append(log_stat)
+            stat.merge(log_stat)
+        return stat
 
     def parse_line(self, log_line):
-        """Find the line in the log url and time."""
+        """Находит в строке лога url и время: (request_url, request_time в мкс).
+
+        Строки, которые не разобрал разборщик log_format, разбираются web_server_re.
+        url нормализуется правилами url_normalize.
+        """
+        parsed_line = self.log_format_parser.parse(log_line) if self.log_format_parser else None
+        if not parsed_line:
+            parsed_line = self.parse_line_re(log_line)
+        if parsed_line and self.url_normalize:
+            return self.normalize_url(parsed_line[0]), parsed_line[1]
+        return parsed_line
+
+    def parse_line_re(self, log_line):
+        """Находит в строке лога url и время паттерном web_server_re."""
         grp = self.web_server_re.match(log_line)
         if not grp:
             return
 
-        col_names = ('request_url', 'request_time')
-        parsed_line = (dict(zip(col_names, grp.groups())))
-        if parsed_line['request_time'] == '-':
-            parsed_line['request_time'] = 0
-        parsed_line['request_time'] = float(parsed_line['request_time'])
+        request_url, request_time = grp.groups()
+        if request_time == '-':
+            return request_url, 0
+        try:
+            return request_url, round(float(request_time) * 1000000)
+        except ValueError:
+            return
 
+    def parse_bytes_line(self, log_line: bytes):
+        """parse_line для строки bytes, декодируется только url."""
+        parsed_line = self.log_format_bytes_parser.parse(log_line) if self.log_format_bytes_parser else None
+        if not parsed_line:
+            parsed_line = self.parse_bytes_line_re(log_line)
+        if parsed_line and self.url_normalize:
+            return self.normalize_url(parsed_line[0]), parsed_line[1]
         return parsed_line
 
+    def parse_bytes_line_re(self, log_line: bytes):
+        """parse_line_re для строки bytes."""
+        grp = self.web_server_bytes_re.match(log_line)
+        if not grp:
+            return
+
+        request_url, request_time = grp.groups()
+        request_url = request_url.decode('utf-8', 'replace')
+        if request_time == b'-':
+            return request_url, 0
+        try:
+            return request_url, round(float(request_time) * 1000000)
+        except ValueError:
+            return
+
+    def stamp_format_parser(self, binary: bool = False):
+        """Разборщик log_format, возвращающий и метку $time_local (stamp_field); None - метки в формате нет."""
+        format_parser = self.log_format_bytes_parser if binary else self.log_format_parser
+        if not isinstance(format_parser, LogFormatParser) or 'time_local' not in format_parser.tokenize()[1::2]:
+            return None
+        return LogFormatParser(format_parser.log_format, format_parser.url_field, format_parser.time_field, binary,
+                               stamp_field='time_local')
+
+    def series_line_parser(self, binary: bool = False):
+        """Функция разбора строки для временного ряда: (url, мкс, номер интервала TimeBuckets) или None.
+
+        Для строки без разбираемой метки времени номер интервала - TimeBuckets.NO_BUCKET.
+        binary: строки bytes (parse_bytes_line), иначе str (parse_line).
+        Если в log_format есть $time_local, метку возвращает сам разборщик log_format (stamp_field),
+        строки, которые он не разобрал, разбираются parse_line с поиском метки в строке (TimeBuckets).
+        """
+        format_parser = self.log_format_bytes_parser if binary else self.log_format_parser
+        time_buckets = TimeBuckets(self.series_seconds, binary, isinstance(format_parser, JsonLineParser))
+        if format_parser is None and not self.url_normalize:
+            return time_buckets.make_bucket(self.parse_bytes_line_re if binary else self.parse_line_re)
+        parse_fallback = time_buckets.make_bucket(self.parse_bytes_line if binary else self.parse_line)
+        stamp_parser = self.stamp_format_parser(binary)
+        if stamp_parser is None:
+            return parse_fallback
+
+        parse_stamp = stamp_parser.parse
+        cache, stamp_bucket = time_buckets.cache, time_buckets.stamp_bucket
+        normalize_url = self.normalize_url if self.url_normalize else None
+
+        def parse(log_line):
+            parsed_line = parse_stamp(log_line)
+            if parsed_line is None:
+                return parse_fallback(log_line)
+            request_url, request_time, stamp = parsed_line
+            try:
+                bucket = cache[stamp]
+            except KeyError:
+                bucket = stamp_bucket(stamp)
+            if bucket is None:
+                bucket = TimeBuckets.NO_BUCKET
+            return normalize_url(request_url) if normalize_url else request_url, request_time, bucket
+        return parse
+
     @staticmethod
     def median(numbers_list):
         """Consider a median."""
         numbers_list = sorted(numbers_list)
         return numbers_list[int(len(numbers_list) / 2)]
 
-    def make_report(self, log_stat, total_count, total_time, limit=100):
-        """Make report with stats.
+    @staticmethod
+    def exact_quantile(sorted_list, q: float):
+        """Квантиль q отсортированного списка, ранг выбирается так же, как в median."""
+        return sorted_list[min(int(len(sorted_list) * q), len(sorted_list) - 1)]
 
-        count: how many times does the url, the absolute value, occur
-        count_percentage: how many times does a url occur as a percentage of the total number of requests
-        time_sum: total for this URL request_time, absolute value
-        time_percent: total for this URL request_time, in percent relative to the total request_time all queries  # noqa
-        time_avg: average request_time for a given URL
-        time_max: request_time maximum for the given URL
-        time_med: request_time median for the given URL
+    @staticmethod
+    def partition_quantiles(times: array.array, quantiles: list):
+        """NumPy backend: exact_quantile по выборке times для всех quantiles одним numpy.partition.
 
+        Вместо полной сортировки на свои места ставятся только значения нужных рангов.
+        Возвращает функцию quantile(q) для q из quantiles.
         """
-        report_data = []
-        for url, times in iter(log_stat.items()):
-            count = len(times)
-            count_percentage = count / float(total_count / 100)
-            time_sum = sum(times)
-            time_percent = time_sum / float(total_time / 100)
-            time_avg = time_sum / count
-            time_max = max(times)
-            time_med = self.median(times)
-
-            report_data.append({'count': count,
-                                'time_avg': round(time_avg, 3),
-                                'time_max': round(time_max, 3),
-                                'time_sum': round(time_sum, 3),
-                                'url': url,
-                                'time_med': round(time_med, 3),
-                                'time_percent': round(time_percent, 3),
-                                'count_percentage': round(count_percentage, 3)
-                                })
-
-        report_data.sort(key=lambda x: x['time_sum'], reverse=True)
-
-        return report_data[:limit]
-
-    def insert_to_template(self, report_data: dict):
-        """Insert report_data to template report."""
-        with io.open(self.template_path, mode='r', encoding='utf-8') as f:
-            file_data = f.read()
-            file_data = file_data.replace(self.replace_tag, json.dumps(report_data))
-        return file_data
-
-    def save_report(self, report_data, file_path: str):
-        """Replace and save report_data to file_path."""
-        pasted_data = self.insert_to_template(report_data)
-        self.save_text_file(file_path, pasted_data)
+        values = numpy.frombuffer(times, dtype='i{}'.format(times.itemsize))
+        ranks = {q: min(int(len(values) * q), len(values) - 1) for q in quantiles}
+        partitioned = numpy.partition(values, sorted(set(ranks.values())))
+        return lambda q: int(partitioned[ranks[q]])
+
+    def ranking_candidates(self, stat: LogStat, limit: int, sort_key: str) -> list:
+        """NumPy backend: id url, которые могут попасть в топ limit по sort_key, по возрастанию id.
+
+        Значения REPORT_RANKINGS округляются до 0.001, округление сохраняет порядок, поэтому
+        в топ попадают только url со значением не меньше limit-го наибольшего неокругленного
+        минус 0.001. Из url с равными значениями в топ могут попасть только первые limit.
+        Отбор по всем url выполняется векторно, heapq.nlargest - только по кандидатам.
+        """
+        counts = numpy.frombuffer(stat.counts, dtype='i{}'.format(stat.counts.itemsize))
+        if sort_key == 'count':
+            values = counts
+        elif sort_key == 'time_max':
+            values = numpy.frombuffer(stat.maxs, dtype='i{}'.format(stat.maxs.itemsize)) / 1000000
+        else:
+            values = numpy.frombuffer(stat.sums, dtype='i{}'.format(stat.sums.itemsize)) / 1000000
+            if sort_key == 'time_avg':
+                values = values / counts
+        threshold = numpy.partition(values, len(values) - limit)[len(values) - limit]
+        candidates = numpy.flatnonzero(values >= threshold - 0.001)
+        # стабильная сортировка по значению: внутри группы равных значений id по возрастанию
+        candidates = candidates[numpy.argsort(values[candidates], kind='stable')]
+        positions = numpy.arange(len(candidates))
+        group_starts = numpy.ones(len(candidates), dtype=bool)
+        group_starts[1:] = values[candidates[1:]] != values[candidates[:-1]]
+        group_positions = positions - numpy.maximum.accumulate(numpy.where(group_starts, positions, 0))
+        return numpy.sort(candidates[group_positions < limit]).tolist()
+
+    def samples_quantile(self, times, quantiles: list):
+        """Функция quantile(q) выборки url для q из quantiles.
+
+        Для QuantileSketch - оценка скетча, иначе exact_quantile (для больших выборок
+        NumPy backend - partition_quantiles).
+        """
+        if isinstance(times, QuantileSketch):
+            return times.quantile
+        if self.report_backend == 'numpy' and len(times) > self.numpy_min_size:
+            return self.partition_quantiles(times, quantiles)
+        return functools.partial(self.exact_quantile, sorted(times))
 
-    def start(self):
-        """Интерфейс для запуска Analyzer."""
-        self.root_logger.info('Analyzer begin to work. Unix time: {}'.format(self._ts_time))
+    def history_rows(self, stat: LogStat):
+        """Строки HistoryStore по всем url stat: (url, *HistoryStore.METRICS), время в секундах.
 
-        total_count = mismatch_count = total_matched_count = total_time = 0
-        log_stat = collections.defaultdict(list)
+        По выборке (sample_scaled) count и time_sum масштабируются на 1 / sample_rate.
+        """
+        quantiles = [perc / 100 for perc in HistoryStore.QUANTILES]
+        scale = 1 / self.sample_rate if self.sample_scaled else 1
+        for url_id, url in enumerate(stat.urls):
+            count, time_sum = round(stat.counts[url_id] * scale), stat.sums[url_id] * scale / 1000000
+            quantile = self.samples_quantile(stat.samples[url_id], quantiles)
+            yield (url, count, time_sum, time_sum / count, stat.maxs[url_id] / 1000000,
+                   *(quantile(q) / 1000000 for q in quantiles))
+
+    def save_history(self, log_date: datetime.date, stat: LogStat):
+        """Сохраняет агрегаты url лога за день log_date в history_path."""
+        scale = 1 / self.sample_rate if self.sample_scaled else 1
+        saved = HistoryStore(self.history_path).save_day(log_date, self.history_rows(stat),
+                                                         round(stat.total_count * scale),
+                                                         round(stat.matched_count * scale),
+                                                         stat.total_time * scale / 1000000)
+        self.root_logger.info('History: {} urls saved for {}.'.format(saved, log_date.isoformat()))
+
+    def url_report(self, stat: LogStat, url_id: int, total_squares: float = None) -> dict:
+        """Строка отчета для url с id url_id.
+
+        count: сколько раз встречается url, абсолютное значение
+        count_percentage: сколько раз встречается url, в процентах от общего числа запросов
+        time_sum: суммарный request_time url, абсолютное значение
+        time_percent: суммарный request_time url, в процентах от суммарного request_time всех запросов
+        time_avg: средний request_time url
+        time_max: максимальный request_time url
+        time_med: медиана request_time url
+        time_pNN: NN перцентиль request_time url (для каждого из report_percentiles)
+        hh_error: только heavy hitters - верхняя граница веса url (time_sum или count), не учтенного
+                  до того, как url стал отслеживаться; count, time_sum и time_max считаются с этого момента
+        hh_exact: только heavy hitters - url отслеживается с начала (hh_error равен 0)
+        count_ci, time_sum_ci, time_percent_ci: только выборка (sample_scaled) - полуширина 95%
+                  доверительного интервала; count и time_sum масштабируются на 1 / sample_rate (см. sample_estimates)
+
+        count, time_sum и time_max берутся из столбцов LogStat, накопленных при разборе.
+        Выборка url - array или QuantileSketch, во втором случае медиана
+        и перцентили оцениваются с погрешностью скетча.
+        """
+        total_count, total_time = stat.matched_count, stat.total_time / 1000000
+        count, time_sum, time_max = stat.counts[url_id], stat.sums[url_id] / 1000000, stat.maxs[url_id] / 1000000
+        quantile = self.samples_quantile(stat.samples[url_id], [0.5] + [perc / 100 for perc in self.report_percentiles])
+
+        count_percentage = count / float(total_count / 100)
+        time_percent = time_sum / float(total_time / 100)
+        time_avg = time_sum / count
+        time_med = quantile(0.5) / 1000000
+
+        url_report = {'count': count,
+                      'time_avg': round(time_avg, 3),
+                      'time_max': round(time_max, 3),
+                      'time_sum': round(time_sum, 3),
+                      'url': stat.urls[url_id],
+                      'time_med': round(time_med, 3),
+                      'time_percent': round(time_percent, 3),
+                      'count_percentage': round(count_percentage, 3)
+                      }
+        for perc in self.report_percentiles:
+            url_report['time_p{}'.format(perc)] = round(quantile(perc / 100) / 1000000, 3)
+        if isinstance(stat, HeavyHitterStat):
+            error = stat.errors[url_id]
+            url_report['hh_error'] = round(error / 1000000, 3) if stat.key == 'time_sum' else error
+            url_report['hh_exact'] = not error
+        if self.sample_scaled:
+            url_report.update(self.sample_estimates(stat, url_id, total_squares))
+        return url_report
 
-        latest_log = self.latest_log
-        report_file_name = self.report_file_name
+    @property
+    def sample_scaled(self) -> bool:
+        """Статистика собрана по выборке строк и масштабируется в отчете (в режиме url - нет)."""
+        return self.sample_rate < 1 and self.sample_mode != 'url'
+
+    def samples_sum_squares(self, times) -> float:
+        """Сумма квадратов времен выборки url, мкс² (для QuantileSketch - оценка)."""
+        if isinstance(times, QuantileSketch):
+            return times.sum_squares()
+        if self.report_backend == 'numpy' and len(times) > self.numpy_min_size:
+            values = numpy.frombuffer(times, dtype='i{}'.format(times.itemsize)).astype(numpy.float64)
+            return float(numpy.dot(values, values))
+        return float(sum(value * value for value in times))
+
+    def sample_estimates(self, stat: LogStat, url_id: int, total_squares: float = None) -> dict:
+        """Оценки строки отчета по выборке sample_rate: count и time_sum, масштабированные на 1 / sample_rate,
+        и полуширины 95% доверительных интервалов count_ci, time_sum_ci и time_percent_ci.
+
+        Строка считается попавшей в выборку с вероятностью sample_rate независимо от других (оценка
+        Хорвица-Томпсона): дисперсия оценки суммы - (1 - rate) / rate² * сумма квадратов выбранных значений.
+        Доля времени url - отношение двух оценок, ее дисперсия - по дельта-методу. В режиме block
+        строки выбираются участками подряд, поэтому интервалы занижены, если время соседних строк связано.
+        total_squares: сумма квадратов времен всех url (если не задана - считается).
+        """
+        rate, z = self.sample_rate, 1.96
+        if total_squares is None:
+            total_squares = sum(map(self.samples_sum_squares, stat.samples))
+        count, time_sum = stat.counts[url_id], stat.sums[url_id]
+        squares = self.samples_sum_squares(stat.samples[url_id])
+        share = time_sum / stat.total_time if stat.total_time else 0.0
+        share_variance = (1 - rate) * max((1 - 2 * share) * squares + share ** 2 * total_squares, 0.0) / \
+            stat.total_time ** 2 if stat.total_time else 0.0
+        return {'count': round(count / rate),
+                'count_ci': round(z * math.sqrt(count * (1 - rate)) / rate, 3),
+                'time_sum': round(time_sum / rate / 1000000, 3),
+                'time_sum_ci': round(z * math.sqrt((1 - rate) * squares) / rate / 1000000, 3),
+                'time_percent_ci': round(z * 100 * math.sqrt(share_variance), 3)}
+
+    def make_report(self, stat: LogStat, limit=100, sort_key='time_sum', rows: dict = None, url_ids=None):
+        """Отчет из limit первых url по sort_key (один из REPORT_RANKINGS).
+
+        Первые url выбираются ограниченной кучей по столбцам LogStat, поэтому
+        строки (и медианы) считаются только для попавших в отчет url.
+        heapq.nlargest сохраняет порядок sorted(reverse=True): url с равными ключами
+        остаются в порядке первого появления.
+        rows: кеш url_id -> строка, общий для рейтингов одного отчета.
+        url_ids: id url для рейтинга (по умолчанию - все url).
+        С numpy report_backend в кучу попадают только ranking_candidates.
+        """
+        rows = {} if rows is None else rows
+        total_squares = None
+        ranking_key = functools.partial(REPORT_RANKINGS[sort_key], stat)
+        if url_ids is None:
+            url_ids = range(len(stat))
+            if self.report_backend == 'numpy' and len(stat) > max(limit, self.numpy_min_size):
+                url_ids = self.ranking_candidates(stat, limit, sort_key)
+        report_data = []
+        for url_id in heapq.nlargest(limit, url_ids, key=ranking_key):
+            if url_id not in rows:
+                if self.sample_scaled and total_squares is None:
+                    total_squares = sum(map(self.samples_sum_squares, stat.samples))
+                rows[url_id] = self.url_report(stat, url_id, total_squares)
+            report_data.append(rows[url_id])
+        return report_data
+
+    def make_reports(self, stat: LogStat) -> dict:
+        """Все рейтинги report_rankings по одному LogStat: sort_key -> строки отчета.
+
+        Если в stat собран временной ряд, первые series_top строк каждого рейтинга получают его в поле series (url_series).
+        """
+        rows = dict()
+        report_data = {sort_key: self.make_report(stat, limit, sort_key, rows)
+                       for sort_key, limit in self.report_rankings.items()}
+        if stat.series is not None:
+            for report_rows in report_data.values():
+                for row in report_rows[:self.series_top]:
+                    if 'series' not in row:
+                        row['series'] = self.url_series(stat, stat.url_ids[row['url']])
+        return report_data
+
+    def url_series(self, stat: LogStat, url_id: int) -> dict:
+        """Временной ряд url по интервалам series_seconds - колонки по возрастанию времени:
+        bucket (начало интервала, UTC, ISO 8601), count, time_sum, time_max и time_med интервала.
+
+        В точном режиме выборка url группируется по номерам интервалов series
+        (запросы без метки - TimeBuckets.NO_BUCKET - в ряд не входят),
+        в приближенном у каждого интервала свой QuantileSketch.
+        По выборке (sample_scaled) count и time_sum масштабируются на 1 / sample_rate.
+        """
+        scale = 1 / self.sample_rate if self.sample_scaled else 1
+        buckets = stat.series[url_id]
+        if not isinstance(buckets, dict):
+            grouped = {}
+            for bucket, request_time in zip(buckets, stat.samples[url_id]):
+                if bucket == TimeBuckets.NO_BUCKET:
+                    continue
+                times = grouped.get(bucket)
+                if times is None:
+                    times = grouped[bucket] = array.array('q')
+                times.append(request_time)
+            buckets = grouped
+
+        series = {'bucket': [], 'count': [], 'time_sum': [], 'time_max': [], 'time_med': []}
+        for bucket in sorted(buckets):
+            times = buckets[bucket]
+            if isinstance(times, QuantileSketch):
+                count, time_sum, time_max = times.count, times.sum, times.max
+            else:
+                count, time_sum, time_max = len(times), sum(times), max(times)
+            start = datetime.datetime.fromtimestamp(bucket * self.series_seconds, datetime.timezone.utc)
+            series['bucket'].append(start.strftime('%Y-%m-%dT%H:%M:%SZ'))
+            series['count'].append(round(count * scale))
+            series['time_sum'].append(round(time_sum * scale / 1000000, 3))
+            series['time_max'].append(round(time_max / 1000000, 3))
+            series['time_med'].append(round(self.samples_quantile(times, [0.5])(0.5) / 1000000, 3))
+        return series
+
+    def insert_to_template(self, report_data):
+        """Вставляет report_data в шаблон отчета.
+
+        report_data - список строк или словарь рейтингов (make_reports).
+        Первый рейтинг заменяет replace_tag, каждый рейтинг также заменяет replace_tag_<sort_key>.
+        """
+        if isinstance(report_data, list):
+            report_data = {'time_sum': report_data}
+        report_f = io.StringIO()
+        TemplateSink(self.template_path, self.replace_tag).write(report_f, report_data)
+        return report_f.getvalue()
+
+    def report_sink(self, name: str) -> ReportSink:
+        """ReportSink для имени из report_sinks."""
+        if name == 'html':
+            return TemplateSink(self.template_path, self.replace_tag)
+        return REPORT_SINKS[name]()
+
+    def report_sink_paths(self, file_path: str) -> list:
+        """[(sink, путь)] для каждого имени из report_sinks: file_path с расширением sink."""
+        base_path = os.path.splitext(file_path)[0]
+        return [(self.report_sink(name), base_path + REPORT_SINKS[name].extension) for name in self.report_sinks]
+
+    def save_report(self, report_data, file_path: str) -> list:
+        """Потоково пишет report_data во все форматы отчета, возвращает записанные файлы.
+
+        Все форматы пишутся из одного report_data во временные файлы рядом с отчетом и заменяют
+        файлы отчета только после записи всех форматов: при ошибке любого из них файлы отчета
+        не создаются и не изменяются, временные файлы удаляются.
+        Без режима incremental существующие файлы отчета не перезаписываются.
+        """
+        if isinstance(report_data, list):
+            report_data = {'time_sum': report_data}
+        sink_paths = self.report_sink_paths(file_path)
+        if not self.incremental:
+            for __, sink_path in sink_paths:
+                self.check_not_exists(sink_path)
+        temp_paths = []
+        try:
+            for sink, sink_path in sink_paths:
+                fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(sink_path),
+                                                 dir=os.path.dirname(os.path.abspath(sink_path)))
+                os.close(fd)
+                temp_paths.append(temp_path)
+                sink.save(report_data, temp_path)
+        except BaseException:
+            for temp_path in temp_paths:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+            raise
+        for temp_path, (__, sink_path) in zip(temp_paths, sink_paths):
+            os.replace(temp_path, sink_path)
+        return [sink_path for __, sink_path in sink_paths]
+
+    def check_mismatch(self, stat: LogStat):
+        """Проверяет, что количество промахов парсера в допустимых пределах."""
+        self.check_mismatch_counts(stat.mismatch_count, stat.total_count)
+
+    def check_mismatch_counts(self, mismatch_count: int, total_count: int):
+        """Проверяет промахи парсера по счетчикам (при разборе части лога - shard - не проверяются)."""
+        if self.shard:
+            return
+        mismatch_percent = (mismatch_count * 100) / total_count if total_count else 0
+        if (mismatch_count > self.max_mismatch_count) and (mismatch_percent > self.max_mismatch_percent):
+            raise AssertionError('Mismatch exceeded. Check log format type')
+
+    def sample_lines(self, file_name: str, lines: int) -> list:
+        """Выборка строк лога в режиме read_mode: первые lines строк и lines строк из середины несжатого лога."""
+        binary = self.read_mode == 'bytes'
+        head = self.read_bytes_gen(file_name, 65536) if binary else self.read_file_gen(file_name)
+        with contextlib.closing(head):
+            sample = list(itertools.islice(head, lines))
+
+        bounds = self.split_file(file_name, 2) if len(sample) == lines and not file_name.endswith('.gz') else []
+        if len(bounds) == 2:
+            start, end = bounds[1]
+            middle = self.read_bytes_gen(file_name, 65536, start, end) if binary else \
+                self.read_range_gen(file_name, start, end)
+            with contextlib.closing(middle):
+                sample.extend(itertools.islice(middle, lines))
+        return sample
+
+    def validate_log(self, file_name: str):
+        """Проверяет формат лога по выборке validate_lines строк до полного разбора.
+
+        С log_format_detect на выборке сравниваются настроенный разбор, форматы LOG_FORMATS и JSON:
+        выбирается вариант с наименьшим числом промахов, из равных - самый быстрый.
+        Если промахов выборки больше порогов max_mismatch_count и max_mismatch_percent -
+        AssertionError без чтения всего файла.
+        """
+        if not self.validate_lines:
+            return
+        sample = self.sample_lines(file_name, self.validate_lines)
+        binary = self.read_mode == 'bytes'
+        candidates = [(None, self.parse_bytes_line if binary else self.parse_line)]
+        if self.log_format_detect:
+            candidates += [(name, LogFormatParser(name, binary=binary).parse) for name in LOG_FORMATS]
+            candidates.append(('json', JsonLineParser(self.json_url_field, self.json_time_field, binary).parse))
+
+        results = []
+        for name, parse in candidates:
+            started = time.perf_counter()
+            mismatch_count = sum(1 for line in sample if not parse(line))
+            results.append((mismatch_count, time.perf_counter() - started, name))
+        mismatch_count, __, log_format = min(results, key=lambda result: result[:2])
+        self.root_logger.debug('Log format check of {}: {}'.format(
+            file_name, ', '.join('{}: {} mismatches in {:.4f}s'.format(name or 'configured', count, seconds)
+                                 for count, seconds, name in results)))
+
+        self.check_mismatch_counts(mismatch_count, len(sample))
+        if log_format:
+            self.root_logger.info('Log format detected: {}'.format(log_format))
+            self.log_format_parser = log_format
+
+    def read_log_gen(self, file_name: str, start: int = 0, end: int = None):
+        """Строки лога в режиме read_mode: str или bytes."""
+        if self.read_mode == 'bytes':
+            return self.read_bytes_gen(file_name, self.read_buffer_size, start, end, self.decompress_backend)
+        if end is None:
+            return self.read_file_gen(file_name, self.decompress_backend)
+        return self.read_range_gen(file_name, start, end)
+
+    def line_parser(self):
+        """Функция разбора строки для aggregate_parsed: parse_bytes_line или parse_line по read_mode,
+        для временного ряда - series_line_parser (с номером интервала).
+        """
+        binary = self.read_mode == 'bytes'
+        if self.series_seconds:
+            return self.series_line_parser(binary)
+        return self.parse_bytes_line if binary else self.parse_line
+
+    def aggregate(self, lines) -> LogStat:
+        """Разбирает строки лога (str или bytes в зависимости от read_mode) и собирает по ним статистику."""
+        return self.aggregate_parsed(map(self.line_parser(), lines))
+
+    def aggregate_parsed(self, parsed_lines, stat: LogStat = None) -> LogStat:
+        """Добавляет в stat (по умолчанию - новый) разобранные строки: (url, мкс) или None для промаха.
+
+        Если stat собирает временной ряд, строки - (url, мкс, номер интервала) из series_line_parser:
+        в точном режиме номер интервала дописывается в series url параллельно выборке,
+        в приближенном - время добавляется в QuantileSketch интервала (LogStat.add_series).
+        Доля промахов растет только на промахе, поэтому пороги проверяются только там.
+        """
+        stat = self.new_stat() if stat is None else stat
+        total_count, mismatch_count = stat.total_count, stat.mismatch_count
+        total_matched_count, total_time = stat.matched_count, stat.total_time
+        url_ids, samples, counts, sums, maxs = stat.url_ids, stat.samples, stat.counts, stat.sums, stat.maxs
+        series, series_exact, add_series = stat.series, not stat.accuracy, stat.add_series
 
-        for line in self.read_file_gen(latest_log):
-            parsed_line = self.parse_line(line)
+        for parsed_line in parsed_lines:
             total_count += 1
 
             if parsed_line:
                 total_matched_count += 1
-                total_time += parsed_line['request_time']
-                log_stat[parsed_line['request_url']].append(parsed_line['request_time'])
+                if series is None:
+                    request_url, request_time = parsed_line
+                else:
+                    request_url, request_time, bucket = parsed_line
+                total_time += request_time
+
+                url_id = url_ids.get(request_url)
+                if url_id is None:
+                    url_id = stat.url_id(request_url)
+                try:
+                    samples[url_id].append(request_time)
+                except OverflowError:
+                    stat.widen(url_id).append(request_time)
+                if series is not None:
+                    if series_exact:
+                        series[url_id].append(bucket)
+                    else:
+                        add_series(url_id, bucket, request_time)
+                counts[url_id] += 1
+                sums[url_id] += request_time
+                if request_time > maxs[url_id]:
+                    maxs[url_id] = request_time
             else:
                 mismatch_count += 1
+                self.check_mismatch_counts(mismatch_count, total_count)
 
-            mismatch_percent = (mismatch_count * 100) / total_count
-            if (mismatch_count > self.max_mismatch_count) and (mismatch_percent > self.max_mismatch_percent):
-                raise AssertionError('Mismatch exceeded. Check log format type')
+        stat.total_count = total_count
+        stat.matched_count = total_matched_count
+        stat.mismatch_count = mismatch_count
+        stat.total_time = total_time
+        return stat
 
-        if total_matched_count == 0 or total_time == 0:
+    @property
+    def block_parsing(self) -> bool:
+        """Лог разбирается блоками bytes (aggregate_blocks): режим bytes и block_re разборщика,
+        для временного ряда - в log_format есть $time_local.
+        """
+        format_parser = self.log_format_bytes_parser
+        if self.read_mode != 'bytes' or not format_parser or not format_parser.block_re:
+            return False
+        return not self.series_seconds or 'time_local' in format_parser.tokenize()[1::2]
+
+    def aggregate_blocks(self, blocks) -> LogStat:
+        """Разбирает лог блоками bytes без деления на строки.
+
+        Строки блока ищутся block_re разборщика log_format (finditer), строки
+        между совпадениями разбираются parse_bytes_line. Доля промахов может
+        превысить порог только на промахе, поэтому проверяется только там.
+        Для временного ряда block_re разборщика stamp_format_parser захватывает и метку $time_local,
+        номер интервала берется из кеша TimeBuckets.
+        """
+        stat = self.new_stat()
+        mismatch_count = total_matched_count = total_time = 0
+        url_ids, samples, counts, sums, maxs = stat.url_ids, stat.samples, stat.counts, stat.sums, stat.maxs
+        format_parser, parse_line = self.log_format_bytes_parser, self.parse_bytes_line
+        series = stat.series
+        if series is not None:
+            format_parser, parse_line = self.stamp_format_parser(True), self.series_line_parser(True)
+            time_buckets = TimeBuckets(self.series_seconds, binary=True)
+            cache, stamp_bucket = time_buckets.cache, time_buckets.stamp_bucket
+        series_exact, add_series = not stat.accuracy, stat.add_series
+        finditer = format_parser.block_re.finditer
+        time_first, block_groups = format_parser.time_first, format_parser.block_groups
+        normalize_url = self.normalize_url if self.url_normalize else None
+
+        def parse_fallback(fallback_lines):
+            nonlocal mismatch_count, total_matched_count, total_time
+            for line in fallback_lines.split(b'\n'):
+                parsed_line = parse_line(line)
+                if parsed_line:
+                    total_matched_count += 1
+                    total_time += parsed_line[1]
+                    stat.add(*parsed_line)
+                else:
+                    mismatch_count += 1
+                    self.check_mismatch_counts(mismatch_count, mismatch_count + total_matched_count)
+
+        for block in self.align_blocks_gen(blocks):
+            position = 0
+            for match in finditer(block):
+                if match.start() != position:
+                    parse_fallback(block[position:match.start() - 1])
+                position = match.end() + 1
+
+                if series is None:
+                    request_url, request_time = match.groups()
+                    if time_first:
+                        request_url, request_time = request_time, request_url
+                else:
+                    request_url, request_time, stamp = match.group(*block_groups)
+                    try:
+                        bucket = cache[stamp]
+                    except KeyError:
+                        bucket = stamp_bucket(stamp)
+                    if bucket is None:
+                        bucket = TimeBuckets.NO_BUCKET
+                request_url = request_url.decode('utf-8', 'replace')
+                if request_time == b'-':
+                    request_time = 0
+                else:
+                    try:
+                        request_time = round(float(request_time) * 1000000)
+                    except ValueError:
+                        mismatch_count += 1
+                        self.check_mismatch_counts(mismatch_count, mismatch_count + total_matched_count)
+                        continue
+
+                if normalize_url:
+                    request_url = normalize_url(request_url)
+                total_matched_count += 1
+                total_time += request_time
+                url_id = url_ids.get(request_url)
+                if url_id is None:
+                    url_id = stat.url_id(request_url)
+                try:
+                    samples[url_id].append(request_time)
+                except OverflowError:
+                    stat.widen(url_id).append(request_time)
+                if series is not None:
+                    if series_exact:
+                        series[url_id].append(bucket)
+                    else:
+                        add_series(url_id, bucket, request_time)
+                counts[url_id] += 1
+                sums[url_id] += request_time
+                if request_time > maxs[url_id]:
+                    maxs[url_id] = request_time
+
+            if position < len(block):
+                parse_fallback(block[position:-1] if block.endswith(b'\n') else block[position:])
+
+        stat.total_count = total_matched_count + mismatch_count
+        stat.matched_count = total_matched_count
+        stat.mismatch_count = mismatch_count
+        stat.total_time = total_time
+        return stat
+
+    def parse_range(self, file_name: str, start: int = 0, end: int = None) -> LogStat:
+        """Разбирает диапазон байт [start, end) несжатого лога (end=None - до конца файла)."""
+        if self.sample_rate < 1:
+            stat = self.parse_range_sampled(file_name, start, end)
+            if self.run_stats:
+                self.run_stats.count_stat(stat)
+            return stat
+        if self.run_stats:
+            return self.parse_range_timed(file_name, start, end)
+        if self.block_parsing:
+            return self.aggregate_blocks(self.read_blocks_gen(file_name, self.read_buffer_size, start, end,
+                                                              self.decompress_backend))
+        return self.aggregate(self.read_log_gen(file_name, start, end))
+
+    def parse_shard(self, file_name: str, start: int, end: int) -> LogStat:
+        """parse_range в процессе пула parse_log: промахи не проверяются по счетчикам одного диапазона,
+        доля промахов проверяется только по слитой статистике всех диапазонов.
+        """
+        self.shard = True
+        return self.parse_range(file_name, start, end)
+
+    def parse_range_sampled(self, file_name: str, start: int = 0, end: int = None) -> LogStat:
+        """parse_range по выборке около sample_rate строк (sample_mode).
+
+        block - читаются только участки несжатого лога (read_sample_blocks_gen), gz - как line;
+        line - разбираются строки с crc32 меньше sample_rate * 2^32;
+        url - разбираются все строки, в статистику попадают url с crc32 меньше порога
+        (total_count, matched_count и total_time - по всем строкам, поэтому count_percentage
+        и time_percent url совпадают с полным отчетом, а их сумма по выбранным url меньше 100).
+        """
+        threshold = int(self.sample_rate * 2 ** 32)
+        bytes_mode = self.read_mode == 'bytes'
+        if self.sample_mode == 'block' and not file_name.endswith('.gz'):
+            blocks = self.read_sample_blocks_gen(file_name, self.sample_rate, self.sample_block_size, start, end)
+            if self.block_parsing:
+                return self.aggregate_blocks(blocks)
+            lines = self.split_lines_gen(blocks)
+            return self.aggregate(lines if bytes_mode else (line.decode('utf-8') + '\n' for line in lines))
+
+        lines = self.read_log_gen(file_name, start, end)
+        if self.sample_mode != 'url':
+            if bytes_mode:
+                return self.aggregate(line for line in lines if zlib.crc32(line) < threshold)
+            return self.aggregate(line for line in lines
+                                  if zlib.crc32(line.rstrip('\n').encode('utf-8')) < threshold)
+
+        skipped = self.new_stat(series=False)
+
+        def sampled_gen(parsed_lines):
+            for parsed_line in parsed_lines:
+                if parsed_line and zlib.crc32(parsed_line[0].encode('utf-8')) >= threshold:
+                    skipped.matched_count += 1
+                    skipped.total_time += parsed_line[1]
+                else:
+                    yield parsed_line
+
+        stat = self.aggregate_parsed(sampled_gen(map(self.line_parser(), lines)))
+        stat.total_count += skipped.matched_count
+        stat.matched_count += skipped.matched_count
+        stat.total_time += skipped.total_time
+        return stat
+
+    def parse_range_timed(self, file_name: str, start: int = 0, end: int = None, chunk_lines: int = 65536) -> LogStat:
+        """parse_range с замером этапов read, parse и aggregate в run_stats.
+
+        Строки читаются пачками по chunk_lines (read), пачка разбирается parse_line (parse)
+        и добавляется в статистику (aggregate). В режиме bytes с log_format разбор
+        и агрегация блока неразделимы и учитываются как parse.
+        """
+        run_stats = self.run_stats
+        run_stats.counters['bytes'] += (os.path.getsize(file_name) if end is None else end) - start
+
+        if self.block_parsing:
+            blocks = self.read_blocks_gen(file_name, self.read_buffer_size, start, end, self.decompress_backend)
+            with run_stats.stage('parse'):
+                stat = self.aggregate_blocks(run_stats.timed_gen(blocks, 'read'))
+        else:
+            stat = self.new_stat()
+            parse_line = self.line_parser()
+            lines = iter(self.read_log_gen(file_name, start, end))
+            while True:
+                with run_stats.stage('read'):
+                    chunk = list(itertools.islice(lines, chunk_lines))
+                if not chunk:
+                    break
+                with run_stats.stage('parse'):
+                    parsed_lines = list(map(parse_line, chunk))
+                with run_stats.stage('aggregate'):
+                    self.aggregate_parsed(parsed_lines, stat)
+
+        run_stats.count_stat(stat)
+        return stat
+
+    def parse_log(self, file_name: str, start: int = 0, end: int = None) -> LogStat:
+        """Разбирает лог целиком или диапазон байт [start, end) несжатого лога.
+
+        Несжатый лог при workers > 1 делится на диапазоны по границам строк,
+        каждый диапазон разбирается в отдельном процессе.
+        Лог целиком при columnar_cache (без выборки sample_rate и временного ряда) разбирается
+        через columns файл (parse_log_columnar).
+        """
+        if self.columnar_cache and self.sample_rate == 1 and not self.series_seconds and start == 0 and end is None:
+            return self.parse_log_columnar(file_name)
+        if self.workers < 2 or file_name.endswith('.gz'):
+            return self.parse_range(file_name, start, end)
+
+        shards = self.split_file(file_name, self.workers, start, end)
+        self.root_logger.debug('Parse {} in {} shards by {} workers'.format(file_name, len(shards),
+                                                                            self.workers))
+        with multiprocessing.Pool(min(self.workers, len(shards))) as pool:
+            partials = pool.starmap(self.parse_shard, [(file_name, start, end) for start, end in shards])
+
+        stat = self.new_stat()
+        for partial in partials:
+            stat.merge(partial)
+        if self.run_stats:
+            self.run_stats.counters['bytes'] += (os.path.getsize(file_name) if end is None else end) - start
+            self.run_stats.count_stat(stat)
+        self.check_mismatch(stat)
+        return stat
+
+    @property
+    def stat_fingerprint(self) -> str:
+        """Настройки, от которых зависит содержимое LogStat - сохраненная статистика с другими не сливается."""
+        log_format = self.log_format_parser.log_format if self.log_format_parser else ''
+        url_normalize = [(pattern.pattern, replacement) for pattern, replacement in self.url_normalize]
+        return json.dumps([self.web_server_re.pattern, log_format, self.quantile_accuracy,
+                           self.heavy_hitters, self.heavy_hitters_key, url_normalize,
+                           self.sample_rate, self.sample_mode, self.sample_block_size, self.series_seconds])
+
+    def checkpoint_path(self, log_file: str) -> str:
+        """Файл checkpoint для лога log_file."""
+        return os.path.join(self.checkpoint_dir, os.path.basename(log_file) + '.checkpoint')
+
+    def load_checkpoint(self, log_file: str):
+        """Читает checkpoint лога, None - checkpoint нет, он не читается или сохранен с другими настройками."""
+        checkpoint_path = self.checkpoint_path(log_file)
+        if not os.path.exists(checkpoint_path):
+            return None
+
+        try:
+            with open(checkpoint_path, 'rb') as checkpoint_f:
+                checkpoint = json.load(checkpoint_f)
+            if (checkpoint.get('fingerprint'), checkpoint.get('byteorder')) != (self.stat_fingerprint, sys.byteorder):
+                self.root_logger.info('Checkpoint {} was made with other settings, ignored'.format(checkpoint_path))
+                return None
+            checkpoint['stat'] = LogStat.from_dict(checkpoint['stat'])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as error:
+            self.root_logger.info('Checkpoint {} is broken, ignored: {!r}'.format(checkpoint_path, error))
+            return None
+        return checkpoint
+
+    def save_checkpoint(self, log_file: str, checkpoint: dict):
+        """Атомарно сохраняет checkpoint лога в JSON, статистика - LogStat.to_dict."""
+        checkpoint = dict(checkpoint, stat=checkpoint['stat'].to_dict(), fingerprint=self.stat_fingerprint,
+                          byteorder=sys.byteorder)
+        self.save_atomic(self.checkpoint_path(log_file), json.dumps(checkpoint).encode('utf-8'))
+
+    columns_magic = b'LACOLS2\n'
+
+    @property
+    def parser_fingerprint(self) -> str:
+        """Настройки разбора строк - от них зависят сырые записи в columns файле."""
+        log_format = self.log_format_parser.log_format if self.log_format_parser else ''
+        return json.dumps([self.web_server_re.pattern, log_format])
+
+    def columns_path(self, log_file: str) -> str:
+        """Columns файл (разобранные записи) для лога log_file."""
+        return os.path.join(self.checkpoint_dir, os.path.basename(log_file) + '.columns')
+
+    def save_columns(self, log_file: str, stat: LogStat):
+        """Атомарно сохраняет записи лога из точного LogStat (все url, выборки - array) в columns файл.
+
+        Формат: columns_magic, длина заголовка (struct <I), JSON заголовок и секции, выровненные на 8 байт:
+            url_offsets: int64 смещения url в секции urls (число url + 1),
+            urls: словарь url в порядке id (utf-8 подряд, url может содержать \\n),
+            url_id: int32 id url по записям, записи сгруппированы по url в порядке появления,
+            request_time: время обработки по записям, мкс (int32, int64 - если не помещается).
+        В заголовке - размер, mtime и контрольная сумма начала лога для проверки актуальности.
+        """
+        time_typecode = 'i' if all(samples.typecode == 'i' for samples in stat.samples) else 'q'
+        url_id_column, time_column = array.array('i'), array.array(time_typecode)
+        for url_id, samples in enumerate(stat.samples):
+            url_id_column.extend(array.array('i', [url_id]) * len(samples))
+            time_column.extend(samples if samples.typecode == time_typecode else array.array(time_typecode, samples))
+
+        url_data = [url.encode('utf-8') for url in stat.urls]
+        url_offsets = array.array('q', [0])
+        for url_bytes in url_data:
+            url_offsets.append(url_offsets[-1] + len(url_bytes))
+        sections = [('url_offsets', url_offsets), ('urls', b''.join(url_data)), ('url_id', url_id_column),
+                    ('request_time', time_column)]
+        file_stat = os.stat(log_file)
+        header = {'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns, 'head_crc': self.head_crc(log_file),
+                  'fingerprint': self.parser_fingerprint, 'byteorder': sys.byteorder,
+                  'total_count': stat.total_count, 'mismatch_count': stat.mismatch_count,
+                  'urls': len(stat.urls), 'records': len(time_column), 'time_typecode': time_typecode,
+                  'sections': {}}
+        offset = 0
+        for name, data in sections:
+            size = len(data) * getattr(data, 'itemsize', 1)
+            header['sections'][name] = [offset, size]
+            offset += size + -size % 8
+        header_data = json.dumps(header).encode('utf-8')
+        header_data += b' ' * (-(len(self.columns_magic) + 4 + len(header_data)) % 8)
+
+        data = bytearray(self.columns_magic)
+        data += struct.pack('<I', len(header_data)) + header_data
+        for name, section in sections:
+            data += section
+            data += b'\0' * (-len(data) % 8)
+        self.save_atomic(self.columns_path(log_file), data)
+
+    def load_columns(self, log_file: str):
+        """Загружает записи лога из columns файла через mmap.
+
+        Возвращает (заголовок, urls, url_id, request_time) - столбцы как memoryview копий секций
+        (mmap закрывается сразу после чтения), None - файла нет, он устарел (изменились размер,
+        mtime или начало лога), сохранен с другими настройками разбора или не читается (битый файл).
+        """
+        columns_path = self.columns_path(log_file)
+        if not os.path.exists(columns_path):
+            return None
+
+        try:
+            with open(columns_path, 'rb') as columns_f:
+                if columns_f.read(len(self.columns_magic)) != self.columns_magic:
+                    return None
+                header_size, = struct.unpack('<I', columns_f.read(4))
+                header = json.loads(columns_f.read(header_size).decode('utf-8'))
+                file_stat = os.stat(log_file)
+                if (header['size'], header['mtime_ns'], header['fingerprint'], header['byteorder']) != \
+                        (file_stat.st_size, file_stat.st_mtime_ns, self.parser_fingerprint, sys.byteorder) \
+                        or header['head_crc'] != self.head_crc(log_file):
+                    self.root_logger.info('Columns {} are out of date, ignored'.format(columns_path))
+                    return None
+                base = len(self.columns_magic) + 4 + header_size
+                with mmap.mmap(columns_f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    sections = {name: data[base + offset:base + offset + size]
+                                for name, (offset, size) in header['sections'].items()}
+            if any(len(sections[name]) != size for name, (__, size) in header['sections'].items()):
+                raise ValueError('section is out of the file')
+            url_offsets, url_data = memoryview(sections['url_offsets']).cast('q'), sections['urls']
+            urls = [url_data[start:end].decode('utf-8') for start, end in zip(url_offsets, url_offsets[1:])]
+            return (header, urls, memoryview(sections['url_id']).cast('i'),
+                    memoryview(sections['request_time']).cast(header['time_typecode']))
+        except (OSError, ValueError, KeyError, TypeError, struct.error) as error:
+            self.root_logger.info('Columns {} are broken, ignored: {!r}'.format(columns_path, error))
+            return None
+
+    def stat_from_columns(self, columns) -> LogStat:
+        """Собирает статистику по записям columns файла без разбора строк.
+
+        В точном режиме без нормализации url и heavy hitters выборка url - срез
+        столбца request_time; иначе записи проходят aggregate_parsed, url
+        нормализуются один раз на url словаря. С numpy report_backend границы
+        срезов, суммы и максимумы считаются bincount и reduceat по столбцам.
+        """
+        header, urls, url_id_column, time_column = columns
+        if self.quantile_accuracy or self.heavy_hitters or self.url_normalize:
+            urls = [self.normalize_url(url) for url in urls] if self.url_normalize else urls
+            stat = self.aggregate_parsed(zip(map(urls.__getitem__, url_id_column), time_column))
+        else:
+            stat = LogStat()
+            stat.urls = urls
+            stat.url_ids = {url: url_id for url_id, url in enumerate(urls)}
+            time_bytes = time_column.cast('B')
+            itemsize = time_column.itemsize
+            vectorized = self.report_backend == 'numpy' and urls
+            if vectorized:
+                times = numpy.frombuffer(time_column, dtype='i{}'.format(itemsize))
+                counts = numpy.bincount(numpy.frombuffer(url_id_column, dtype='i4'), minlength=len(urls))
+                starts = numpy.cumsum(counts) - counts
+                stat.counts = array.array('l', counts.tolist())
+                stat.sums = array.array('q', numpy.add.reduceat(times.astype(numpy.int64), starts).tolist())
+                stat.maxs = array.array('l', numpy.maximum.reduceat(times, starts).tolist())
+                bounds = zip(starts.tolist(), (starts + counts).tolist())
+            else:
+                bounds = []
+                start = 0
+                for url_id in range(len(urls)):
+                    end = bisect.bisect_right(url_id_column, url_id, start)
+                    bounds.append((start, end))
+                    start = end
+            for start, end in bounds:
+                samples = array.array(header['time_typecode'])
+                samples.frombytes(time_bytes[start * itemsize:end * itemsize])
+                if samples.typecode != 'i':
+                    samples = array.array('l', samples)
+                stat.samples.append(samples)
+            if not vectorized:
+                stat.counts = array.array('l', map(len, stat.samples))
+                stat.sums = array.array('q', map(sum, stat.samples))
+                stat.maxs = array.array('l', map(max, stat.samples))
+            stat.matched_count = header['records']
+            stat.total_time = sum(stat.sums)
+        stat.total_count = header['total_count']
+        stat.mismatch_count = header['mismatch_count']
+        return stat
+
+    def parse_log_columnar(self, file_name: str) -> LogStat:
+        """Разбирает лог целиком через columns файл.
+
+        Если актуального columns файла нет - лог разбирается в точном режиме
+        без нормализации url и heavy hitters, записи сохраняются в columns файл.
+        Следующие запуски (в том числе с другими report_size, рейтингами,
+        quantile_mode, url_normalize, heavy_hitters) строят статистику по нему.
+        """
+        columns = self.load_columns(file_name)
+        if columns is None:
+            raw_analyzer = copy.copy(self)
+            raw_analyzer.run_stats = self.run_stats
+            raw_analyzer.columnar_cache = False
+            raw_analyzer.quantile_accuracy = None
+            raw_analyzer.heavy_hitters = 0
+            raw_analyzer.url_normalize = []
+            stat = raw_analyzer.parse_log(file_name)
+            self.save_columns(file_name, stat)
+            self.root_logger.info('Columns of {} saved to {}'.format(file_name, self.columns_path(file_name)))
+            if raw_analyzer.stat_fingerprint == self.stat_fingerprint:
+                return stat
+            columns = self.load_columns(file_name)
+        else:
+            self.root_logger.info('Load {} from {}'.format(file_name, self.columns_path(file_name)))
+
+        stat = self.stat_from_columns(columns)
+        if self.run_stats:
+            self.run_stats.count_stat(stat)
+        self.check_mismatch(stat)
+        return stat
+
+    def parse_log_incremental(self, log_file: str) -> LogStat:
+        """Разбирает лог, продолжая с позиции из checkpoint.
+
+        Несжатый лог дочитывается с сохраненной позиции до конца последней
+        полной строки. Если сменился inode, файл стал короче позиции или
+        изменилось начало файла (ротация, truncate) - лог разбирается заново.
+        Файл того же размера, что при сохранении checkpoint, но с другим mtime_ns
+        (перезапись на месте) тоже разбирается заново.
+        gzip лог не дочитывается: при неизменных размере и mtime_ns статистика
+        берется из checkpoint, иначе файл разбирается целиком.
+        """
+        file_stat = os.stat(log_file)
+        is_gzip = log_file.endswith('.gz')
+        checkpoint = self.load_checkpoint(log_file)
+
+        if checkpoint and checkpoint['inode'] == file_stat.st_ino and checkpoint['offset'] <= file_stat.st_size \
+                and checkpoint['head_crc'] == self.head_crc(log_file, checkpoint['head_size']):
+            if (is_gzip or checkpoint['size'] == file_stat.st_size) \
+                    and (checkpoint['size'], checkpoint.get('mtime_ns')) != (file_stat.st_size, file_stat.st_mtime_ns):
+                self.root_logger.info('Log {} was changed in place, parse from the beginning'.format(log_file))
+                checkpoint = None
+        elif checkpoint:
+            self.root_logger.info('Log {} was rotated or truncated, parse from the beginning'.format(log_file))
+            checkpoint = None
+
+        stat, start = (checkpoint['stat'], checkpoint['offset']) if checkpoint else (None, 0)
+        end = file_stat.st_size if is_gzip else self.last_line_end(log_file, file_stat.st_size)
+
+        if stat is not None and end == start:
+            self.root_logger.info('No new lines in {} since the checkpoint'.format(log_file))
+            return stat
+
+        self.root_logger.info('Parse {} bytes [{}, {})'.format(log_file, start, end))
+        partial = self.parse_log(log_file, start, None if is_gzip else end)
+        stat = stat.merge(partial) if stat else partial
+        self.check_mismatch(stat)
+
+        head_size = min(end, 4096)
+        self.save_checkpoint(log_file, {'offset': end, 'inode': file_stat.st_ino, 'size': file_stat.st_size,
+                                        'mtime_ns': file_stat.st_mtime_ns, 'head_size': head_size,
+                                        'head_crc': self.head_crc(log_file, head_size), 'stat': stat})
+        return stat
+
+    def start(self, date_from: datetime.date = None, date_to: datetime.date = None):
+        """Интерфейс для запуска Analyzer.
+
+        Если задан date_from или date_to - отчет строится по всем логам интервала.
+        """
+        self.root_logger.info('Analyzer begin to work. Unix time: {}'.format(self._ts_time))
+        self.run_stats = RunStats() if self.run_summary or self.profile or self.prometheus_textfile else None
+        profiler = cProfile.Profile() if self.profile else None
+
+        with self.stage('discovery'):
+            if date_from or date_to:
+                logs = self.logs_in_range(date_from, date_to)
+                self.max_log_date = logs[-1][0]
+                report_file_name = self.range_report_file_name(date_from or logs[0][0], date_to or logs[-1][0])
+            else:
+                latest_log = self.latest_log
+                report_file_name = self.report_file_name
+        with self.stage('validate'):
+            for log_file in ([log_file for __, log_file in logs] if date_from or date_to else [latest_log]):
+                self.validate_log(log_file)
+
+        if profiler:
+            profiler.enable()
+        with self.stage('parse'):
+            if date_from or date_to:
+                log_stats = [] if self.history_path else None
+                stat = self.parse_logs([log_file for __, log_file in logs], log_stats)
+            else:
+                stat = self.parse_log_incremental(latest_log) if self.incremental else self.parse_log(latest_log)
+        if profiler:
+            profiler.disable()
+            self.save_profile(profiler)
+
+        if stat.matched_count == 0 or stat.total_time == 0:
             raise AssertionError('No match during parser work. Something goes wrong.')
 
-        log_report = self.make_report(log_stat, total_matched_count, total_time, self.report_size)  # noqa
-        self.save_report(log_report, report_file_name)
+        with self.stage('report'):
+            log_report = self.make_reports(stat)
+        with self.stage('write'):
+            self.save_report(log_report, report_file_name)
+        if self.history_path:
+            with self.stage('history'):
+                if date_from or date_to:
+                    for (log_date, __), log_stat in zip(logs, log_stats):
+                        self.save_history(log_date, log_stat)
+                else:
+                    self.save_history(self.max_log_date, stat)
+        if self.run_stats:
+            self.run_stats.counters['urls'] = len(stat)
+            summary = self.run_stats.summary()
+            if self.run_summary or self.profile:
+                self.save_run_summary(summary)
+            if self.prometheus_textfile:
+                self.save_prometheus(summary)
         logging.info('Log parsed successfully')
         return report_file_name
 
+    def stage(self, name: str):
+        """Замер этапа name в run_stats (если замер выключен - пустой контекст)."""
+        return self.run_stats.stage(name) if self.run_stats else contextlib.nullcontext()
+
+    @property
+    def summary_path(self) -> str:
+        """JSON с итогами запуска: рядом с ts_f_path или, если он не задан, в report_dir."""
+        if self.ts_f_path:
+            return os.path.splitext(self.ts_f_path)[0] + '.summary.json'
+        return os.path.join(self.report_dir, 'log_analyzer.summary.json')
+
+    def save_run_summary(self, summary: dict):
+        """Выводит итоги запуска (RunStats.summary) в лог и атомарно перезаписывает summary_path."""
+        for name, times in summary['stages'].items():
+            self.root_logger.info('Stage {}: wall {:.3f} sec, cpu {:.3f} sec'.format(name, times['wall'],
+                                                                                   times['cpu']))
+        self.root_logger.info('Run summary: {} lines, {} bytes, {} lines/sec, {} bytes/sec, mismatch {} ({}), '
+                              'peak RSS {} KB, tracemalloc peak {} KB'.format(
+                                  summary['counters'].get('lines', 0), summary['counters'].get('bytes', 0),
+                                  summary['lines_per_sec'], summary['bytes_per_sec'],
+                                  summary['counters'].get('mismatch', 0), summary['mismatch_ratio'],
+                                  summary['peak_rss_kb'], summary['tracemalloc_peak_kb']))
+        self.save_atomic(self.summary_path, json.dumps(summary, sort_keys=True, indent=2).encode('utf-8'))
+
+    def save_prometheus(self, summary: dict, mode: str = 'batch'):
+        """Атомарно перезаписывает prometheus_textfile метриками запуска (RunStats.summary).
+
+        Формат - text exposition для textfile collector node_exporter, все метрики - gauge
+        с меткой mode (batch - обычный запуск, follow - режим --follow). Временный файл
+        начинается с точки и не имеет расширения .prom, поэтому collector его не читает.
+        """
+        counters = summary['counters']
+        peak_rss_kb = summary['peak_rss_kb']
+        metrics = [
+            ('run_duration_seconds', 'Duration of the run', summary['duration']),
+            ('lines_processed', 'Log lines parsed in the run', counters.get('lines', 0)),
+            ('lines_mismatched', 'Log lines not matched by the parser', counters.get('mismatch', 0)),
+            ('mismatch_ratio', 'Share of log lines not matched by the parser', summary['mismatch_ratio']),
+            ('bytes_read', 'Log bytes read in the run (compressed for gz)', counters.get('bytes', 0)),
+            ('urls', 'Distinct urls in the report', counters.get('urls', 0)),
+            ('lines_per_second', 'Parse throughput', summary['lines_per_sec']),
+            ('bytes_per_second', 'Read throughput', summary['bytes_per_sec']),
+            ('peak_rss_bytes', 'Peak resident set size of the process', peak_rss_kb and peak_rss_kb * 1024),
+            ('last_success_timestamp_seconds', 'Unix time of the last successful run', round(time.time(), 3)),
+        ]
+
+        lines = []
+        for name, description, value in metrics:
+            if value is None:
+                continue
+            lines.extend(['# HELP log_analyzer_{} {}.'.format(name, description),
+                          '# TYPE log_analyzer_{} gauge'.format(name),
+                          'log_analyzer_{}{{mode="{}"}} {}'.format(name, mode, value)])
+        lines.extend(['# HELP log_analyzer_stage_seconds Time spent in the run stage.',
+                      '# TYPE log_analyzer_stage_seconds gauge'])
+        for stage, times in summary['stages'].items():
+            for clock, value in sorted(times.items()):
+                lines.append('log_analyzer_stage_seconds{{mode="{}",stage="{}",clock="{}"}} {}'.format(
+                    mode, stage, clock, value))
+        self.save_atomic(self.prometheus_textfile, ('\n'.join(lines) + '\n').encode('utf-8'))
+
+    def save_profile(self, profiler: cProfile.Profile, top: int = 20):
+        """Сохраняет статистику cProfile рядом с summary_path (.prof) и выводит top функций в лог."""
+        profile_path = os.path.splitext(self.summary_path)[0] + '.prof'
+        profiler.dump_stats(profile_path)
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(top)
+        self.root_logger.info('Profile saved: {}\n{}'.format(profile_path, output.getvalue()))
+
     def stop(self):
         """Фиксирует время успешного завершения работы Analyzer."""
         ts_time = self._ts_time_str
@@ -788,14 +4881,211 @@ class Analyzer(Utils):
 
         if self.ts_f_path:
             self.root_logger.info('TS file: {}'.format(self.ts_f_path))
-            self.save_text_file(self.ts_f_path, ts_time)
+            self.save_text_file(self.ts_f_path, ts_time, overwrite=self.incremental)
+
+    def live_report_file_name(self, window: int) -> str:
+        """Имя файла отчета режима follow за окно window минут."""
+        return os.path.join(self.report_dir, 'report-live-{}m.html'.format(window))
+
+    def follow_lines(self, lines, window_stat: WindowStat, now: float):
+        """Учитывает новые строки активного лога в интервале окна, в который попадает now."""
+        stat = window_stat.bucket(now)
+        mismatch_count = 0
+        for line in lines:
+            parsed_line = self.parse_bytes_line(line)
+            if parsed_line:
+                stat.add(*parsed_line)
+            else:
+                mismatch_count += 1
+        stat.total_count += len(lines)
+        stat.mismatch_count += mismatch_count
+
+        if self.run_stats:
+            self.run_stats.counters['lines'] += len(lines)
+            self.run_stats.counters['matched'] += len(lines) - mismatch_count
+            self.run_stats.counters['mismatch'] += mismatch_count
+            self.run_stats.counters['bytes'] += sum(map(len, lines)) + len(lines)
+
+    def render_windows(self, window_stat: WindowStat, now: float, server: ReportServer = None) -> list:
+        """Атомарно перезаписывает отчеты по окнам follow_windows, возвращает имена файлов отчетов.
+
+        Статистика окон публикуется в server (окно N минут - как "Nm").
+        """
+        report_files = []
+        for window in self.follow_windows:
+            stat = window_stat.stat(window * 60, now)
+            if server:
+                server.publish('{}m'.format(window), stat)
+            try:
+                self.check_mismatch(stat)
+            except AssertionError as error_msg:
+                self.root_logger.warning('Window {}m: {}'.format(window, error_msg))
+            if stat.matched_count == 0 or stat.total_time == 0:
+                continue
+            report_data = self.make_reports(stat)
+            for sink, sink_path in self.report_sink_paths(self.live_report_file_name(window)):
+                sink.save(report_data, sink_path)
+                report_files.append(sink_path)
+            if self.run_stats:
+                self.run_stats.counters['urls'] = len(stat)
+
+        if self.prometheus_textfile and self.run_stats:
+            self.save_prometheus(self.run_stats.summary(), mode='follow')
+        return report_files
+
+    def follow(self, stop: threading.Event = None, poll_interval: float = 1.0):
+        """Режим follow: разбирает строки, дописываемые в follow_log_path, до установки stop.
+
+        Статистика собирается в скользящем окне (WindowStat) по времени поступления строк,
+        каждые follow_interval секунд отчеты по окнам follow_windows перезаписываются
+        и, если задан server_port, публикуются в HTTP сервере, если задан prometheus_textfile -
+        перезаписываются метрики (счетчики - с начала режима follow).
+        Работа пропорциональна количеству новых строк, а не размеру файла.
+        """
+        if not self.follow_log_path:
+            raise AssertionError('FOLLOW_LOG_PATH is not set.')
+        stop = stop or threading.Event()
+        server = None
+        if self.server_port:
+            server = ReportServer(self, self.server_host, self.server_port)
+            server.start()
+            self.root_logger.info('Report server: http://{}:{}/top'.format(server.host, server.port))
+        follower = LogFollower(self.follow_log_path, self.read_buffer_size)
+        window_stat = WindowStat(max(self.follow_windows) * 60, accuracy=self.quantile_accuracy,
+                                 new_stat=functools.partial(self.new_stat, series=False))
+        next_render = time.time() + self.follow_interval
+        self.run_stats = RunStats() if self.prometheus_textfile else None
+        self.root_logger.info('Follow {}'.format(self.follow_log_path))
 
-    def run(self):  # pragma: no cover
+        try:
+            while not stop.is_set():
+                with self.stage('read'):
+                    lines = follower.read_lines()
+                now = time.time()
+                with self.stage('parse'):
+                    self.follow_lines(lines, window_stat, now)
+                if now >= next_render:
+                    self.render_windows(window_stat, now, server)
+                    next_render = now + self.follow_interval
+                if not lines:
+                    stop.wait(poll_interval)
+        finally:
+            follower.close()
+            if server:
+                server.stop()
+
+    def run(self, date_from: datetime.date = None, date_to: datetime.date = None):  # pragma: no cover
         """Запускает и останавливает Analyzer."""
-        self.start()
+        self.start(date_from, date_to)
         self.stop()
 
 
+class BatchRunner:
+    """Пакетный запуск Analyzer по конфигам нескольких виртуальных хостов (tenant) в пуле процессов.
+
+    Каждый tenant получает свои, не синглтон, Config, Logging и Analyzer (классы под
+    singleton_decorator доступны как __wrapped__) и свой логгер log_analyzer.<tenant>: при
+    LOGFILE_PATH лог tenant пишется в его файл, иначе в stdout с именем tenant в начале строки.
+    Tenant'ы запускаются по убыванию размера логов (самые долгие начинаются первыми и не
+    остаются одни в конце), каждый - в новом процессе пула; ошибка tenant не прерывает остальные.
+    Пул параллелит tenant'ы, поэтому лог каждого разбирается в одном процессе (workers = 1).
+    """
+
+    def __init__(self, config_files: list, workers: int = None, date_from: str = None, date_to: str = None):
+        assert (isinstance(config_files, list) and config_files)
+        assert (len(set(config_files)) == len(config_files)), 'Batch config files are not unique.'
+        self.config_files = config_files
+        self.workers = workers or os.cpu_count() or 1
+        self.date_from = date_from
+        self.date_to = date_to
+
+    @staticmethod
+    def tenant_name(config_file: str) -> str:
+        """Имя tenant - путь конфига без расширения."""
+        return os.path.splitext(os.path.normpath(config_file))[0]
+
+    @staticmethod
+    def date_range(config: Config, date_from: str = None, date_to: str = None) -> tuple:
+        """Интервал дат --from/--to в формате DATE_FMT конфига tenant."""
+        return (Utils.str_to_date(date_from, config.date_fmt) if date_from else None,
+                Utils.str_to_date(date_to, config.date_fmt) if date_to else None)
+
+    def tenant_size(self, config_file: str) -> int:
+        """Размер логов, которые разберет tenant, байт - только для порядка запуска.
+
+        Логи ищутся по Config просмотром LOG_DIR (Utils.scan_logs) без Analyzer: каталог логов
+        не строится и не сохраняется, TS_F_PATH не проверяется. Если конфиг не читается или логов нет -
+        размер 0, причина пишется в лог log_analyzer.batch (ошибку tenant покажет его запуск).
+        """
+        try:
+            config = Config.__wrapped__()
+            config.load(config_file, exclude=('ts_f_path',))
+            date_from, date_to = self.date_range(config, self.date_from, self.date_to)
+            min_log_date = Utils.str_to_date(config.min_log_date, config.date_fmt)
+            __, logs, __ = Utils.scan_logs(config.log_dir, config.log_dir_recursive, re.compile(config.log_name_pattern),
+                                           re.compile(config.log_name_date_pattern), config.date_fmt)
+        except (AssertionError, ValueError, OSError, re.error) as error:
+            logging.getLogger('log_analyzer.batch').warning('Tenant {} is sized 0: {}'.format(
+                self.tenant_name(config_file), error))
+            return 0
+
+        date_from = max(date_from, min_log_date) if date_from else min_log_date
+        logs = [log_file for log_file in logs if date_from <= log_file.date and (date_to is None or log_file.date <= date_to)]
+        if not (self.date_from or self.date_to):
+            logs = logs[-1:]
+        if not logs:
+            logging.getLogger('log_analyzer.batch').warning('Tenant {} is sized 0: no logs found in {}'.format(
+                self.tenant_name(config_file), config.log_dir))
+        return sum(log_file.size for log_file in logs)
+
+    @classmethod
+    def run_tenant(cls, config_file: str, date_from: str = None, date_to: str = None) -> dict:
+        """Запускает Analyzer tenant, возвращает итог: status 0 - успешно, 1 - ошибка (error)."""
+        started = time.time()
+        result = {'tenant': cls.tenant_name(config_file), 'config': config_file, 'status': 1, 'report': None,
+                  'error': None}
+        log = None
+        try:
+            config = Config.__wrapped__(config_file)
+            if not config.logfile_path:
+                config.logfile_format = '{} {}'.format(result['tenant'].replace('%', '%%'), config.logfile_format)
+            log = Logging.__wrapped__(config.logfile_date_format, config.logfile_format,
+                                      logger_name='log_analyzer.{}'.format(result['tenant']))
+            log.update(config.public_attrs())
+            config.workers = 1
+            analyzer = Analyzer(config=config, log=log)
+            result['report'] = analyzer.start(*cls.date_range(config, date_from, date_to))
+            analyzer.stop()
+            result['status'] = 0
+        except Exception as error:
+            result['error'] = str(error) if isinstance(error, (AssertionError, FileExistsError, ValueError)) \
+                else repr(error)
+            if log:
+                log.critical(result['error'])
+        finally:
+            if log:
+                for handler in list(log.root_logger.handlers):
+                    handler.close()
+                    log.root_logger.removeHandler(handler)
+        result['duration'] = round(time.time() - started, 3)
+        return result
+
+    def run(self) -> dict:
+        """Запускает всех tenant'ов, возвращает общий итог: tenants в порядке конфигов, succeeded, failed."""
+        started = time.time()
+        sizes = {config_file: self.tenant_size(config_file) for config_file in self.config_files}
+        schedule = sorted(self.config_files, key=lambda config_file: -sizes[config_file])
+        with multiprocessing.Pool(min(self.workers, len(schedule)), maxtasksperchild=1) as pool:
+            results = {result['config']: result for result in pool.imap_unordered(
+                functools.partial(self.run_tenant, date_from=self.date_from, date_to=self.date_to),
+                schedule)}
+
+        tenants = [dict(results[config_file], size=sizes[config_file]) for config_file in self.config_files]
+        failed = sum(1 for tenant in tenants if tenant['status'])
+        return {'tenants': tenants, 'succeeded': len(tenants) - failed, 'failed': failed,
+                'duration': round(time.time() - started, 3)}
+
+
 def parse_args():  # pragma: no cover
     """Парсер входных аргументов скрипта."""
     parser = argparse.ArgumentParser()
@@ -803,6 +5093,36 @@ def parse_args():  # pragma: no cover
                         help='Path to configuration file, ex: config.json')
     parser.add_argument('--template', default=False, type=bool,
                         help='Create config template')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Run micro-benchmarks on the latest log instead of report generation')
+    parser.add_argument('--from', dest='date_from', default=None, type=str,
+                        help='Make report on all logs since the date (DATE_FMT), ex: 20170601')
+    parser.add_argument('--to', dest='date_to', default=None, type=str,
+                        help='Make report on all logs until the date (DATE_FMT), ex: 20170630')
+    parser.add_argument('--benchmark-suite', dest='benchmark_suite', action='store_true',
+                        help='Benchmark stages on synthetic logs of BENCHMARK_SIZES lines, compare with BENCHMARK_BASELINE')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile log parsing with cProfile, implies RUN_SUMMARY')
+    parser.add_argument('--follow', action='store_true',
+                        help='Follow FOLLOW_LOG_PATH and rewrite sliding window reports until interrupted')
+    parser.add_argument('--batch', nargs='+', default=None, metavar='CONFIG',
+                        help='Run reports for several configs (virtual hosts) in a process pool, '
+                             'largest logs first; --config is ignored')
+    parser.add_argument('--batch-workers', dest='batch_workers', default=None, type=int,
+                        help='Processes for --batch (default: CPU count)')
+    parser.add_argument('--batch-summary', dest='batch_summary', default=None, type=str,
+                        help='Save the combined --batch summary to the JSON file')
+    parser.add_argument('--history', choices=('trend', 'movers'), default=None,
+                        help='Query HISTORY_PATH instead of log parsing: trend of --url or top movers '
+                             'between the first and the last day in --from/--to')
+    parser.add_argument('--url', default=None, type=str,
+                        help='Url for --history trend')
+    parser.add_argument('--metric', default='time_sum', choices=HistoryStore.METRICS,
+                        help='Metric for --history movers')
+    parser.add_argument('--limit', default=10, type=int,
+                        help='Number of urls for --history movers')
+    parser.add_argument('--history-output', dest='history_output', default='-', type=str,
+                        help='Save the --history result to the JSON file, - for stdout')
     return parser.parse_args()
 
 
@@ -816,12 +5136,57 @@ def main():  # pragma: no cover
         log.info('Configuration file template created.')
         sys.exit(0)
 
+    if args.batch:
+        summary = BatchRunner(args.batch, args.batch_workers, args.date_from, args.date_to).run()
+        for tenant in summary['tenants']:
+            (log.error if tenant['status'] else log.info)('Tenant {}: {} in {} sec, log size {} bytes{}'.format(
+                tenant['tenant'], 'failed' if tenant['status'] else 'ok', tenant['duration'], tenant['size'],
+                ': {}'.format(tenant['error']) if tenant['status'] else ', report {}'.format(tenant['report'])))
+        log.info('Batch: {} succeeded, {} failed in {} sec'.format(summary['succeeded'], summary['failed'],
+                                                                  summary['duration']))
+        if args.batch_summary:
+            Utils.save_atomic(args.batch_summary, json.dumps(summary, indent=2).encode('utf-8'))
+        sys.exit(1 if summary['failed'] else 0)
+
     try:
         user_config = Config(args.config)
         log.update(user_config.public_attrs())
+        date_from = Utils.str_to_date(args.date_from, user_config.date_fmt) if args.date_from else None
+        date_to = Utils.str_to_date(args.date_to, user_config.date_fmt) if args.date_to else None
+        if args.history:
+            history = HistoryStore(user_config.history_path)
+            if args.history == 'trend':
+                assert (args.url), '--history trend requires --url.'
+                result = history.trend(args.url, date_from, date_to)
+            else:
+                result = history.movers(date_from, date_to, args.metric, args.limit)
+            result_json = json.dumps(result, indent=2) + '\n'
+            if args.history_output == '-':
+                # результат запроса - вывод команды, а не сообщение лога
+                sys.stdout.write(result_json)
+            else:
+                Utils.save_atomic(args.history_output, result_json.encode('utf-8'))
+                log.info('History {} saved to {}.'.format(args.history, args.history_output))
+            sys.exit(0)
         analyzer = Analyzer(config=user_config, log=log)
-        analyzer.run()
-    except (AssertionError, FileExistsError) as error_msg:
+        if args.benchmark:
+            Benchmark(analyzer).run(analyzer.latest_log)
+            sys.exit(0)
+        if args.benchmark_suite:
+            with contextlib.ExitStack() as stack:
+                work_dir = user_config.benchmark_dir or stack.enter_context(tempfile.TemporaryDirectory())
+                Benchmark(analyzer).suite(user_config.benchmark_sizes, work_dir,
+                                          user_config.benchmark_baseline, user_config.benchmark_tolerance)
+            sys.exit(0)
+        if args.follow:
+            try:
+                analyzer.follow()
+            except KeyboardInterrupt:
+                log.info('Follow mode stopped.')
+            sys.exit(0)
+        analyzer.profile = args.profile
+        analyzer.run(date_from, date_to)
+    except (AssertionError, FileExistsError, ValueError) as error_msg:
         log.critical(str(error_msg))
         sys.exit(1)
 
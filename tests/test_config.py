@@ -59,6 +59,19 @@ class TestConfig(unittest.TestCase):
         self.assertEqual('$edited_tag', cls.template_replace_tag)
         self.assertTrue(True)
 
+    def test_ts_f_path_exists(self):
+        # существующий TS_F_PATH - ошибка, в инкрементальном режиме (в любом порядке ключей) - перезаписывается
+        with open(self._template_name, 'w') as json_file:
+            json.dump({'TS_F_PATH': self._template_name}, json_file)
+        self.assertRaises(FileExistsError, Config.__wrapped__, self._template_name)
+
+        with open(self._template_name, 'w') as json_file:
+            json.dump({'TS_F_PATH': self._template_name, 'INCREMENTAL': True}, json_file)
+        self.assertEqual(self._template_name, Config.__wrapped__(self._template_name).ts_f_path)
+        cfg = Config.__wrapped__()
+        cfg.load(self._template_name, exclude=('ts_f_path', 'incremental'))
+        self.assertEqual('', cfg.ts_f_path)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,148 @@
+"""Тесты разборщиков строк по nginx log_format и строк JSON, номеров интервалов времени строк."""
+import pickle
+import unittest
+
+from log_analyzer import JsonLineParser, LogFormatParser, TimeBuckets
+
+
+class TestLogFormatParser(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls._line = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 '
+                     '"-" "Lynx/2.8.8dev.9 libwww-FM/2.14" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n')
+
+    def test_parse(self):
+        parser = LogFormatParser('ui_short')
+        self.assertEqual(('/api/v2/banner/25019354', 390000), parser(self._line))
+        self.assertEqual(('/api/v2/banner/25019354', 0), parser(self._line.replace('0.390', '-')))
+
+    def test_parse_binary(self):
+        parser = LogFormatParser('ui_short', binary=True)
+        self.assertEqual(('/api/v2/banner/25019354', 390000), parser(self._line.encode('utf-8')))
+
+    def test_mismatch(self):
+        parser = LogFormatParser('ui_short')
+        self.assertIsNone(parser('garbage'))
+        self.assertIsNone(parser(self._line.replace('0.390', 'abc')))
+        self.assertIsNone(parser(self._line.replace('GET /api/v2/banner/25019354 HTTP/1.1', '-')))
+
+    def test_custom_format(self):
+        parser = LogFormatParser('$remote_addr - [$time_local] "$request" $status ${request_time}s "$http_user_agent"')
+        line = '10.0.0.1 - [29/Jun/2017:03:50:22 +0300] "POST /login HTTP/1.1" 200 1.5s "curl/7.58.0 (x86)"'
+        self.assertEqual(('/login', 1500000), parser(line))
+
+    def test_invalid_format(self):
+        with self.assertRaises(ValueError):
+            LogFormatParser('$remote_addr $status')
+        with self.assertRaises(ValueError):
+            LogFormatParser('$remote_addr $request_time$request $status')
+
+    def test_pickle(self):
+        parser = pickle.loads(pickle.dumps(LogFormatParser('ui_short')))
+        self.assertEqual(('/api/v2/banner/25019354', 390000), parser(self._line))
+
+    def test_stamp_field(self):
+        parser = LogFormatParser('ui_short', binary=True, stamp_field='time_local')
+        line = self._line.encode('utf-8')
+        expected = (b'/api/v2/banner/25019354', b'0.390', b'29/Jun/2017:03:50:22 +0300')
+        self.assertEqual(('/api/v2/banner/25019354', 390000, expected[2]), parser(line))
+        self.assertEqual(expected, parser.block_re.match(line.rstrip()).group(*parser.block_groups))
+        self.assertEqual(parser.stamp_field, pickle.loads(pickle.dumps(parser)).stamp_field)
+        with self.assertRaises(ValueError):
+            LogFormatParser('$remote_addr "$request" $request_time', stamp_field='time_local')
+
+
+class TestJsonLineParser(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls._line = ('{"time_local":"29/Jun/2017:03:50:22 +0300","request":"GET /api/v2/banner/25019354 HTTP/1.1",'
+                     '"status":"200","http_user_agent":"Lynx/2.8.8dev.9","request_time":"0.390"}\n')
+
+    def test_parse(self):
+        parser = JsonLineParser()
+        self.assertEqual(('/api/v2/banner/25019354', 390000), parser(self._line))
+        self.assertEqual(('/api/v2/banner/25019354', 0), parser(self._line.replace('"0.390"', '"-"')))
+        # время числом, пробелы после двоеточия, время до url
+        self.assertEqual(('/api/v2/banner/25019354', 390000), parser(self._line.replace('"0.390"', ' 0.390')))
+        self.assertEqual(('/x', 1500), parser('{"request_time":0.0015, "request": "GET /x HTTP/1.1"}'))
+
+    def test_parse_binary(self):
+        parser = JsonLineParser(binary=True)
+        self.assertEqual(('/api/v2/banner/25019354', 390000), parser(self._line.encode('utf-8')))
+
+    def test_escaped(self):
+        parser = JsonLineParser()
+        line = self._line.replace('/api/v2/banner/25019354', '/search?q=\\"x\\"')
+        self.assertEqual(('/search?q="x"', 390000), parser(line))
+        # экранированные кавычки в других полях не мешают поиску ключей
+        line = self._line.replace('Lynx/2.8.8dev.9', '\\"request\\":\\"GET /fake HTTP/1.1\\"')
+        self.assertEqual(('/api/v2/banner/25019354', 390000), parser(line))
+
+    def test_custom_fields(self):
+        parser = JsonLineParser('uri', 'upstream_time')
+        self.assertEqual(('/login', 1500000), parser('{"uri":"/login","upstream_time":"1.5"}'))
+
+    def test_mismatch(self):
+        parser = JsonLineParser()
+        self.assertIsNone(parser('garbage'))
+        self.assertIsNone(parser(self._line.replace('"0.390"', '"abc"')))
+        self.assertIsNone(parser(self._line.replace('request_time', 'upstream_time')))
+        self.assertIsNone(parser(self._line.replace('GET /api/v2/banner/25019354 HTTP/1.1', '-')))
+
+    def test_pickle(self):
+        parser = pickle.loads(pickle.dumps(JsonLineParser(binary=True)))
+        self.assertEqual(('/api/v2/banner/25019354', 390000), parser(self._line.encode('utf-8')))
+
+
+class TestTimeBuckets(unittest.TestCase):
+
+    def test_parse_stamp(self):
+        # 29.06.2017 03:50:22 +0300 = 00:50:22 UTC
+        self.assertEqual(1498697422, TimeBuckets.parse_stamp('29/Jun/2017:03:50:22 +0300'))
+        self.assertEqual(1498697422, TimeBuckets.parse_stamp('2017-06-29T03:50:22+03:00'))
+        self.assertEqual(1498697422 + 7200, TimeBuckets.parse_stamp('29/Jun/2017:00:20:22 -0230'))
+        for stamp in ('', 'garbage', '29/Foo/2017:03:50:22 +0300', '31/Jun/2017:03:50:22 +0300'):
+            self.assertIsNone(TimeBuckets.parse_stamp(stamp))
+
+    def test_bucket(self):
+        line = '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET / HTTP/1.1" 200 927 0.390\n'
+        minutes = TimeBuckets(60)
+        self.assertEqual(1498697422 // 60, minutes(line))
+        self.assertEqual(1498697422 // 3600, TimeBuckets(3600, binary=True)(line.encode('utf-8')))
+        self.assertIsNone(minutes('garbage'))
+        self.assertIsNone(minutes(line.replace('Jun', 'Foo')))
+
+        # секунды той же минуты считаются без разбора метки
+        seconds = TimeBuckets(1)
+        self.assertEqual(1498697422, seconds(line))
+        self.assertEqual(1498697459, seconds(line.replace(':22 ', ':59 ')))
+        self.assertIsNone(seconds(line.replace(':22 ', ':5x ')))
+        self.assertEqual(1, len(seconds.minutes))
+
+    def test_json_lines(self):
+        buckets = TimeBuckets(60, json_lines=True)
+        self.assertEqual(1498697422 // 60, buckets('{"time_local": "29/Jun/2017:03:50:22 +0300","request":"GET /"}'))
+        self.assertEqual(1498697422 // 60, buckets('{"time_iso8601":"2017-06-29T03:50:22+03:00"}'))
+        self.assertIsNone(buckets('{"request":"GET /"}'))
+
+    def test_make_bucket_parser(self):
+        parse = TimeBuckets(60).make_bucket(LogFormatParser('ui_short'))
+        line = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 '
+                '"-" "Lynx/2.8.8dev.9 libwww-FM/2.14" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" 0.390\n')
+        self.assertEqual(('/api/v2/banner/25019354', 390000, 1498697422 // 60), parse(line))
+        self.assertIsNone(parse('garbage'))
+        # строка разобрана, метка - нет: запрос учитывается без интервала
+        self.assertEqual(('/api/v2/banner/25019354', 390000, TimeBuckets.NO_BUCKET), parse(line.replace('Jun', 'Foo')))
+
+    def test_pickle(self):
+        buckets = TimeBuckets(60, binary=True)
+        buckets(b'[29/Jun/2017:03:50:22 +0300]')
+        restored = pickle.loads(pickle.dumps(buckets))
+        self.assertEqual({}, restored.cache)
+        self.assertEqual(1498697422 // 60, restored(b'[29/Jun/2017:03:50:22 +0300]'))
+
+
+if __name__ == '__main__':
+    unittest.main()
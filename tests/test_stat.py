@@ -0,0 +1,245 @@
+"""Тесты агрегатов статистики."""
+import json
+import random
+import unittest
+
+from log_analyzer import Analyzer, HeavyHitterStat, LogStat, QuantileSketch, WindowStat
+
+
+class TestQuantileSketch(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rnd = random.Random(42)
+        cls._values = [round(rnd.lognormvariate(-1, 1.5), 3) * 1000000 for __ in range(20000)]
+        cls._sorted_values = sorted(cls._values)
+
+    def test_quantile_accuracy(self):
+        sketch = QuantileSketch(0.01)
+        for value in self._values:
+            sketch.append(value)
+
+        self.assertEqual(len(self._values), len(sketch))
+        self.assertEqual(max(self._values), sketch.max)
+        for q in (0.5, 0.9, 0.95, 0.99):
+            exact = Analyzer.exact_quantile(self._sorted_values, q)
+            self.assertLessEqual(abs(sketch.quantile(q) - exact), exact * 0.01 + 1000)
+
+    def test_extend(self):
+        whole, left, right = QuantileSketch(0.01), QuantileSketch(0.01), QuantileSketch(0.01)
+        middle = len(self._values) // 2
+        for value in self._values:
+            whole.append(value)
+        for value in self._values[:middle]:
+            left.append(value)
+        for value in self._values[middle:]:
+            right.append(value)
+        left.extend(right)
+
+        self.assertEqual(whole.buckets, left.buckets)
+        self.assertEqual(whole.quantile(0.99), left.quantile(0.99))
+
+    def test_sum_squares(self):
+        sketch = QuantileSketch(0.01)
+        for value in self._values:
+            sketch.append(value)
+        exact = sum(value * value for value in self._values)
+        self.assertAlmostEqual(exact, sketch.sum_squares(), delta=exact * 0.021)
+
+    def test_max_buckets(self):
+        sketch = QuantileSketch(0.01, max_buckets=16)
+        for value in self._values:
+            sketch.append(value)
+        self.assertLessEqual(len(sketch.buckets), 16)
+        self.assertEqual(len(self._values), sum(sketch.buckets.values()) + sketch.zero_count)
+
+
+class TestLogStat(unittest.TestCase):
+
+    def test_add(self):
+        stat = LogStat()
+        stat.add('/a', 300)
+        stat.add('/b', 100)
+        stat.add('/a', 200)
+        self.assertEqual(['/a', '/b'], stat.urls)
+        self.assertEqual(0, stat.url_id('/a'))
+        self.assertEqual([2, 1], list(stat.counts))
+        self.assertEqual([500, 100], list(stat.sums))
+        self.assertEqual([300, 100], list(stat.maxs))
+        self.assertEqual([300, 200], list(stat.samples[0]))
+        self.assertEqual(3, stat.matched_count)
+        self.assertEqual(600, stat.total_time)
+
+    def test_merge(self):
+        left, right = LogStat(), LogStat()
+        left.add('/a', 1)
+        left.add('/a', 2)
+        right.add('/b', 4)
+        right.add('/a', 3)
+        left.total_count, right.total_count = 2, 3
+        left.merge(right)
+        self.assertEqual([1, 2, 3], list(left.samples[left.url_id('/a')]))
+        self.assertEqual([4], list(left.samples[left.url_id('/b')]))
+        self.assertEqual(3, left.maxs[left.url_id('/a')])
+        self.assertEqual(5, left.total_count)
+        self.assertEqual(10, left.total_time)
+
+    def test_widen(self):
+        left, right = LogStat(), LogStat()
+        left.add('/a', 1)
+        right.add('/a', 2 ** 40)
+        self.assertEqual('i', left.samples[0].typecode)
+        self.assertEqual('l', right.samples[0].typecode)
+        left.merge(right)
+        self.assertEqual([1, 2 ** 40], list(left.samples[0]))
+        self.assertEqual(2 ** 40, left.maxs[0])
+
+    def test_approx_merge(self):
+        left, right = LogStat(0.01), LogStat(0.01)
+        left.add('/a', 1500000)
+        right.add('/a', 500000)
+        left.merge(right)
+        self.assertIsInstance(left.samples[0], QuantileSketch)
+        self.assertEqual(2, left.samples[0].count)
+        self.assertEqual(2, left.counts[0])
+        self.assertEqual(2000000, left.sums[0])
+
+    def test_series(self):
+        left, right = LogStat(series=True), LogStat(series=True)
+        left.add('/a', 1, 10)
+        left.add('/a', 2, 11)
+        right.add('/b', 4, 12)
+        right.add('/a', 3, 11)
+        left.merge(right)
+        self.assertEqual([10, 11, 11], list(left.series[left.url_id('/a')]))
+        self.assertEqual([12], list(left.series[left.url_id('/b')]))
+
+        left, right = LogStat(0.01, True), LogStat(0.01, True)
+        left.add('/a', 1500000, 10)
+        right.add('/a', 500000, 10)
+        right.add('/a', 700000, 11)
+        left.merge(right)
+        self.assertEqual([10, 11], sorted(left.series[0]))
+        self.assertEqual((2, 2000000, 1500000), (left.series[0][10].count, left.series[0][10].sum,
+                                                 left.series[0][10].max))
+        self.assertEqual(1, right.series[0][10].count)
+
+        # агрегат без ряда при слиянии отключает ряд
+        left.merge(LogStat(0.01))
+        self.assertIsNone(left.series)
+
+    def test_to_dict(self):
+        stat = LogStat(series=True)
+        stat.add('/a', 1000, 10)
+        stat.add('/b', 2 ** 40, 11)
+        stat.widen(1)
+        stat.mismatch_count = 3
+        restored = LogStat.from_dict(json.loads(json.dumps(stat.to_dict())))
+        self.assertEqual(stat.__dict__, restored.__dict__)
+
+        stat = LogStat(0.01, True)
+        stat.add('/a', 1500000, 10)
+        stat.add('/a', 500, 11)
+        restored = LogStat.from_dict(json.loads(json.dumps(stat.to_dict())))
+        self.assertEqual(stat.samples[0].__dict__, restored.samples[0].__dict__)
+        self.assertEqual({bucket: sketch.__dict__ for bucket, sketch in stat.series[0].items()},
+                         {bucket: sketch.__dict__ for bucket, sketch in restored.series[0].items()})
+        self.assertEqual((stat.total_time, stat.urls), (restored.total_time, restored.urls))
+
+
+class TestHeavyHitterStat(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rnd = random.Random(42)
+        cls._requests = [('/url/{}'.format(int(rnd.paretovariate(1.0))), rnd.randint(1000, 100000))
+                         for __ in range(50000)]
+
+    def assert_bounds(self, stat, requests):
+        true_weights, total = {}, 0
+        for url, request_time in requests:
+            weight = request_time if stat.key == 'time_sum' else 1
+            true_weights[url] = true_weights.get(url, 0) + weight
+            total += weight
+
+        self.assertEqual(stat.capacity, len(stat))
+        for url_id, url in enumerate(stat.urls):
+            # оценка сверху с погрешностью не больше total / capacity
+            self.assertLessEqual(true_weights[url], stat.weight(url_id))
+            self.assertLessEqual(stat.errors[url_id], total / stat.capacity)
+        # url тяжелее total / capacity не вытесняются
+        for url, weight in true_weights.items():
+            if weight > total / stat.capacity:
+                self.assertIn(url, stat.url_ids)
+
+    def test_bounds(self):
+        for key in HeavyHitterStat.keys:
+            stat = HeavyHitterStat(20, key)
+            for url, request_time in self._requests:
+                stat.add(url, request_time)
+            self.assert_bounds(stat, self._requests)
+            self.assertEqual(len(self._requests), stat.matched_count)
+
+    def test_merge(self):
+        left, right = HeavyHitterStat(20), HeavyHitterStat(20)
+        for number, (url, request_time) in enumerate(self._requests):
+            (left if number % 2 else right).add(url, request_time)
+        left.merge(right)
+        self.assertEqual(len(self._requests), left.matched_count)
+        self.assert_bounds(left, self._requests)
+
+    def test_series(self):
+        left, right = HeavyHitterStat(20, series=True), HeavyHitterStat(20, series=True)
+        for number, (url, request_time) in enumerate(self._requests):
+            (left if number % 2 else right).add(url, request_time, number // 1000)
+        left.merge(right)
+        self.assertEqual(len(left), len(left.series))
+        # ряд вытесненного url начинается заново вместе с count и sum
+        for url_id in range(len(left)):
+            series = left.series[url_id]
+            self.assertEqual(left.counts[url_id], sum(sketch.count for sketch in series.values()))
+            self.assertEqual(left.sums[url_id], sum(sketch.sum for sketch in series.values()))
+
+    def test_to_dict(self):
+        stat = HeavyHitterStat(20, 'count')
+        for url, request_time in self._requests[:5000]:
+            stat.add(url, request_time)
+        restored = LogStat.from_dict(json.loads(json.dumps(stat.to_dict())))
+        self.assertIsInstance(restored, HeavyHitterStat)
+        self.assertEqual((stat.capacity, stat.key, stat.urls, stat.errors), (restored.capacity, restored.key,
+                                                                             restored.urls, restored.errors))
+        self.assertEqual(stat.min_weight(), restored.min_weight())
+        for url, request_time in self._requests[5000:]:
+            stat.add(url, request_time)
+            restored.add(url, request_time)
+        self.assertEqual((stat.urls, stat.counts), (restored.urls, restored.counts))
+
+    def test_exact_while_not_full(self):
+        stat, exact = HeavyHitterStat(100), LogStat(0.01)
+        for url, request_time in self._requests[:100]:
+            stat.add(url, request_time)
+            exact.add(url, request_time)
+        self.assertEqual(exact.urls, stat.urls)
+        self.assertEqual(list(exact.sums), list(stat.sums))
+        self.assertEqual([0] * len(stat), list(stat.errors))
+
+
+class TestWindowStat(unittest.TestCase):
+
+    def test_window(self):
+        window_stat = WindowStat(300, 60)
+        for minute in range(10):
+            window_stat.bucket(minute * 60 + 30).add('/minute/{}'.format(minute), 1000)
+
+        # 10 минут запросов, в окне 5 минут - интервалы, хотя бы частично попадающие в окно
+        now = 9 * 60 + 30
+        self.assertEqual(6, len(window_stat.buckets))
+        self.assertEqual(['/minute/7', '/minute/8', '/minute/9'], window_stat.stat(120, now).urls)
+        self.assertEqual(6, window_stat.stat(300, now).matched_count)
+
+        window_stat.expire(now + 3600)
+        self.assertEqual(0, len(window_stat.buckets))
+
+
+if __name__ == '__main__':
+    unittest.main()
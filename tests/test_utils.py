@@ -1,11 +1,12 @@
 """Тесты класса Utils и публичных функций."""
 import datetime
 import os
+import sys
 import unittest
 import uuid
 from collections.abc import Iterable
 
-from log_analyzer import Utils, singleton_decorator
+from log_analyzer import Utils, numpy, singleton_decorator
 
 
 class TestUtils(unittest.TestCase):
@@ -130,6 +131,111 @@ class TestUtils(unittest.TestCase):
         self.assertIsInstance(result, Iterable)
         self.assertIsInstance(next(result), str)
 
+    def test_split_file(self):
+        cls = self._instance_class_being_tested
+        shards = cls.split_file(__file__, 4)
+        self.assertEqual(0, shards[0][0])
+        self.assertEqual(os.path.getsize(__file__), shards[-1][1])
+
+        with open(__file__, 'rb') as f:
+            file_data = f.read()
+        for start, end in shards:
+            self.assertTrue(start == 0 or file_data[start - 1:start] == b'\n')
+
+        lines = [line for start, end in shards for line in cls.read_range_gen(__file__, start, end)]
+        self.assertEqual(list(cls.read_file_gen(__file__)), lines)
+
+    def test_read_bytes_gen(self):
+        cls = self._instance_class_being_tested
+        with open(__file__, 'rb') as f:
+            file_lines = f.read().split(b'\n')[:-1]
+        self.assertEqual(file_lines, list(cls.read_bytes_gen(__file__, 1024)))
+
+        blocks = list(cls.read_blocks_gen(__file__, 1000, 10, 3010))
+        self.assertEqual(3, len(blocks))
+        self.assertEqual(3000, sum(len(block) for block in blocks))
+
+    def test_read_sample_blocks_gen(self):
+        cls = self._instance_class_being_tested
+        with open(__file__, 'rb') as f:
+            file_data = f.read()
+        file_lines = file_data.split(b'\n')[:-1]
+        line_starts = [0]
+        for line in file_lines[:-1]:
+            line_starts.append(line_starts[-1] + len(line) + 1)
+
+        for rate, block_size in ((0.1, 256), (0.5, 1000), (0.999, 64)):
+            windows = max(1, round(len(file_data) * rate / block_size))
+            stride, window = len(file_data) / windows, len(file_data) * rate / windows
+            expected = [line for start, line in zip(line_starts, file_lines)
+                        if any(int(number * stride) <= start < int(number * stride + window)
+                               for number in range(windows))]
+            blocks = list(cls.read_sample_blocks_gen(__file__, rate, block_size))
+            self.assertTrue(all(block.endswith(b'\n') for block in blocks))
+            self.assertEqual(expected, list(cls.split_lines_gen(blocks)))
+
+        shards = cls.split_file(__file__, 3)
+        self.assertEqual(file_lines, [line for start, end in shards
+                                      for line in cls.split_lines_gen(cls.read_sample_blocks_gen(__file__, 1, 64,
+                                                                                                 start, end))])
+
+    def test_open_gzip(self):
+        cls = self._instance_class_being_tested
+        log_file = 'tests/mock_data/log/nginx-access-ui.log-20170630.gz'
+        lines = list(cls.read_file_gen(log_file))
+        blocks = b''.join(cls.read_blocks_gen(log_file, 4096))
+
+        for backend in ('thread', 'pipe', cls.resolve_decompress_backend('auto')):
+            self.assertEqual(lines, list(cls.read_file_gen(log_file, backend)))
+            self.assertEqual(blocks, b''.join(cls.read_blocks_gen(log_file, 4096, backend=backend)))
+
+        self.assertIn(cls.resolve_decompress_backend('auto'), ('gzip', 'pipe', 'thread'))
+        self.assertIn(cls.resolve_decompress_backend('pipe'), ('pipe', 'thread'))
+
+    def test_open_gzip_stderr(self):
+        cls = self._instance_class_being_tested
+        log_file = 'tests/mock_data/log/nginx-access-ui.log-20170630.gz'
+        lines = list(cls.read_file_gen(log_file))
+        # распаковщик пишет в stderr больше буфера pipe до того, как вычитан stdout
+        command = [sys.executable, '-c', 'import gzip, sys; sys.stderr.write("warning\\n" * 100000); '
+                                         'sys.stdout.buffer.write(gzip.open(sys.argv[1]).read())']
+        decompress_command, Utils.decompress_command = Utils.__dict__['decompress_command'], staticmethod(lambda: command)
+        try:
+            self.assertEqual(lines, list(cls.read_file_gen(log_file, 'pipe')))
+        finally:
+            Utils.decompress_command = decompress_command
+
+    def test_resolve_report_backend(self):
+        cls = self._instance_class_being_tested
+        self.assertEqual('python', cls.resolve_report_backend('python'))
+        if numpy is None:
+            self.assertEqual('python', cls.resolve_report_backend('auto'))
+            self.assertRaises(AssertionError, cls.resolve_report_backend, 'numpy')
+        else:
+            self.assertEqual('numpy', cls.resolve_report_backend('auto'))
+
+    def test_open_gzip_broken(self):
+        cls = self._instance_class_being_tested
+        file_path = __file__ + self._temp_value + '.gz'
+        with open('tests/mock_data/log/nginx-access-ui.log-20170630.gz', 'rb') as f:
+            broken_data = f.read()[:1000]
+        with open(file_path, 'wb') as f:
+            f.write(broken_data)
+
+        try:
+            for backend in ('gzip', 'thread', 'pipe'):
+                with self.assertRaises((OSError, EOFError)):
+                    list(cls.read_blocks_gen(file_path, 4096, backend=backend))
+        finally:
+            os.remove(file_path)
+
+    def test_align_blocks_gen(self):
+        cls = self._instance_class_being_tested
+        blocks = [b'first\nsec', b'ond', b'\nthi', b'rd\n\nlast']
+        aligned = list(cls.align_blocks_gen(blocks))
+        self.assertEqual([b'first\n', b'second\n', b'third\n\n', b'last'], aligned)
+        self.assertEqual([b'first', b'second', b'third', b'', b'last'], list(cls.split_lines_gen(blocks)))
+
     def test_save_text_file(self):
         cls = self._instance_class_being_tested
         file_path = __file__ + self._temp_value
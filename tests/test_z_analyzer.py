@@ -1,9 +1,20 @@
 """Тесты класса Analyzer."""
+import csv
+import datetime
+import gzip
+import http.client
+import json
 import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
-import uuid
 
-from log_analyzer import Analyzer, Config, Logging
+from log_analyzer import (Analyzer, BatchRunner, Benchmark, Config, HistoryStore, LogFollower, LogGenerator, Logging,
+                          LogStat, ReportServer, RunStats, LOG_FORMATS, WindowStat, numpy)
 
 
 class TestAnalyzer(unittest.TestCase):
@@ -11,9 +22,9 @@ class TestAnalyzer(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls) -> None:
-        temp_uuid = str(uuid.uuid4())[:4]
-        cls._ts_file = temp_uuid + '.ts'
-        cls._temp_log = temp_uuid + '.log'
+        cls._temp_dir = tempfile.mkdtemp()
+        cls._ts_file = os.path.join(cls._temp_dir, 'analyzer.ts')
+        cls._temp_log = os.path.join(cls._temp_dir, 'analyzer.log')
         config_dict = {'ts_f_path': cls._ts_file,
                        'log_dir': 'tests/mock_data/log',
                        'report_dir': 'tests/mock_data/reports',
@@ -31,16 +42,1017 @@ class TestAnalyzer(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls) -> None:
-        os.remove(cls._ts_file)
-        os.remove(cls._temp_log)
+        shutil.rmtree(cls._temp_dir)
 
     def setUp(self) -> None:
         self._instance_class_being_tested = Analyzer(self._config, self._logger)
+        self._state = dict(vars(self._instance_class_being_tested))
+        self._test_dir = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        # Analyzer - синглтон: настройки и подмены методов теста не переходят в следующие тесты
+        state = vars(self._instance_class_being_tested)
+        state.clear()
+        state.update(self._state)
+        shutil.rmtree(self._test_dir)
+
+    def plain_log(self) -> str:
+        """Распакованный тестовый лог в каталоге теста."""
+        plain_log = os.path.join(self._test_dir, 'nginx-access-ui.log-20170630')
+        with gzip.open('tests/mock_data/log/nginx-access-ui.log-20170630.gz', 'rb') as src:
+            with open(plain_log, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        return plain_log
 
     def test_stop(self):
         self._instance_class_being_tested.stop()
         self.assertTrue(True)
 
+    def test_parse_log_workers(self):
+        cls = self._instance_class_being_tested
+        plain_log = self.plain_log()
+        cls.workers = 1
+        single_stat = cls.parse_log(plain_log)
+        cls.workers = 3
+        sharded_stat = cls.parse_log(plain_log)
+
+        self.assertEqual(single_stat.total_count, sharded_stat.total_count)
+        self.assertEqual(single_stat.urls, sharded_stat.urls)
+        self.assertEqual(single_stat.samples, sharded_stat.samples)
+        self.assertEqual(cls.make_report(single_stat), cls.make_report(sharded_stat))
+
+    def test_parse_log_workers_mismatch(self):
+        cls = self._instance_class_being_tested
+        temp_dir = tempfile.mkdtemp()
+        plain_log = os.path.join(temp_dir, 'nginx-access-ui.log-20170630')
+        with gzip.open('tests/mock_data/log/nginx-access-ui.log-20170630.gz', 'rb') as src:
+            lines = src.read().splitlines(keepends=True)[:1000]
+        # все промахи - в последнем диапазоне: по нему одному доля промахов больше порога, по всему логу - меньше
+        with open(plain_log, 'wb') as log_f:
+            log_f.writelines(lines + [b'broken line\n'] * 80)
+
+        cls.max_mismatch_count, cls.max_mismatch_percent = 10, 10
+        try:
+            cls.workers = 1
+            single_stat = cls.parse_log(plain_log)
+            cls.workers = 3
+            sharded_stat = cls.parse_log(plain_log)
+            self.assertEqual(80, sharded_stat.mismatch_count)
+            self.assertEqual(cls.make_report(single_stat), cls.make_report(sharded_stat))
+
+            # по слитой статистике порог превышен
+            with open(plain_log, 'ab') as log_f:
+                log_f.writelines([b'broken line\n'] * 100)
+            self.assertRaises(AssertionError, cls.parse_log, plain_log)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_parse_log_approx(self):
+        cls = self._instance_class_being_tested
+        log_file = 'tests/mock_data/log/nginx-access-ui.log-20170630.gz'
+        exact_report = cls.make_report(cls.parse_log(log_file))
+        cls.quantile_accuracy = 0.01
+        cls.report_percentiles = [90, 99]
+        approx_report = cls.make_report(cls.parse_log(log_file))
+
+        self.assertEqual([row['url'] for row in exact_report], [row['url'] for row in approx_report])
+        for exact_row, approx_row in zip(exact_report, approx_report):
+            self.assertEqual(exact_row['count'], approx_row['count'])
+            self.assertAlmostEqual(exact_row['time_med'], approx_row['time_med'],
+                                   delta=exact_row['time_med'] * 0.01 + 0.002)
+            self.assertIn('time_p90', approx_row)
+            self.assertIn('time_p99', approx_row)
+
+    def test_heavy_hitters(self):
+        cls = self._instance_class_being_tested
+        log_path = 'tests/mock_data/log/nginx-access-ui.log-20170630.gz'
+        cls.url_normalize = []
+        self.assertEqual('/api/1/banner/?x=1', cls.normalize_url('/api/1/banner/?x=1'))
+
+        cls.url_normalize = ['query', 'numeric', 'uuid']
+        self.assertEqual('/api/{id}/banner/{id}/{uuid}',
+                         cls.normalize_url('/api/1/banner/25019354/9f0c8cd1-5d5a-4e4b-9c46-5b2f3c7c2c8e?x=1'))
+        exact_stat = cls.parse_log(log_path)
+        self.assertFalse(any('?' in url for url in exact_stat.urls))
+        exact_rows = {row['url']: row for row in cls.make_report(exact_stat, len(exact_stat))}
+
+        cls.heavy_hitters = 20
+        stat = cls.parse_log(log_path)
+        self.assertEqual(20, len(stat))
+        self.assertEqual(exact_stat.matched_count, stat.matched_count)
+        report = cls.make_report(stat, 10)
+        self.assertEqual(cls.make_report(exact_stat, 1)[0]['url'], report[0]['url'])
+        for row in report:
+            self.assertLessEqual(exact_rows[row['url']]['time_sum'], row['time_sum'] + row['hh_error'])
+            if row['hh_exact']:
+                self.assertEqual(exact_rows[row['url']]['count'], row['count'])
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_numpy_report_backend(self):
+        cls = self._instance_class_being_tested
+        log_path = self.plain_log()
+        cls.checkpoint_dir = self._test_dir
+        cls.columnar_cache = True
+        cls.report_percentiles = [90, 99]
+        cls.numpy_min_size = 0
+        cls.report_backend = 'python'
+        stat = cls.parse_log(log_path)
+        python_reports = [cls.make_report(stat, limit, sort_key)
+                          for sort_key in ('time_sum', 'count', 'time_avg', 'time_max') for limit in (1, 10, 100)]
+
+        cls.report_backend = 'numpy'
+        stat = cls.parse_log(log_path)
+        numpy_reports = [cls.make_report(stat, limit, sort_key)
+                         for sort_key in ('time_sum', 'count', 'time_avg', 'time_max') for limit in (1, 10, 100)]
+        self.assertEqual(json.dumps(python_reports), json.dumps(numpy_reports))
+
+    def test_make_reports(self):
+        cls = self._instance_class_being_tested
+        stat = cls.parse_log('tests/mock_data/log/nginx-access-ui.log-20170630.gz')
+        all_rows = [cls.url_report(stat, url_id) for url_id in range(len(stat))]
+
+        cls.report_rankings = {'time_sum': 5, 'count': 3, 'time_avg': 2, 'time_max': 4}
+        reports = cls.make_reports(stat)
+        self.assertEqual(list(cls.report_rankings), list(reports))
+        for sort_key, limit in cls.report_rankings.items():
+            expected = sorted(all_rows, key=lambda row: row[sort_key], reverse=True)[:limit]
+            self.assertEqual(expected, reports[sort_key])
+
+    def test_insert_to_template(self):
+        cls = self._instance_class_being_tested
+        stat = cls.parse_log('tests/mock_data/log/nginx-access-ui.log-20170630.gz')
+        cls.report_rankings = {'time_sum': 5, 'count': 3}
+        reports = cls.make_reports(stat)
+        cls.template_path = os.path.join(self._test_dir, 'report.html')
+        cls.replace_tag = '$table_json'
+        with open(cls.template_path, 'w') as template:
+            template.write('$table_json;\n$table_json_count;')
+        self.assertEqual('{};\n{};'.format(json.dumps(reports['time_sum']), json.dumps(reports['count'])),
+                         cls.insert_to_template(reports))
+
+    def batch_configs(self) -> list:
+        """Конфиги трех арендаторов в каталоге теста: shop - один лог, api - два, empty - без логов."""
+        config_files = []
+        for tenant, log_names in (('shop', ['nginx-access-ui.log-20170630.gz']),
+                                  ('api', ['nginx-access-ui.log-20170629.gz', 'nginx-access-ui.log-20170630.gz']),
+                                  ('empty', [])):
+            tenant_dir = os.path.join(self._test_dir, tenant)
+            os.makedirs(os.path.join(tenant_dir, 'log'))
+            for log_name in log_names:
+                shutil.copy('tests/mock_data/log/nginx-access-ui.log-20170630.gz',
+                            os.path.join(tenant_dir, 'log', log_name))
+            config_files.append(os.path.join(self._test_dir, tenant + '.json'))
+            with open(config_files[-1], 'w') as config_f:
+                json.dump({'LOG_DIR': os.path.join(tenant_dir, 'log'), 'REPORT_DIR': tenant_dir,
+                           'REPORT_TEMPLATE_PATH': 'tests/mock_data/reports/report.html',
+                           'TS_F_PATH': os.path.join(tenant_dir, 'ts'), 'WORKERS': 2,
+                           'LOGFILE_PATH': os.path.join(tenant_dir, 'analyzer.log')}, config_f)
+        return config_files
+
+    def test_batch_tenant_size(self):
+        config_files = self.batch_configs()
+        runner = BatchRunner(config_files, workers=2, date_from='20170601')
+        with self.assertLogs('log_analyzer.batch', 'WARNING') as batch_log:
+            sizes = [runner.tenant_size(config_file) for config_file in config_files]
+        self.assertEqual(2 * sizes[0], sizes[1])
+        self.assertEqual(0, sizes[2])
+        self.assertIn('empty is sized 0: no logs found', batch_log.output[0])
+        # размер считается без Analyzer: TS_F_PATH и отчеты не проверяются
+        open(os.path.join(self._test_dir, 'shop', 'ts'), 'w').close()
+        self.assertEqual(sizes[0], runner.tenant_size(config_files[0]))
+
+    def test_batch_run(self):
+        config_files = self.batch_configs()
+        runner = BatchRunner(config_files, workers=2, date_from='20170601')
+        summary = runner.run()
+        self.assertEqual((2, 1), (summary['succeeded'], summary['failed']))
+        self.assertEqual(config_files, [tenant['config'] for tenant in summary['tenants']])
+        self.assertEqual([runner.tenant_size(config_file) for config_file in config_files],
+                         [tenant['size'] for tenant in summary['tenants']])
+        shop, api, __ = summary['tenants']
+        self.assertEqual(os.path.join(self._test_dir, 'shop', 'report-20170601-20170630.html'), shop['report'])
+        self.assertEqual(os.path.join(self._test_dir, 'api', 'report-20170601-20170630.html'), api['report'])
+        self.assertTrue(os.path.exists(os.path.join(self._test_dir, 'api', 'ts')))
+        with open(os.path.join(self._test_dir, 'shop', 'analyzer.log')) as log_f:
+            self.assertNotIn(api['tenant'], log_f.read())
+        # Синглтоны процесса не затронуты.
+        self.assertIs(self._config, Config())
+
+    def test_batch_run_failure(self):
+        # ошибка арендатора - в его сводке и логе, остальные арендаторы отрабатывают
+        config_files = self.batch_configs()
+        summary = BatchRunner(config_files, workers=2, date_from='20170601').run()
+        empty = summary['tenants'][2]
+        self.assertEqual((1, 'Web server log files not found in the date range.'), (empty['status'], empty['error']))
+        self.assertIsNone(empty.get('report'))
+        with open(os.path.join(self._test_dir, 'empty', 'analyzer.log')) as log_f:
+            self.assertIn(empty['error'], log_f.read())
+
+    def history_days(self):
+        """История двух дней по тестовому логу, второй день - один запрос top_url: (строки отчета, top_url)."""
+        cls = self._instance_class_being_tested
+        stat = cls.parse_log('tests/mock_data/log/nginx-access-ui.log-20170630.gz')
+        rows = {row['url']: row for row in cls.make_report(stat, len(stat))}
+        top_url = cls.make_report(stat, 1)[0]['url']
+        cls.history_path = os.path.join(self._test_dir, 'history.sqlite')
+        cls.save_history(datetime.date(2017, 6, 29), stat)
+        cls.save_history(datetime.date(2017, 6, 30), stat)
+        # Повторное сохранение дня заменяет его строки.
+        top_stat = LogStat()
+        top_stat.add(top_url, 3000000)
+        cls.save_history(datetime.date(2017, 6, 30), top_stat)
+        return rows, top_url
+
+    def test_history_trend(self):
+        rows, top_url = self.history_days()
+        history = HistoryStore(self._instance_class_being_tested.history_path)
+        trend = history.trend(top_url)
+        self.assertEqual(['2017-06-29', '2017-06-30'], [day['date'] for day in trend])
+        for metric in ('count', 'time_sum', 'time_avg', 'time_max', 'time_med'):
+            self.assertAlmostEqual(rows[top_url][metric], trend[0][metric], places=3)
+        self.assertEqual({'count': 1, 'time_sum': 3.0, 'time_max': 3.0, 'time_p99': 3.0},
+                         {metric: trend[1][metric] for metric in ('count', 'time_sum', 'time_max', 'time_p99')})
+        self.assertEqual(trend[:1], history.trend(top_url, date_to=datetime.date(2017, 6, 29)))
+        with history.connect() as connection:
+            self.assertEqual('wal', connection.execute('PRAGMA journal_mode').fetchone()[0])
+
+    def test_history_movers(self):
+        rows, top_url = self.history_days()
+        history = HistoryStore(self._instance_class_being_tested.history_path)
+        movers = history.movers(limit=3)
+        expected = sorted(rows.values(), key=lambda row: (-abs((3.0 if row['url'] == top_url else 0)
+                                                               - row['time_sum']), row['url']))[:3]
+        self.assertEqual([row['url'] for row in expected], [mover['url'] for mover in movers])
+        self.assertEqual(('2017-06-29', '2017-06-30'), (movers[0]['date_from'], movers[0]['date_to']))
+        self.assertEqual([], history.movers(date_from=datetime.date(2018, 1, 1)))
+        self.assertRaises(AssertionError, history.movers, metric='url')
+
+    def test_history_cli(self):
+        # результат запроса - в stdout или в --history-output
+        __, top_url = self.history_days()
+        history_path = self._instance_class_being_tested.history_path
+        history = HistoryStore(history_path)
+        config_path = os.path.join(self._test_dir, 'config.json')
+        with open(config_path, 'w') as config_f:
+            json.dump({'LOG_DIR': 'tests/mock_data/log', 'REPORT_DIR': self._test_dir, 'HISTORY_PATH': history_path,
+                       'LOGFILE_PATH': os.path.join(self._test_dir, 'analyzer.log')}, config_f)
+        command = [sys.executable, 'log_analyzer.py', '--config', config_path, '--history', 'trend',
+                   '--url', top_url, '--to', '20170629']
+        self.assertEqual(history.trend(top_url, date_to=datetime.date(2017, 6, 29)),
+                         json.loads(subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout))
+        output_path = os.path.join(self._test_dir, 'movers.json')
+        subprocess.run([*command[:4], '--history', 'movers', '--limit', '3', '--history-output', output_path],
+                       check=True)
+        with open(output_path) as output_f:
+            self.assertEqual(history.movers(limit=3), json.load(output_f))
+
+        # --history trend без --url - ошибка в лог и код возврата 1
+        self.assertEqual(1, subprocess.run(command[:6], stdout=subprocess.PIPE).returncode)
+        with open(os.path.join(self._test_dir, 'analyzer.log')) as log_f:
+            self.assertIn('--history trend requires --url.', log_f.read())
+
+    def test_sampling(self):
+        cls = self._instance_class_being_tested
+        plain_log = self.plain_log()
+        exact_stat = cls.parse_log(plain_log)
+        exact_rows = {row['url']: row for row in cls.make_report(exact_stat, len(exact_stat))}
+        exact_fingerprint = cls.stat_fingerprint
+
+        cls.sample_rate = 0.5
+        cls.sample_block_size = 512
+        for sample_mode in ('block', 'line'):
+            cls.sample_mode = sample_mode
+            stat = cls.parse_log(plain_log)
+            self.assertLess(stat.total_count, exact_stat.total_count)
+            self.assertEqual(stat.urls, cls.parse_log(plain_log).urls)
+            cls.read_mode = 'bytes'
+            self.assertEqual(stat.total_count, cls.parse_log(plain_log).total_count)
+            cls.read_mode = 'text'
+
+            row = cls.make_report(stat, 1)[0]
+            self.assertEqual(round(stat.counts[stat.url_ids[row['url']]] / 0.5), row['count'])
+            self.assertGreater(row['count_ci'], 0)
+            self.assertGreater(row['time_sum_ci'], 0)
+            self.assertGreater(row['time_percent_ci'], 0)
+            self.assertEqual(row, cls.url_report(stat, stat.url_ids[row['url']]))
+        self.assertNotEqual(exact_fingerprint, cls.stat_fingerprint)
+
+        # Выбранные url учитываются полностью, итоги - по всем строкам.
+        cls.sample_mode = 'url'
+        stat = cls.parse_log('tests/mock_data/log/nginx-access-ui.log-20170630.gz')
+        self.assertLess(len(stat), len(exact_stat))
+        self.assertEqual((exact_stat.total_count, exact_stat.total_time), (stat.total_count, stat.total_time))
+        sampled_rows = cls.make_report(stat, len(stat))
+        for row in sampled_rows:
+            self.assertNotIn('count_ci', row)
+            self.assertEqual(exact_rows[row['url']], row)
+        # доли - от всех запросов лога: по выбранным url в сумме меньше 100
+        sampled_count = sum(row['count'] for row in sampled_rows)
+        self.assertAlmostEqual(100 * sampled_count / stat.matched_count,
+                               sum(row['count_percentage'] for row in sampled_rows), delta=0.001 * len(sampled_rows))
+        self.assertLess(sum(row['time_percent'] for row in sampled_rows), 100)
+
+    def test_series(self):
+        cls = self._instance_class_being_tested
+        temp_dir = tempfile.mkdtemp()
+        log_file = LogGenerator(urls=50).generate(os.path.join(temp_dir, 'nginx-access-ui.log-20170630'), 2000)
+        cls.report_rankings = {'time_sum': 5, 'count': 5}
+        try:
+            exact_fingerprint = cls.stat_fingerprint
+            cls.series_seconds, cls.series_top = 3600, 3
+            self.assertNotEqual(exact_fingerprint, cls.stat_fingerprint)
+            reports = cls.make_reports(cls.parse_log(log_file))
+            for rows in reports.values():
+                self.assertTrue(all('series' in row for row in rows[:3]))
+            row = reports['time_sum'][0]
+            series = row['series']
+            # сутки 30.06.2017 +0300 - 24 часовых интервала от 29.06.2017 21:00 UTC
+            self.assertEqual(24, len(series['bucket']))
+            self.assertEqual('2017-06-29T21:00:00Z', series['bucket'][0])
+            self.assertEqual(row['count'], sum(series['count']))
+            self.assertAlmostEqual(row['time_sum'], sum(series['time_sum']), delta=0.012)
+            self.assertEqual(row['time_max'], max(series['time_max']))
+
+            # тот же ряд по метке из log_format, при разборе bytes блоками и в нескольких процессах
+            cls.log_format_parser = 'ui_short'
+            self.assertEqual(reports, cls.make_reports(cls.parse_log(log_file)))
+            cls.read_mode = 'bytes'
+            self.assertEqual(reports, cls.make_reports(cls.parse_log(log_file)))
+            cls.workers = 2
+            self.assertEqual(reports, cls.make_reports(cls.parse_log(log_file)))
+            cls.read_mode, cls.workers = 'text', 1
+
+            cls.quantile_accuracy = 0.01
+            approx_series = cls.make_reports(cls.parse_log(log_file))['time_sum'][0]['series']
+            self.assertEqual(series['count'], approx_series['count'])
+            self.assertEqual(series['time_max'], approx_series['time_max'])
+            for exact_med, approx_med in zip(series['time_med'], approx_series['time_med']):
+                self.assertAlmostEqual(exact_med, approx_med, delta=exact_med * 0.01 + 0.002)
+
+            cls.series_seconds = 0
+            self.assertNotIn('series', cls.make_reports(cls.parse_log(log_file))['time_sum'][0])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_series_unstamped_lines(self):
+        cls = self._instance_class_being_tested
+        temp_dir = tempfile.mkdtemp()
+        log_file = LogGenerator(urls=50).generate(os.path.join(temp_dir, 'nginx-access-ui.log-20170630'), 2000)
+        with open(log_file) as log_f:
+            lines = log_f.readlines()
+        with open(log_file, 'w') as log_f:
+            log_f.writelines(line.replace('/Jun/', '/Foo/') if number % 10 == 0 else line
+                             for number, line in enumerate(lines))
+        cls.report_rankings = {'time_sum': 5, 'count': 5}
+        try:
+            for log_format, read_mode in ((None, 'text'), ('ui_short', 'text'), ('ui_short', 'bytes')):
+                cls.log_format_parser, cls.read_mode = log_format, read_mode
+                cls.series_seconds = 0
+                reports = cls.make_reports(cls.parse_log(log_file))
+                cls.series_seconds, cls.series_top = 3600, 3
+                series_reports = cls.make_reports(cls.parse_log(log_file))
+                row = series_reports['time_sum'][0]
+                self.assertLess(sum(row['series']['count']), row['count'])
+                for rows in series_reports.values():
+                    for series_row in rows:
+                        series_row.pop('series', None)
+                self.assertEqual(reports, series_reports)
+        finally:
+            cls.log_format_parser, cls.read_mode, cls.series_seconds = None, 'text', 0
+            shutil.rmtree(temp_dir)
+
+    def test_report_sinks(self):
+        cls = self._instance_class_being_tested
+        stat = cls.parse_log('tests/mock_data/log/nginx-access-ui.log-20170630.gz')
+        cls.report_rankings = {'time_sum': 5, 'count': 3}
+        reports = cls.make_reports(stat)
+        temp_dir = tempfile.mkdtemp()
+        cls.template_path = os.path.join(temp_dir, 'report.html')
+        cls.replace_tag = '$table_json'
+        with open(cls.template_path, 'w') as template:
+            template.write('$table_json_count;\n$table_json;\n$table_json_time_sum')
+        cls.report_sinks = ['html', 'json', 'ndjson', 'csv', 'sqlite']
+        cls.incremental = False
+        try:
+            report_file = os.path.join(temp_dir, 'report-2017.06.30.html')
+            report_files = cls.save_report(reports, report_file)
+            self.assertEqual([os.path.join(temp_dir, 'report-2017.06.30' + extension)
+                              for extension in ('.html', '.json', '.ndjson', '.csv', '.sqlite')], report_files)
+            with open(report_files[0]) as html_f:
+                self.assertEqual(cls.insert_to_template(reports), html_f.read())
+            with open(report_files[1]) as json_f:
+                self.assertEqual(json.dumps(reports), json_f.read())
+
+            expected = [dict(ranking=sort_key, rank=rank, **row)
+                        for sort_key, rows in reports.items() for rank, row in enumerate(rows, 1)]
+            with open(report_files[2]) as ndjson_f:
+                self.assertEqual(expected, [json.loads(line) for line in ndjson_f])
+            with open(report_files[3], newline='') as csv_f:
+                csv_rows = list(csv.reader(csv_f))
+            fields = list(expected[0])
+            self.assertEqual([fields] + [[str(row[field]) for field in fields] for row in expected], csv_rows)
+            # числа - в том же виде, что в JSON отчете
+            self.assertEqual(json.dumps(expected[0]['time_sum']), csv_rows[1][fields.index('time_sum')])
+            connection = sqlite3.connect(report_files[4])
+            try:
+                connection.row_factory = sqlite3.Row
+                sqlite_rows = [dict(row) for row in connection.execute('SELECT * FROM report ORDER BY rowid')]
+            finally:
+                connection.close()
+            self.assertEqual(expected, sqlite_rows)
+
+            # Существующие файлы отчета не перезаписываются без incremental.
+            self.assertRaises(FileExistsError, cls.save_report, reports, report_file)
+        finally:
+            cls.report_sinks = ['html']
+            shutil.rmtree(temp_dir)
+
+    def test_report_sinks_failure(self):
+        cls = self._instance_class_being_tested
+        reports = cls.make_reports(cls.parse_log('tests/mock_data/log/nginx-access-ui.log-20170630.gz'))
+        temp_dir = tempfile.mkdtemp()
+        report_file = os.path.join(temp_dir, 'report-2017.06.30.html')
+        cls.report_sinks = ['json', 'csv', 'sqlite']
+        report_sink = cls.report_sink
+
+        def fail(*args):
+            raise sqlite3.OperationalError('disk I/O error')
+
+        def failing_sink(name):
+            sink = report_sink(name)
+            if name == 'sqlite':
+                sink.write = fail
+            return sink
+        try:
+            # ошибка последнего формата: нет ни файлов отчета, ни временных файлов
+            cls.report_sink = failing_sink
+            self.assertRaises(sqlite3.OperationalError, cls.save_report, reports, report_file)
+            self.assertEqual([], os.listdir(temp_dir))
+
+            # в incremental уже записанный отчет остается прежним
+            cls.report_sink = report_sink
+            report_files = cls.save_report(reports, report_file)
+            contents = []
+            for path in report_files:
+                with open(path, 'rb') as report_f:
+                    contents.append(report_f.read())
+            cls.incremental = True
+            cls.report_sink = failing_sink
+            self.assertRaises(sqlite3.OperationalError, cls.save_report, {'time_sum': []}, report_file)
+            self.assertEqual(sorted(os.path.basename(path) for path in report_files), sorted(os.listdir(temp_dir)))
+            for path, content in zip(report_files, contents):
+                with open(path, 'rb') as report_f:
+                    self.assertEqual(content, report_f.read())
+        finally:
+            cls.report_sink = report_sink
+            cls.report_sinks, cls.incremental = ['html'], False
+            shutil.rmtree(temp_dir)
+
+    def test_parse_line_log_format(self):
+        cls = self._instance_class_being_tested
+        cls.log_format_parser = 'ui_short'
+        lines = list(cls.read_file_gen('tests/mock_data/log/nginx-access-ui.log-20170630.gz'))
+        for line in lines:
+            self.assertEqual(cls.parse_line_re(line), cls.parse_line(line))
+
+        # Строка не под log_format, но под паттерн - разбирается паттерном.
+        line = lines[0].replace('] "', ']  "', 1)
+        self.assertIsNone(cls.log_format_parser(line))
+        self.assertIsNone(cls.parse_line(line))
+        cls.web_server_re = r'^.*?\"\S+\s(\S+)\s\S+\".*\s(\S+)$'
+        self.assertEqual(cls.parse_line_re(lines[0]), cls.parse_line(line))
+
+    def test_parse_log_bytes(self):
+        cls = self._instance_class_being_tested
+        temp_dir = tempfile.mkdtemp()
+        plain_log = os.path.join(temp_dir, 'nginx-access-ui.log-20170630')
+        with gzip.open('tests/mock_data/log/nginx-access-ui.log-20170630.gz', 'rb') as src:
+            log_data = src.read().replace(b'\n', b'\ngarbage\n\n', 2)
+        with open(plain_log, 'wb') as dst:
+            dst.write(log_data)
+
+        cls.max_mismatch_count = 10
+        cls.max_mismatch_percent = 10
+        try:
+            text_stat = cls.parse_log(plain_log)
+            cls.read_mode = 'bytes'
+            cls.read_buffer_size = 4096
+            bytes_stat = cls.parse_log(plain_log)
+            cls.log_format_parser = 'ui_short'
+            blocks_stat = cls.parse_log(plain_log)
+        finally:
+            shutil.rmtree(temp_dir)
+
+        for stat in (bytes_stat, blocks_stat):
+            self.assertEqual(text_stat.total_count, stat.total_count)
+            self.assertEqual(4, stat.mismatch_count)
+            self.assertEqual(cls.make_report(text_stat), cls.make_report(stat))
+
+    def test_parse_log_incremental(self):
+        cls = self._instance_class_being_tested
+        temp_dir = tempfile.mkdtemp()
+        plain_log = os.path.join(temp_dir, 'nginx-access-ui.log-20170630')
+        with gzip.open('tests/mock_data/log/nginx-access-ui.log-20170630.gz', 'rb') as src:
+            log_data = src.read().rstrip(b'\n') + b'\n'
+        middle = len(log_data) // 2
+
+        cls.incremental = True
+        cls.checkpoint_dir = temp_dir
+        try:
+            with open(plain_log, 'wb') as log_f:
+                log_f.write(log_data[:middle])
+            first_stat = cls.parse_log_incremental(plain_log)
+            self.assertEqual(log_data[:middle].count(b'\n'), first_stat.total_count)
+            self.assertTrue(os.path.exists(cls.checkpoint_path(plain_log)))
+
+            with open(plain_log, 'ab') as log_f:
+                log_f.write(log_data[middle:])
+            incremental_stat = cls.parse_log_incremental(plain_log)
+            full_stat = cls.parse_log(plain_log)
+            self.assertEqual(full_stat.total_count, incremental_stat.total_count)
+            self.assertEqual(cls.make_report(full_stat), cls.make_report(incremental_stat))
+            self.assertEqual(full_stat.total_count, cls.parse_log_incremental(plain_log).total_count)
+
+            # truncate + новые строки: разбор с начала файла
+            with open(plain_log, 'wb') as log_f:
+                log_f.write(log_data[middle:])
+            self.assertEqual(log_data[middle:].count(b'\n'), cls.parse_log_incremental(plain_log).total_count)
+
+            # перезапись на месте с тем же размером: разбор с начала файла
+            tail_data = log_data[middle:]
+            changed_at = tail_data.rindex(b'/api/')
+            changed_data = tail_data[:changed_at] + b'/apx/' + tail_data[changed_at + 5:]
+            self.assertGreater(changed_at, 4096)
+            file_stat = os.stat(plain_log)
+            with open(plain_log, 'r+b') as log_f:
+                log_f.write(changed_data)
+            os.utime(plain_log, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 1000000000))
+            self.assertEqual(cls.make_report(cls.parse_log(plain_log)), cls.make_report(cls.parse_log_incremental(plain_log)))
+
+            # битый checkpoint игнорируется, лог разбирается заново
+            with open(cls.checkpoint_path(plain_log), 'r+b') as checkpoint_f:
+                checkpoint_f.truncate(100)
+            self.assertIsNone(cls.load_checkpoint(plain_log))
+            self.assertEqual(log_data[middle:].count(b'\n'), cls.parse_log_incremental(plain_log).total_count)
+        finally:
+            cls.incremental = False
+            shutil.rmtree(temp_dir)
+
+    def test_columnar_cache(self):
+        cls = self._instance_class_being_tested
+        temp_dir = tempfile.mkdtemp()
+        log_path = os.path.join(temp_dir, 'nginx-access-ui.log-20170630.gz')
+        shutil.copy('tests/mock_data/log/nginx-access-ui.log-20170630.gz', log_path)
+        cls.checkpoint_dir = temp_dir
+        try:
+            plain_stat = cls.parse_log(log_path)
+            cls.columnar_cache = True
+            self.assertEqual(cls.make_report(plain_stat), cls.make_report(cls.parse_log(log_path)))
+            self.assertTrue(os.path.exists(cls.columns_path(log_path)))
+
+            # актуальный columns файл - строки не разбираются
+            parse_range, cls.parse_range = cls.parse_range, None
+            cached_stat = cls.parse_log(log_path)
+            self.assertEqual(plain_stat.total_count, cached_stat.total_count)
+            self.assertEqual(plain_stat.mismatch_count, cached_stat.mismatch_count)
+            self.assertEqual(cls.make_report(plain_stat), cls.make_report(cached_stat))
+            cls.url_normalize = ['query']
+            self.assertFalse(any('?' in url for url in cls.parse_log(log_path).urls))
+            cls.url_normalize = []
+
+            # лог изменился - columns файл устарел
+            os.utime(log_path, ns=(0, 0))
+            self.assertIsNone(cls.load_columns(log_path))
+            cls.parse_range = parse_range
+            self.assertEqual(plain_stat.total_count, cls.parse_log(log_path).total_count)
+            self.assertIsNotNone(cls.load_columns(log_path))
+
+            # битый columns файл игнорируется и пересобирается
+            columns_size = os.path.getsize(cls.columns_path(log_path))
+            for columns_length in (len(cls.columns_magic) + 2, len(cls.columns_magic) + 30, columns_size - 10):
+                with open(cls.columns_path(log_path), 'r+b') as columns_f:
+                    columns_f.truncate(columns_length)
+                self.assertIsNone(cls.load_columns(log_path))
+                self.assertEqual(cls.make_report(plain_stat), cls.make_report(cls.parse_log(log_path)))
+                self.assertIsNotNone(cls.load_columns(log_path))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_columnar_cache_urls(self):
+        cls = self._instance_class_being_tested
+        temp_dir = tempfile.mkdtemp()
+        log_path = os.path.join(temp_dir, 'access.log')
+        with open(log_path, 'w') as log_f:
+            log_f.write('log\n')
+        cls.checkpoint_dir = temp_dir
+        stat = LogStat()
+        for url, request_time in (('/a\nb', 1000), ('/c', 2000), ('/д', 3000), ('/a\nb', 4000)):
+            stat.add(url, request_time)
+        try:
+            cls.save_columns(log_path, stat)
+            header, urls, url_id_column, time_column = cls.load_columns(log_path)
+            self.assertEqual(['/a\nb', '/c', '/д'], urls)
+            self.assertEqual([0, 0, 1, 2], list(url_id_column))
+            self.assertEqual(stat.samples, cls.stat_from_columns((header, urls, url_id_column, time_column)).samples)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_json_log(self):
+        cls = self._instance_class_being_tested
+        text_stat = cls.parse_log('tests/mock_data/log/nginx-access-ui.log-20170630.gz')
+        temp_dir = tempfile.mkdtemp()
+        json_log = os.path.join(temp_dir, 'nginx-access-ui.log-20170630')
+        with gzip.open('tests/mock_data/log/nginx-access-ui.log-20170630.gz', 'rt') as src:
+            with open(json_log, 'w') as log_f:
+                for line in src:
+                    parsed_line = cls.parse_line(line)
+                    if parsed_line:
+                        url, request_time = parsed_line
+                        log_f.write(json.dumps({'request': 'GET {} HTTP/1.1'.format(url), 'status': '200',
+                                                'request_time': '{:.3f}'.format(request_time / 1000000)}) + '\n')
+                    else:
+                        log_f.write(line)
+
+        cls.max_mismatch_count = 10
+        cls.max_mismatch_percent = 10
+        try:
+            cls.log_format_parser = 'json'
+            for read_mode, workers in (('text', 1), ('bytes', 1), ('bytes', 2)):
+                cls.read_mode, cls.workers = read_mode, workers
+                json_stat = cls.parse_log(json_log)
+                self.assertEqual(text_stat.total_count, json_stat.total_count)
+                self.assertEqual(cls.make_report(text_stat), cls.make_report(json_stat))
+
+            cls.workers = 1
+            cls.log_format_parser = ''
+            cls.log_format_detect = True
+            cls.validate_log(json_log)
+            self.assertEqual('json:request:request_time', cls.log_format_parser.log_format)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def combined_log(self) -> str:
+        """Лог combined с $request_time в конце (3000 строк, 7 url) в каталоге теста."""
+        combined_log = os.path.join(self._test_dir, 'nginx-access-ui.log-20170630')
+        with open(combined_log, 'w') as log_f:
+            for number in range(3000):
+                log_f.write('1.2.3.4 - - [29/Jun/2017:03:50:22 +0300] "GET /api/{} HTTP/1.1" 200 927 "-" '
+                            '"Lynx/2.8.8dev.9" 0.{:03d}\n'.format(number % 7, number % 1000))
+        cls = self._instance_class_being_tested
+        cls.max_mismatch_count = 10
+        cls.max_mismatch_percent = 10
+        cls.validate_lines = 100
+        return combined_log
+
+    def test_log_format_validation(self):
+        # ui_short и паттерн по умолчанию combined не разбирают - отказ по выборке без полного разбора
+        cls = self._instance_class_being_tested
+        combined_log = self.combined_log()
+        self.assertEqual(200, len(cls.sample_lines(combined_log, 100)))
+        cls.parse_log = None
+        self.assertRaises(AssertionError, cls.validate_log, combined_log)
+
+    def test_log_format_detect(self):
+        cls = self._instance_class_being_tested
+        combined_log = self.combined_log()
+        cls.log_format_detect = True
+        for read_mode in ('text', 'bytes'):
+            cls.read_mode = read_mode
+            cls.log_format_parser = ''
+            cls.validate_log(combined_log)
+            self.assertEqual(LOG_FORMATS['combined_rt'], cls.log_format_parser.log_format)
+            stat = cls.parse_log(combined_log)
+            self.assertEqual(3000, stat.matched_count)
+            self.assertEqual(['/api/{}'.format(number) for number in range(7)], stat.urls)
+
+    def test_start_range(self):
+        cls = self._instance_class_being_tested
+        temp_dir = tempfile.mkdtemp()
+        for log_date in ('20170628', '20170629', '20170630', '20170701'):
+            shutil.copy('tests/mock_data/log/nginx-access-ui.log-20170630.gz',
+                        os.path.join(temp_dir, 'nginx-access-ui.log-{}.gz'.format(log_date)))
+
+        cls.log_dir = cls.report_dir = cls.checkpoint_dir = temp_dir
+        date_from, date_to = datetime.date(2017, 6, 29), datetime.date(2017, 6, 30)
+        try:
+            logs = cls.logs_in_range(date_from, date_to)
+            self.assertEqual([date_from, date_to], [log_date for log_date, __ in logs])
+
+            # без incremental checkpoint в report_dir не пишутся
+            os.remove(cls.start(date_from, date_to))
+            self.assertEqual([], [name for name in os.listdir(temp_dir) if name.endswith('.checkpoint')])
+
+            cls.incremental = True
+
+            # статистика логов для истории берется из разбора интервала, логи разбираются по разу
+            cls.history_path = os.path.join(temp_dir, 'history.sqlite')
+            parsed_logs = []
+            parse_log_incremental = cls.parse_log_incremental
+            cls.parse_log_incremental = lambda log_file: parsed_logs.append(log_file) or parse_log_incremental(log_file)
+            report_file_name = cls.start(date_from, date_to)
+            self.assertTrue(report_file_name.endswith('report-20170629-20170630.html'))
+            self.assertTrue(os.path.exists(cls.checkpoint_path(logs[0][1])))
+            self.assertEqual([log_file for __, log_file in logs], parsed_logs)
+            cls.parse_log_incremental = parse_log_incremental
+            top_url = cls.make_report(cls.parse_log_incremental(logs[0][1]))[0]['url']
+            self.assertEqual(['2017-06-29', '2017-06-30'],
+                             [row['date'] for row in HistoryStore(cls.history_path).trend(top_url)])
+
+            # Повторный разбор берет статистику из checkpoint без чтения логов.
+            cls.parse_log = None
+            stat = cls.parse_logs([log_file for __, log_file in logs])
+            single_stat = cls.parse_log_incremental(logs[0][1])
+            self.assertEqual(single_stat.total_count * 2, stat.total_count)
+            self.assertEqual(single_stat.sums[0] * 2, stat.sums[0])
+        finally:
+            cls.incremental = False
+            shutil.rmtree(temp_dir)
+
+    def catalog_log_dir(self) -> str:
+        """Каталог логов с архивом и посторонними файлами, mtime каталога - 01.07.2017; log_dir и каталог логов."""
+        cls = self._instance_class_being_tested
+        log_dir = os.path.join(self._test_dir, 'log')
+        os.makedirs(os.path.join(log_dir, 'archive'))
+        for log_name in ('nginx-access-ui.log-20170628.gz', 'nginx-access-ui.log-20170630',
+                         'archive/nginx-access-ui.log-20170701.gz', 'nginx-access-ui.log-20171399', 'other.log'):
+            open(os.path.join(log_dir, log_name), 'w').close()
+        old_mtime = datetime.datetime(2017, 7, 1).timestamp()
+        os.utime(log_dir, (old_mtime, old_mtime))
+        cls.log_dir = log_dir
+        cls.log_catalog_path = os.path.join(log_dir, 'archive', 'catalog.json')
+        return log_dir
+
+    def test_log_catalog(self):
+        cls = self._instance_class_being_tested
+        log_dir = self.catalog_log_dir()
+        self.assertEqual(os.path.join(log_dir, 'nginx-access-ui.log-20170630'), cls.latest_log)
+        self.assertEqual([datetime.date(2017, 6, 28), datetime.date(2017, 6, 30)],
+                         [log_file.date for log_file in cls.log_catalog])
+        self.assertTrue(os.path.exists(cls.log_catalog_path))
+
+    def test_log_catalog_reuse(self):
+        cls = self._instance_class_being_tested
+        log_dir = self.catalog_log_dir()
+        self.assertEqual(2, len(cls.log_catalog))
+
+        # mtime каталога не изменился - каталог берется из файла без чтения каталога
+        cls._Analyzer__log_catalog = None
+        cls.scan_log_dir = None
+        self.assertEqual(2, len(cls.log_catalog))
+
+        del cls.scan_log_dir
+        open(os.path.join(log_dir, 'nginx-access-ui.log-20170629.gz'), 'w').close()
+        self.assertEqual(3, len(cls.log_catalog))
+        with open(cls.log_catalog_path) as catalog_f:
+            self.assertEqual('2017-06-30', json.load(catalog_f)['logs'][-1][0])
+
+    def test_log_catalog_broken(self):
+        # битый каталог перестраивается
+        cls = self._instance_class_being_tested
+        self.catalog_log_dir()
+        with open(cls.log_catalog_path, 'w') as catalog_f:
+            catalog_f.write('{"logs": [')
+        cls._Analyzer__log_catalog = None
+        self.assertEqual(2, len(cls.log_catalog))
+        with open(cls.log_catalog_path) as catalog_f:
+            self.assertEqual(2, len(json.load(catalog_f)['logs']))
+
+    def test_log_catalog_recursive(self):
+        cls = self._instance_class_being_tested
+        log_dir = self.catalog_log_dir()
+        cls.log_dir_recursive = True
+        self.assertEqual(os.path.join(log_dir, 'archive', 'nginx-access-ui.log-20170701.gz'), cls.latest_log)
+        self.assertEqual(2, len(cls.logs_in_range(datetime.date(2017, 6, 29))))
+
+    def test_follow(self):
+        cls = self._instance_class_being_tested
+        temp_dir = tempfile.mkdtemp()
+        active_log = os.path.join(temp_dir, 'access.log')
+        with gzip.open('tests/mock_data/log/nginx-access-ui.log-20170630.gz', 'rb') as src:
+            lines = src.read().splitlines(keepends=True)[:30]
+        with open(active_log, 'wb') as log_f:
+            log_f.write(lines[0])
+
+        cls.report_dir = temp_dir
+        cls.follow_log_path = active_log
+        cls.follow_windows = [5, 15]
+        cls.template_path = 'tests/mock_data/reports/report.html'
+        window_stat = WindowStat(15 * 60)
+        follower = LogFollower(active_log)
+        try:
+            # с конца файла, неполная строка ждет окончания
+            with open(active_log, 'ab') as log_f:
+                log_f.write(lines[1] + lines[2][:10])
+            self.assertEqual([lines[1].rstrip(b'\n')], follower.read_lines())
+            with open(active_log, 'ab') as log_f:
+                log_f.write(lines[2][10:])
+            cls.follow_lines(follower.read_lines(), window_stat, 1000)
+
+            # ротация: старый файл переименован, новый создан
+            os.rename(active_log, active_log + '.1')
+            with open(active_log + '.1', 'ab') as log_f:
+                log_f.write(lines[3])
+            with open(active_log, 'wb') as log_f:
+                log_f.write(lines[4])
+            cls.follow_lines(follower.read_lines(), window_stat, 1000)
+            cls.follow_lines(follower.read_lines(), window_stat, 1000)
+
+            # truncate
+            with open(active_log, 'wb') as log_f:
+                log_f.write(b'garbage\n')
+            cls.follow_lines(follower.read_lines(), window_stat, 1000)
+            cls.follow_lines(follower.read_lines(), window_stat, 1000)
+            follower.close()
+
+            stat = window_stat.stat(300, 1000)
+            self.assertEqual(4, stat.total_count)
+            self.assertEqual(3, stat.matched_count)
+            self.assertEqual(1, stat.mismatch_count)
+
+            report_files = cls.render_windows(window_stat, 1000)
+            self.assertEqual([cls.live_report_file_name(5), cls.live_report_file_name(15)], report_files)
+            self.assertTrue(all(os.path.exists(report_file) for report_file in report_files))
+
+            stop = threading.Event()
+            follow_thread = threading.Thread(target=cls.follow, args=(stop, 0.01))
+            follow_thread.start()
+            stop.set()
+            follow_thread.join()
+            self.assertFalse(follow_thread.is_alive())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_report_server(self):
+        cls = self._instance_class_being_tested
+        stat = cls.parse_log('tests/mock_data/log/nginx-access-ui.log-20170630.gz')
+        server = ReportServer(cls, port=0)
+        server.publish('5m', stat)
+        server.start()
+        connection = http.client.HTTPConnection(server.host, server.port)
+        try:
+            connection.request('GET', '/top?limit=3&sort=count&prefix=/api/v2/banner')
+            response = connection.getresponse()
+            rows = json.loads(response.read())['rows']
+            self.assertEqual(200, response.status)
+            self.assertEqual(cls.make_report(stat, 3, 'count',
+                                             url_ids=[url_id for url_id, url in enumerate(stat.urls)
+                                                      if url.startswith('/api/v2/banner')]), rows)
+            self.assertTrue(all(row['url'].startswith('/api/v2/banner') for row in rows))
+
+            # тот же запрос по той же версии - из кеша, сжатый, с проверкой ETag
+            connection.request('GET', '/top?limit=3&sort=count&prefix=/api/v2/banner',
+                               headers={'Accept-Encoding': 'gzip'})
+            response = connection.getresponse()
+            self.assertEqual('gzip', response.getheader('Content-Encoding'))
+            self.assertEqual(rows, json.loads(gzip.decompress(response.read()))['rows'])
+            self.assertEqual(1, len(server.cache))
+            connection.request('GET', '/top?limit=3&sort=count&prefix=/api/v2/banner',
+                               headers={'If-None-Match': response.getheader('ETag')})
+            response = connection.getresponse()
+            response.read()
+            self.assertEqual(304, response.status)
+
+            # публикация из потока разбора выполняется в потоке сервера
+            set_stat_threads = []
+            set_stat = server.set_stat
+            server.set_stat = lambda *args: set_stat_threads.append(threading.current_thread()) or set_stat(*args)
+            server.publish('5m', stat)
+            connection.request('GET', '/top?window=5m&limit=3&sort=count&prefix=/api/v2/banner')
+            self.assertEqual(2, json.loads(connection.getresponse().read())['version'])
+            self.assertEqual([server.thread], set_stat_threads)
+            del server.set_stat
+
+            for target, status in (('/top?sort=median', 400), ('/top?window=1m', 404), ('/stats', 200)):
+                connection.request('GET', target)
+                response = connection.getresponse()
+                response.read()
+                self.assertEqual(status, response.status)
+
+            # ошибка построения ответа - 500, ответ не кешируется
+            def fail(*args):
+                raise ValueError('broken')
+            server.top_body = fail
+            connection.request('GET', '/top?limit=4')
+            response = connection.getresponse()
+            self.assertEqual(500, response.status)
+            self.assertIn('broken', json.loads(response.read())['error'])
+            del server.top_body
+            connection.request('GET', '/top?limit=4')
+            response = connection.getresponse()
+            response.read()
+            self.assertEqual(200, response.status)
+        finally:
+            connection.close()
+            server.stop()
+
+    def test_benchmark(self):
+        cls = self._instance_class_being_tested
+        cls.log_format_parser = 'ui_short'
+        results = Benchmark(cls, repeat=1).run('tests/mock_data/log/nginx-access-ui.log-20170630.gz')
+        self.assertIn('regex', results['parsers'])
+        self.assertIn('log_format', results['parsers'])
+
+    def test_benchmark_suite(self):
+        cls = self._instance_class_being_tested
+        cls.max_mismatch_count = cls.max_mismatch_percent = 10
+        temp_dir = tempfile.mkdtemp()
+        baseline_path = os.path.join(temp_dir, 'baseline.json')
+        try:
+            log_file = LogGenerator(urls=100, malformed_share=0.05).generate(os.path.join(temp_dir, 'log.gz'), 1000)
+            stat = cls.parse_log(log_file)
+            self.assertEqual(1000, stat.total_count)
+            self.assertTrue(0 < stat.mismatch_count < 100)
+            # Zipf: самый частый url встречается чаще десятого
+            self.assertGreater(stat.counts[stat.url_ids['/api/1/campaigns/?id=0']],
+                               stat.counts[stat.url_ids['/api/v2/banner/10']])
+
+            results = Benchmark(cls).suite([2000], temp_dir, baseline_path)
+            self.assertEqual(list(Benchmark.STAGES), list(results['2000']))
+            self.assertTrue(os.path.exists(baseline_path))
+            self.assertEqual([], Benchmark.regressions(results, results, 0.2))
+
+            with open(baseline_path) as baseline_f:
+                baseline = json.load(baseline_f)
+            baseline['2000']['parse_line']['lines_per_sec'] *= 2
+            self.assertEqual(1, len(Benchmark.regressions(results, baseline, 0.2)))
+
+            # полный запуск в том же процессе не меняет настройки analyzer
+            settings = (cls.log_dir, cls.report_dir, cls.nginx_log_name_re, cls.log_catalog_path, cls.incremental)
+            self.assertGreater(Benchmark.run_stage(cls, 'end_to_end', os.path.join(temp_dir, 'bench-2000.log'))['seconds'], 0)
+            self.assertEqual(settings, (cls.log_dir, cls.report_dir, cls.nginx_log_name_re, cls.log_catalog_path,
+                                        cls.incremental))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_summary(self):
+        cls = self._instance_class_being_tested
+        temp_dir = tempfile.mkdtemp()
+        cls.report_dir = temp_dir
+        cls.ts_f_path = ''
+        cls.run_summary = True
+        cls.profile = True
+        try:
+            report_file_name = cls.start()
+            with open(cls.summary_path) as summary_f:
+                summary = json.load(summary_f)
+            self.assertTrue(os.path.exists(os.path.join(temp_dir, 'log_analyzer.summary.prof')))
+
+            cls.profile = False
+            cls.read_mode = 'bytes'
+            cls.log_format_parser = 'ui_short'
+            os.remove(report_file_name)
+            cls.start()
+            with open(cls.summary_path) as summary_f:
+                bytes_summary = json.load(summary_f)
+        finally:
+            shutil.rmtree(temp_dir)
+
+        stat = cls.parse_log(cls.latest_log)
+        for run_summary in (summary, bytes_summary):
+            self.assertEqual(set(RunStats.STAGES), set(run_summary['stages']))
+            self.assertEqual(stat.total_count, run_summary['counters']['lines'])
+            self.assertEqual(os.path.getsize(cls.latest_log), run_summary['counters']['bytes'])
+            self.assertEqual(len(stat), run_summary['counters']['urls'])
+            self.assertGreater(run_summary['stages']['read']['wall'], 0)
+            self.assertGreater(run_summary['lines_per_sec'], 0)
+        self.assertGreater(summary['stages']['aggregate']['wall'], 0)
+
+    def test_run_stats_timed_gen(self):
+        run_stats = RunStats()
+        # None (промах разбора) - обычный элемент, а не конец перебора
+        self.assertEqual(['a', None, 'b'], list(run_stats.timed_gen(['a', None, 'b'], 'parse')))
+
+    def test_prometheus_textfile(self):
+        cls = self._instance_class_being_tested
+        cls.report_dir = self._test_dir
+        cls.prometheus_textfile = os.path.join(self._test_dir, 'log_analyzer.prom')
+        cls.start()
+        with open(cls.prometheus_textfile) as prom_f:
+            metrics = dict(line.rsplit(' ', 1) for line in prom_f.read().splitlines() if not line.startswith('#'))
+
+        stat = cls.parse_log(cls.latest_log)
+        self.assertEqual(str(stat.total_count), metrics['log_analyzer_lines_processed{mode="batch"}'])
+        self.assertEqual(str(len(stat)), metrics['log_analyzer_urls{mode="batch"}'])
+        self.assertEqual(str(os.path.getsize(cls.latest_log)), metrics['log_analyzer_bytes_read{mode="batch"}'])
+        self.assertIn('log_analyzer_mismatch_ratio{mode="batch"}', metrics)
+        self.assertIn('log_analyzer_last_success_timestamp_seconds{mode="batch"}', metrics)
+        self.assertIn('log_analyzer_stage_seconds{mode="batch",stage="read",clock="wall"}', metrics)
+
+    def test_prometheus_textfile_follow(self):
+        cls = self._instance_class_being_tested
+        cls.report_dir = self._test_dir
+        cls.prometheus_textfile = os.path.join(self._test_dir, 'log_analyzer.prom')
+        with open(cls.latest_log, 'rb') as log_f:
+            lines = gzip.decompress(log_f.read()).splitlines()
+        window_stat = WindowStat(3600)
+        cls.run_stats = RunStats()
+        cls.follow_lines(lines, window_stat, 1000)
+        cls.render_windows(window_stat, 1000)
+        with open(cls.prometheus_textfile) as prom_f:
+            self.assertIn('log_analyzer_lines_processed{{mode="follow"}} {}'.format(len(lines)), prom_f.read())
+        # файл заменяется атомарно - временных файлов не остается
+        self.assertEqual(['log_analyzer.prom'], [name for name in os.listdir(self._test_dir) if '.prom' in name])
+
     def test_start(self):
         report_file_name = self._instance_class_being_tested.start()
         self.assertIsInstance(report_file_name, str)